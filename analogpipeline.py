@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Per-tick processing of the analog pins of a board
+
+All the analog values read in one tick are processed together, as one vector:
+
+    despike   median of the last N readings of each pin
+    calibrate running min/max of each pin, the value is normalized to 0-1
+    smooth    one-pole lowpass (exponential moving average)
+    scale     linear mapping from 0-1 to any range
+
+If numpy is available, each stage is one vectorized operation for all the pins,
+otherwise plain arrays are used.
+
+Calibration ranges can be saved to a file and loaded at startup, so that a
+calibrated installation does not need to be recalibrated at each start.
+
+    pipeline = AnalogPipeline(calibrate=True, smooth=0.8, median=3, calibrationfile="cal.json")
+    pipeline.start([0, 1, 2])              # the analog pins to process
+    values = pipeline.process([0.1, 0.5, 0.7])
+    ...
+    pipeline.close()                       # saves the calibration
+"""
+import os
+import json
+from array import array
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+# below this number of pins, the per-call overhead of numpy is higher than
+# looping over an array
+NUMPY_MINPINS = 24
+
+class AnalogPipeline(object):
+    """
+    calibrate: normalize each pin to the range seen so far
+    smooth: 0 (no smoothing) to 1 (frozen). y = smooth * y + (1 - smooth) * x
+    median: despike by taking the median of the last `median` readings (1: no despiking)
+    scale: a tuple (y0, y1), the range the output (0-1) is mapped to, or None
+    calibrationfile: where the calibration ranges are loaded from and saved to.
+                     Implies calibrate
+    usenumpy: True to use numpy (if available), False to use arrays, None to
+              decide depending on the number of pins (see NUMPY_MINPINS)
+
+    A pipeline holds the settings. Use start to bind it to the pins of a board,
+    and copy to get a new pipeline with the same settings for another board.
+    process expects a value for every pin
+    """
+    def __init__(self, calibrate=False, smooth=0, median=1, scale=None, calibrationfile=None, usenumpy=None):
+        self.calibrate = calibrate or calibrationfile is not None
+        self.smooth = smooth
+        self.median = max(1, int(median))
+        self.scale = scale
+        self.calibrationfile = calibrationfile
+        self.usenumpy = usenumpy
+        self.pins = None
+        self.name = None
+    def copy(self):
+        return AnalogPipeline(self.calibrate, self.smooth, self.median, self.scale, self.calibrationfile, self.usenumpy)
+    def start(self, pins, name=None):
+        """
+        pins: the analog pins, in the order their values will be given to process
+        name: the name of the board, used as key in the calibration file
+        """
+        self.pins = list(pins)
+        self.name = name
+        n = len(self.pins)
+        usenumpy = self.usenumpy if self.usenumpy is not None else n >= NUMPY_MINPINS
+        if usenumpy and NUMPY:
+            self.mins = numpy.ones(n)
+            self.maxs = numpy.zeros(n) + 1e-12
+            self.process = self._process_numpy
+        else:
+            self.mins = array('d', [1] * n)
+            self.maxs = array('d', [1e-12] * n)
+            self.process = self._process_array
+        # history and smoothing state are initialized with the first reading
+        self.history = None
+        self.state = None
+        self._historyidx = 0
+        if self.calibrationfile is not None:
+            self.load(self.calibrationfile)
+        return self
+    def _process_numpy(self, values):
+        x = numpy.array(values, dtype=float)
+        if self.median > 1:
+            if self.history is None:
+                self.history = numpy.tile(x, (self.median, 1))
+            self.history[self._historyidx] = x
+            self._historyidx = (self._historyidx + 1) % self.median
+            x = numpy.median(self.history, axis=0)
+        if self.calibrate:
+            numpy.minimum(self.mins, x, self.mins)
+            numpy.maximum(self.maxs, x, self.maxs)
+            span = self.maxs - self.mins
+            x = numpy.where(span > 0, (x - self.mins) / numpy.where(span > 0, span, 1), 0)
+        if self.smooth:
+            if self.state is not None:
+                x = self.smooth * self.state + (1 - self.smooth) * x
+            self.state = x
+        if self.scale is not None:
+            y0, y1 = self.scale
+            x = x * (y1 - y0) + y0
+        return x
+    def _process_array(self, values):
+        n = len(values)
+        x = array('d', values)
+        if self.median > 1:
+            if self.history is None:
+                self.history = [array('d', x) for i in range(self.median)]
+            self.history[self._historyidx] = array('d', x)
+            self._historyidx = (self._historyidx + 1) % self.median
+            mid = self.median // 2
+            odd = self.median % 2
+            for i in range(n):
+                column = sorted(h[i] for h in self.history)
+                x[i] = column[mid] if odd else (column[mid-1] + column[mid]) * 0.5
+        if self.calibrate:
+            mins, maxs = self.mins, self.maxs
+            for i in range(n):
+                v = x[i]
+                if v < mins[i]:
+                    mins[i] = v
+                if v > maxs[i]:
+                    maxs[i] = v
+                span = maxs[i] - mins[i]
+                x[i] = (v - mins[i]) / span if span > 0 else 0
+        if self.smooth:
+            smooth = self.smooth
+            state = self.state
+            if state is not None:
+                for i in range(n):
+                    x[i] = smooth * state[i] + (1 - smooth) * x[i]
+            self.state = array('d', x)
+        if self.scale is not None:
+            y0, y1 = self.scale
+            for i in range(n):
+                x[i] = x[i] * (y1 - y0) + y0
+        return x
+    def ranges(self):
+        """{pin: (min, max)} of the pins which were calibrated"""
+        out = {}
+        for i, pin in enumerate(self.pins):
+            if self.maxs[i] >= self.mins[i]:
+                out[pin] = (float(self.mins[i]), float(self.maxs[i]))
+        return out
+    def load(self, path):
+        """load the calibration ranges for this board from path, if it exists"""
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            data = json.load(f)
+        ranges = data.get(self.name or "default", {})
+        for i, pin in enumerate(self.pins):
+            minmax = ranges.get(str(pin))
+            if minmax is not None:
+                self.mins[i], self.maxs[i] = minmax
+    def save(self, path):
+        """save the calibration ranges of this board to path, keeping those of other boards"""
+        data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+        data[self.name or "default"] = dict((str(pin), minmax) for pin, minmax in self.ranges().items())
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    def close(self):
+        if self.calibrate and self.calibrationfile is not None and self.pins is not None:
+            self.save(self.calibrationfile)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Benchmark: firmatasend.py end to end, without hardware
+
+    $ python bench_firmata.py [--rate 100] [--analog 6] [--wait 20] [--duration 5]
+
+A fake board (fakefirmata.py, on a pseudo terminal) streams reports, which
+firmatasend reads and sends on, in the sync path of receive_boards:
+
+  * receive              a callback which only counts
+  * sendosc --bundle     to a local OSC sink
+  * sendosc --relay      idem, through OSCRelay
+  * sendosc (liblo)      idem, one liblo.send per pin. Only if liblo is installed
+  * sendmidi             to a stub MidiOut
+  * send_osc_and_midi    both
+
+For each: samples/s delivered, the CPU used by firmatasend (the board and the
+OSC sink run in another process) and the latency from the moment the board
+writes a report to the moment its value arrives. Analog pin 0 of the board
+carries a sequence number (0-127), which identifies the report a value comes from.
+
+The board needs no time to reset, pyfirmata is told not to wait 5 seconds
+for it. Each case still takes a moment to open the board.
+"""
+import os
+import sys
+import time
+import select
+import signal
+import bisect
+import optparse
+import multiprocessing
+from cStringIO import StringIO
+
+import osccodec
+from osccodec import monotonic
+import fakefirmata
+
+# firmatasend prints what it is missing when imported
+_stdout, sys.stdout = sys.stdout, StringIO()
+try:
+    import firmatasend
+finally:
+    sys.stdout = _stdout
+
+import pyfirmata.pyfirmata
+pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0.2
+
+SINK_PORT = 47130
+SEQ = 128
+
+def seq2value(seq):
+    """the raw analog value (0-1023) which reads as seq/127, and as CC seq"""
+    return int(round(seq * 1023 / 127.))
+
+def value2seq(value):
+    """value: an analog value, normalized to 0-1"""
+    return int(round(value * 127))
+
+class SequencedBoard(fakefirmata.FakeFirmata):
+    """a fake board whose analog pin 0 counts its reports (modulo SEQ)"""
+    def __init__(self, *args, **kws):
+        fakefirmata.FakeFirmata.__init__(self, *args, **kws)
+        self.sent = []
+    def frame(self, t):
+        seq = len(self.sent) % SEQ
+        data = fakefirmata.FakeFirmata.frame(self, t)
+        data = fakefirmata.analog_message(0, seq2value(seq)) + data[3:]
+        self.sent.append(monotonic())
+        return data
+
+def harness(conn, rate, analog, digitalports, port):
+    """
+    the other process: runs the fake board and an OSC sink until told to stop.
+    Sends back the time of each report and the (seq, time) of each value of
+    pin 0 received, plus the number of messages received
+    """
+    board = SequencedBoard(analog, digitalports, rate).start()
+    sock = osccodec.udpsocket(port)
+    receiver = osccodec.BatchReceiver(sock)
+    conn.send(board.port)
+    received = []
+    messages = 0
+    a0 = '/firmata/a0'
+    while not conn.poll():
+        ready, _, _ = select.select([sock], [], [], 0.05)
+        if not ready:
+            continue
+        while receiver.recv_batch():
+            now = monotonic()
+            for path, args in receiver.decode_batch():
+                messages += 1
+                if path == a0:
+                    received.append((value2seq(args[0]), now))
+    board.stop()
+    conn.send((board.sent, received, messages))
+    board.close()
+    sock.close()
+
+class StubMidiOut(object):
+    """stands for rtmidi.MidiOut, records the CCs of analog pin 0"""
+    ports = []
+    cc_a0 = 100
+    instance = None
+    def __init__(self):
+        self.received = []
+        self.messages = 0
+        StubMidiOut.instance = self
+    def open_port(self, port):
+        pass
+    def open_virtual_port(self, name):
+        pass
+    def send_cc(self, channel, cc, value):
+        self.messages += 1
+        if cc == self.cc_a0:
+            self.received.append((value, monotonic()))
+
+class stub_rtmidi(object):
+    MidiOut = StubMidiOut
+
+firmatasend.rtmidi = stub_rtmidi
+firmatasend.MIDIAVAILABLE = True
+
+def latencies(sent, received):
+    """match each received (seq, time) with the last report of that seq sent before it"""
+    byseq = [[] for i in range(SEQ)]
+    for i, t in enumerate(sent):
+        byseq[i % SEQ].append(t)
+    out = []
+    for seq, t in received:
+        times = byseq[seq % SEQ]
+        i = bisect.bisect(times, t)
+        if i:
+            out.append(t - times[i - 1])
+    return sorted(out)
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+class Measure(object):
+    """wraps firmatasend.run_ticks: measures the CPU and wall time of the loop and stops it after duration"""
+    def __init__(self, duration):
+        self.duration = duration
+        self.cpu = self.wall = 0
+    def __enter__(self):
+        original = self.original = firmatasend.run_ticks
+        def run_ticks(readers, wait, ontick, stop=None):
+            cpu0, wall0 = sum(os.times()[:2]), time.time()
+            signal.setitimer(signal.ITIMER_REAL, self.duration)
+            try:
+                original(readers, wait, ontick, stop)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                self.cpu = sum(os.times()[:2]) - cpu0
+                self.wall = time.time() - wall0
+        firmatasend.run_ticks = run_ticks
+        signal.signal(signal.SIGALRM, self._stop)
+        return self
+    def _stop(self, signum, frame):
+        # receive_boards stops and cleans up on CTRL-C
+        raise KeyboardInterrupt
+    def __exit__(self, *args):
+        firmatasend.run_ticks = self.original
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+def run_case(name, func, options):
+    """
+    func: a function (device, analog_pins, digital_pins, wait) which runs firmatasend,
+          returns the (seq, time) of the values of pin 0 it delivered itself, if any
+    """
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=harness, args=(child, options.rate, options.analog, 1, SINK_PORT))
+    process.start()
+    device = conn.recv()
+    StubMidiOut.instance = None
+    analog_pins, digital_pins = range(options.analog), range(2, 8)
+    _stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        with Measure(options.duration) as measure:
+            local = func(device, analog_pins, digital_pins, options.wait)
+    finally:
+        sys.stdout = _stdout
+    conn.send('stop')
+    sent, received, messages = conn.recv()
+    process.join()
+    midi = StubMidiOut.instance
+    if local is not None:
+        received, messages = local
+    elif midi is not None and not received:
+        received, messages = midi.received, midi.messages
+    lat = latencies(sent, received)
+    wall = max(measure.wall, 1e-9)
+    print "%-24s %9.0f samples/s  cpu %5.1f%%  latency ms: p50 %6.2f  p90 %6.2f  p99 %6.2f  max %6.2f" % (
+        name, messages / wall, measure.cpu / wall * 100,
+        percentile(lat, 0.5) * 1000, percentile(lat, 0.9) * 1000, percentile(lat, 0.99) * 1000,
+        lat[-1] * 1000 if lat else float('nan'))
+
+def case_receive(device, analog_pins, digital_pins, wait):
+    received = []
+    count = [0]
+    def callback(pintype, pinnumber, value):
+        count[0] += 1
+        if pintype == 'A' and pinnumber == 0:
+            received.append((value2seq(value), monotonic()))
+    firmatasend.receive(callback, analog_pins, digital_pins, wait, device=device)
+    return received, count[0]
+
+def case_sendosc(**kws):
+    def run(device, analog_pins, digital_pins, wait):
+        firmatasend.sendosc('127.0.0.1:%d' % SINK_PORT, analog_pins, digital_pins, wait, device=device, **kws)
+    return run
+
+def case_sendmidi(device, analog_pins, digital_pins, wait):
+    firmatasend.sendmidi('BENCH', analog_pins=analog_pins, digital_pins=digital_pins, wait=wait, device=device)
+
+def case_osc_and_midi(device, analog_pins, digital_pins, wait):
+    firmatasend.send_osc_and_midi('127.0.0.1:%d' % SINK_PORT, 'BENCH', analog_pins=analog_pins, digital_pins=digital_pins,
+                                  wait=wait, bundle=True, device=device)
+
+CASES = [
+    ("receive",           case_receive),
+    ("sendosc --bundle",  case_sendosc(bundle=True)),
+    ("sendosc --relay",   case_sendosc(relay=True)),
+    ("sendosc (liblo)",   case_sendosc()),
+    ("sendmidi (stub)",   case_sendmidi),
+    ("send_osc_and_midi", case_osc_and_midi)
+]
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--rate", type="float", default=100, help="reports per second of the fake board (default: 100)")
+    parser.add_option("-a", "--analog", type="int", default=6, help="number of analog pins (default: 6)")
+    parser.add_option("-w", "--wait", type="int", default=20, help="firmatasend --wait, in ms (default: 20)")
+    parser.add_option("-d", "--duration", type="float", default=5, help="seconds per case (default: 5)")
+    parser.add_option("-c", "--case", action="append", help="run only this case (a prefix of its name). Can be given several times")
+    options, args = parser.parse_args()
+    print "board: %g reports/s, %d analog pins, 6 digital pins. --wait %d ms, %g s per case\n" % (
+        options.rate, options.analog, options.wait, options.duration)
+    for name, func in CASES:
+        if options.case and not any(name.startswith(case) for case in options.case):
+            continue
+        if name == "sendosc (liblo)" and firmatasend.liblo is None:
+            print "%-24s liblo not found, skipped" % name
+            continue
+        run_case(name, func, options)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Microbenchmark: osccodec vs liblo
+
+    $ python bench_osccodec.py [numpackets]
+
+Measures
+  * encoding: Encoder / encode vs liblo.Message
+  * decoding: osccodec.decode on already received packets
+  * receiving: N packets over loopback, with BatchReceiver vs liblo.Server.recv
+
+liblo is optional. If it is not installed, only osccodec is measured
+"""
+import sys
+import time
+import osccodec
+
+try:
+    import liblo
+except ImportError:
+    liblo = None
+
+PORT = 47120
+
+def timeit(func, n):
+    t0 = time.time()
+    func(n)
+    return time.time() - t0
+
+def report(name, n, dur):
+    print "%-40s %9.0f msgs/s  %6.2f us/msg" % (name, n / dur, dur / n * 1e6)
+
+def bench_encode(n):
+    enc_a0 = osccodec.Encoder('/firmata/a0', 'f')
+    enc_print = osccodec.Encoder('/print', 'sssii')
+    def encoder_fixed(n):
+        for i in xrange(n):
+            enc_a0(0.5)
+    def encoder_strings(n):
+        for i in xrange(n):
+            enc_print('MIDI/src', 'CC    ', 'x', 1, 64)
+    def encode_generic(n):
+        encode = osccodec.encode
+        for i in xrange(n):
+            encode('/firmata/a0', 0.5)
+    report("encode   Encoder('/firmata/a0', 'f')", n, timeit(encoder_fixed, n))
+    report("encode   Encoder('/print', 'sssii')", n, timeit(encoder_strings, n))
+    report("encode   osccodec.encode", n, timeit(encode_generic, n))
+    if liblo is not None:
+        def liblo_message(n):
+            Message = liblo.Message
+            for i in xrange(n):
+                Message('/firmata/a0', 0.5)
+        report("encode   liblo.Message", n, timeit(liblo_message, n))
+
+def bench_decode(n):
+    fixed = osccodec.Encoder('/firmata/a0', 'f')(0.5)
+    strings = osccodec.Encoder('/print', 'sssii')('MIDI/src', 'CC    ', 'x', 1, 64)
+    bundle = osccodec.encode_bundle([fixed] * 20, time.time())
+    decode = osccodec.decode
+    def decode_fixed(n):
+        for i in xrange(n):
+            decode(fixed)
+    def decode_strings(n):
+        for i in xrange(n):
+            decode(strings)
+    def decode_bundle(n):
+        for i in xrange(n // 20):
+            decode(bundle)
+    report("decode   /firmata/a0 f", n, timeit(decode_fixed, n))
+    report("decode   /print sssii", n, timeit(decode_strings, n))
+    report("decode   bundle of 20 x /firmata/a0 f", n, timeit(decode_bundle, n))
+
+def bench_receive(n, batch=64):
+    """
+    send packets in bursts of `batch` and receive them. Measures the
+    receiving side only
+    """
+    packet = osccodec.Encoder('/firmata/a0', 'f')(0.5)
+    out = osccodec.udpsocket()
+    dest = ('127.0.0.1', PORT)
+
+    sock = osccodec.udpsocket(PORT)
+    receiver = osccodec.BatchReceiver(sock, batchsize=batch)
+    received = 0
+    dur = 0
+    for burst in xrange(n // batch):
+        for i in xrange(batch):
+            out.sendto(packet, dest)
+        t0 = time.time()
+        got = receiver.recv_batch()
+        receiver.decode_batch()
+        dur += time.time() - t0
+        received += got
+    sock.close()
+    report("receive  BatchReceiver (batch=%d)" % batch, received, dur)
+
+    if liblo is not None:
+        server = liblo.Server(PORT + 1)
+        server.add_method(None, None, lambda path, args: None)
+        dest = ('127.0.0.1', PORT + 1)
+        received = 0
+        dur = 0
+        for burst in xrange(n // batch):
+            for i in xrange(batch):
+                out.sendto(packet, dest)
+            t0 = time.time()
+            while server.recv(0):
+                received += 1
+            dur += time.time() - t0
+        server.free()
+        report("receive  liblo.Server.recv", received, dur)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if liblo is None:
+        print "liblo not found, only osccodec is measured\n"
+    bench_encode(n)
+    print
+    bench_decode(n)
+    print
+    bench_receive(min(n, 20000))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Microbenchmark: the cost of an update in oscprint, without a terminal
+
+    $ python bench_oscprint.py [numupdates] [--rows 50] [--cols 160] [--only NAME]
+
+Measures
+  * startup: the time to import oscprint in a new interpreter, and the modules
+    it pulls in. Importing must have no side effects: no screen, no socket,
+    no peach
+  * update: Handler.handle / printasfader / printasvu on an existing label,
+    with and without a transform
+  * render: formatting a line whose value changed, and one whose value did not
+    (cached), and tostr
+  * frame: updating a set of labels and redrawing them, per update
+  * workload: synthetic traffic (many labels, one label at a high rate, a mix
+    of faders and VUs, new labels arriving), with autosort on and off. For
+    each: updates/s, screen calls and bytes written per frame and the memory
+    left allocated
+
+The screen is replaced by a stub which only counts the calls. Memory is the
+net growth over the run, not an allocation rate: what is allocated and freed
+again does not show. It is measured with tracemalloc where it exists (python 3,
+memory blocks retained), otherwise by the growth of the objects tracked by the
+garbage collector (objects retained)
+"""
+import os
+import sys
+import gc
+import time
+import optparse
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import oscprint
+
+class StubScreen(object):
+    def __init__(self, rows=50, cols=160):
+        self.rows, self.cols = rows, cols
+        self.calls = 0
+    def getmaxyx(self):
+        return self.rows, self.cols
+    def move(self, y, x):
+        self.calls += 1
+    def clrtoeol(self):
+        self.calls += 1
+    def addstr(self, y, x, s, attr=0):
+        self.calls += 1
+    def clear(self):
+        pass
+    erase = clear
+    def refresh(self):
+        pass
+
+def timeit(func, n):
+    t0 = time.time()
+    func(n)
+    return time.time() - t0
+
+def report(name, n, dur):
+    print "%-40s %9.0f updates/s  %6.2f us/update" % (name, n / dur, dur / n * 1e6)
+
+ROWS, COLS = 50, 160
+
+def make_handler(rows=None, cols=None, autosort=True):
+    rows, cols = rows or ROWS, cols or COLS
+    oscprint.screen = StubScreen(rows, cols)
+    oscprint.screeny, oscprint.screenx = rows, cols
+    oscprint.curses.color_pair = lambda n: 0
+    return oscprint.Handler(autosort=autosort, historysize=0)
+
+def allocations(func, n):
+    """
+    run func(n) and return (net blocks or objects retained per 1000 calls, peak KB or None)
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        func(n)
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1] / 1024.
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        return blocks * 1000. / n, peak
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        func(n)
+        objects = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    return objects * 1000. / n, None
+
+IMPORT_SCRIPT = """
+import sys, time
+before = set(sys.modules)
+t0 = time.time()
+import oscprint
+dur = time.time() - t0
+new = [m for m in set(sys.modules) - before if sys.modules[m] is not None]
+print dur, len(new), ' '.join(sorted(m for m in new if m.split('.')[0] in ('peach', 'liblo', 'numpy')))
+"""
+
+def bench_startup(runs=10):
+    """
+    import oscprint in a fresh interpreter `runs` times. Python 2 has no
+    -X importtime, the import is timed from inside the interpreter
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([here] + sys.path))
+    durs = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], env=env, cwd=here)
+        fields = out.split(None, 2)
+        durs.append(float(fields[0]))
+        nummodules = int(fields[1])
+        heavy = fields[2].strip() if len(fields) > 2 else ""
+    durs.sort()
+    print "%-40s %9.1f ms (median of %d)  %d modules" % ("startup  import oscprint", durs[len(durs) // 2] * 1000, runs, nummodules)
+    if heavy:
+        print "         WARNING: importing oscprint loads %s" % heavy
+
+def bench_update(n):
+    h = make_handler()
+    h.handle('line', [0.])
+    h.printasfader('fader', 0.)
+    h.printasvu('vu', 0.5)
+    h.handle('note', [60])
+    h.lineconfig_transform('note', 'amp2db')
+    def update_line(n):
+        handle = h.handle
+        for i in xrange(n):
+            handle('line', [i * 0.001])
+    def update_fader(n):
+        printasfader = h.printasfader
+        for i in xrange(n):
+            printasfader('fader', (i % 1000) * 0.001)
+    def update_vu(n):
+        printasvu = h.printasvu
+        for i in xrange(n):
+            printasvu('vu', (i % 1000) * 0.001 + 0.001)
+    def update_transform(n):
+        handle = h.handle
+        for i in xrange(n):
+            handle('note', [i % 128])
+    report("update   Line", n, timeit(update_line, n))
+    report("update   LineFader", n, timeit(update_fader, n))
+    report("update   VuFader (amp2db)", n, timeit(update_vu, n))
+    report("update   Line + transform amp2db", n, timeit(update_transform, n))
+
+def bench_render(n):
+    h = make_handler()
+    h.handle('line', [0.])
+    h.printasfader('fader', 0.)
+    line, fader = h.lines['line'], h.lines['fader']
+    width = 157
+    def render_changed(line, values):
+        def run(n):
+            for i in xrange(n):
+                line.value = values[i % len(values)]
+                line.render(width)
+        return run
+    def render_cached(line):
+        def run(n):
+            render = line.render
+            for i in xrange(n):
+                render(width)
+        return run
+    values = [i * 0.0123 for i in range(100)]
+    report("render   Line, value changed", n, timeit(render_changed(line, values), n))
+    report("render   Line, cached", n, timeit(render_cached(line), n))
+    report("render   LineFader, value changed", n, timeit(render_changed(fader, values), n))
+    report("render   LineFader, cached", n, timeit(render_cached(fader), n))
+    def format_numbers(n):
+        tostr = oscprint.tostr
+        for i in xrange(n):
+            tostr(values[i % len(values)])
+    report("render   tostr", n, timeit(format_numbers, n))
+
+def bench_frame(n, numlabels=40):
+    """update numlabels labels, then redraw. The cost is given per update"""
+    h = make_handler()
+    labels = ['label%d' % i for i in range(numlabels)]
+    for label in labels:
+        h.handle(label, [0.])
+    h.refresh(force=True)
+    def frames(n):
+        handle, refresh = h.handle, h.refresh
+        for frame in xrange(n // numlabels):
+            for label in labels:
+                handle(label, [frame * 0.01])
+            refresh()
+    report("frame    %d labels, update + draw" % numlabels, n, timeit(frames, n))
+
+class Workload(object):
+    """
+    labels: the labels updated, round robin
+    kinds: the kind of each label: line, fader, vu or percent (cycled)
+    perframe: updates between two refreshes
+    fresh: if True, every update is to a new label (the labels arrive)
+    """
+    SETTERS = {
+        'line':    lambda h: lambda label, v: h.handle(label, [v]),
+        'fader':   lambda h: h.printasfader,
+        'vu':      lambda h: lambda label, v: h.printasvu(label, v + 0.001),
+        'percent': lambda h: h.printaspercent
+    }
+    def __init__(self, name, numlabels, kinds=('line',), perframe=100, fresh=False):
+        self.name = name
+        self.numlabels = numlabels
+        self.kinds = kinds
+        self.perframe = perframe
+        self.fresh = fresh
+    def setup(self, autosort):
+        h = make_handler(autosort=autosort)
+        setters = [self.SETTERS[kind](h) for kind in self.kinds]
+        labels = ['%s%d' % (self.kinds[i % len(self.kinds)], i) for i in range(self.numlabels)]
+        calls = [(labels[i], setters[i % len(setters)]) for i in range(self.numlabels)]
+        if not self.fresh:
+            for label, setter in calls:
+                setter(label, 0.5)
+            h.refresh(force=True)
+        return h, calls
+    def run(self, autosort, n):
+        """returns (duration, screen calls per frame, bytes per frame, the update function)"""
+        h, calls = self.setup(autosort)
+        screen = oscprint.screen
+        perframe, numcalls = self.perframe, len(calls)
+        state = {'frames': 0, 'calls': 0, 'serial': 0, 'bytes': 0}
+        def updates(n):
+            refresh = h.refresh
+            fresh = self.fresh
+            serial = state['serial']
+            for frame in xrange(n // perframe):
+                for i in xrange(frame * perframe, (frame + 1) * perframe):
+                    if fresh:
+                        serial += 1
+                        label, setter = calls[serial % numcalls]
+                        setter('%s.%d' % (label, serial), (i % 1009) * 0.001)
+                    else:
+                        label, setter = calls[i % numcalls]
+                        setter(label, (i % 1009) * 0.001)
+                screen.calls = 0
+                written = h.written
+                refresh()
+                state['calls'] += screen.calls
+                state['bytes'] += h.written - written
+                state['frames'] += 1
+            state['serial'] = serial
+        dur = timeit(updates, n)
+        frames = max(state['frames'], 1)
+        return dur, state['calls'] / float(frames), state['bytes'] / float(frames), updates
+
+WORKLOADS = [
+    Workload("many labels (2000)", 2000, perframe=1000),
+    Workload("one label, high rate", 1, perframe=1000),
+    Workload("faders + VUs (40)", 40, kinds=('fader', 'vu', 'line', 'percent'), perframe=100),
+    Workload("new labels arriving", 1000, perframe=100, fresh=True)
+]
+
+def bench_workloads(n, only=None):
+    if tracemalloc is None:
+        print "(tracemalloc not available: memory is given as net objects retained, tracked by the gc)"
+    for workload in WORKLOADS:
+        if only and only not in workload.name:
+            continue
+        for autosort in (True, False):
+            n_w = n if not workload.fresh else n // 10
+            dur, callsperframe, bytesperframe, updates = workload.run(autosort, n_w)
+            blocks, peak = allocations(updates, n_w // 10)
+            name = "workload %s, %s" % (workload.name, "sort" if autosort else "nosort")
+            mem = "net %s retained %+7.1f/1000" % ("blocks" if tracemalloc is not None else "objects", blocks)
+            if peak is not None:
+                mem += " peak %.0f KB" % peak
+            print "%-48s %9.0f updates/s  %6.1f calls/frame %7.0f bytes/frame  %s" % (name, n_w / dur, callsperframe, bytesperframe, mem)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [numupdates] [options]")
+    parser.add_option("--rows", type="int", default=ROWS, help="the size of the stub screen (default: %d)" % ROWS)
+    parser.add_option("--cols", type="int", default=COLS)
+    parser.add_option("--only", help="run only this group: startup, update, render, frame or workload")
+    parser.add_option("--workload", help="with --only workload, run only the workloads whose name contains this")
+    options, args = parser.parse_args()
+    n = int(args[0]) if args else 100000
+    ROWS, COLS = options.rows, options.cols
+    groups = [
+        ('startup',  bench_startup),
+        ('update',   lambda: bench_update(n)),
+        ('render',   lambda: bench_render(n)),
+        ('frame',    lambda: bench_frame(n)),
+        ('workload', lambda: bench_workloads(n, options.workload))
+    ]
+    first = True
+    for name, func in groups:
+        if options.only is not None and options.only != name:
+            continue
+        if not first:
+            print
+        first = False
+        func()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+A fake Arduino running StandardFirmata, on a pseudo terminal
+
+It streams analog and digital reports at a fixed rate, so that firmatasend.py
+can be run and measured without hardware:
+
+    $ python fakefirmata.py --rate 100 --analog 6
+    fake board at /dev/pts/5 (press CTRL-C to stop)
+
+    $ python firmatasend.py --device /dev/pts/5 --analog all --osc 57121
+
+Analog pins follow a slow sine (each pin with a different phase), digital
+pins toggle once per second. Commands sent to the board are read and discarded.
+"""
+import os
+import pty
+import tty
+import time
+import math
+import select
+import threading
+import optparse
+
+ANALOG_MESSAGE  = 0xE0
+DIGITAL_MESSAGE = 0x90
+
+def analog_message(pin, value):
+    """value: 0-1023"""
+    return chr(ANALOG_MESSAGE | pin) + chr(value & 0x7F) + chr((value >> 7) & 0x7F)
+
+def digital_message(port, mask):
+    """mask: the state of the 8 pins of the port, as bits"""
+    return chr(DIGITAL_MESSAGE | port) + chr(mask & 0x7F) + chr((mask >> 7) & 0x7F)
+
+def sine(pin, t):
+    return int(511.5 + 511.5 * math.sin(2 * math.pi * 0.2 * t + pin))
+
+class FakeFirmata(object):
+    """
+    analog: number of analog pins to report
+    digitalports: number of digital ports (8 pins each) to report
+    rate: reports per second, for each pin
+    waveform: a function (pin, time) -> value (0-1023) for the analog pins
+    """
+    def __init__(self, analog=6, digitalports=2, rate=100, waveform=sine):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.analog = analog
+        self.digitalports = digitalports
+        self.rate = rate
+        self.waveform = waveform
+        self.reports = 0
+        self.bytes_received = 0
+        self._running = False
+        self._thread = None
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+    def frame(self, t):
+        """the bytes sent in one report period, at time t"""
+        parts = [analog_message(pin, self.waveform(pin, t)) for pin in range(self.analog)]
+        mask = 0xFF if int(t) % 2 else 0
+        parts.extend(digital_message(port, mask) for port in range(self.digitalports))
+        return "".join(parts)
+    def _run(self):
+        master = self.master
+        period = 1.0 / self.rate
+        t0 = time.time()
+        nextframe = t0
+        while self._running:
+            timeout = nextframe - time.time()
+            if timeout > 0:
+                ready, _, _ = select.select([master], [], [], timeout)
+                if ready:
+                    self.bytes_received += len(os.read(master, 1024))
+                continue
+            os.write(master, self.frame(time.time() - t0))
+            self.reports += 1
+            nextframe += period
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--rate", type="float", default=100, help="reports per second (default: 100)")
+    parser.add_option("-a", "--analog", type="int", default=6, help="number of analog pins (default: 6)")
+    parser.add_option("-d", "--digitalports", type="int", default=2, help="number of digital ports, 8 pins each (default: 2)")
+    options, args = parser.parse_args()
+    board = FakeFirmata(options.analog, options.digitalports, options.rate)
+    print "fake board at %s (press CTRL-C to stop)" % board.port
+    board.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        board.stop()
+        print "\nsent %d reports" % board.reports
@@ -2,8 +2,18 @@
 # stdlib
 import glob
 import sys
+import os
 import time
 import optparse
+import socket
+import select
+import errno
+import threading
+import collections
+
+import osccodec
+from osccodec import monotonic
+from analogpipeline import AnalogPipeline
 
 OSC_SC    = 57121
 OSC_PRINT = 31415
@@ -51,6 +61,7 @@ try:
 	import liblo
 	from liblo import send
 except ImportError:
+	liblo = None
 	print """
 liblo was not found. This is a library to send OSC, and without it you will not be able
 to send OSC. 
@@ -92,14 +103,58 @@ gcc. If you are in OSX, you should have installed the Developer Tools
 	"""
 
 
-osc_analog_paths  = ["/firmata/a%d" % i for i in range(12)]
-osc_digital_paths = ["/firmata/d%d" % i for i in range(20)]
+def board_prefix(name=None):
+	"""the OSC namespace of a board: /firmata, or /firmata/<name> when there are many boards"""
+	return "/firmata" if name is None else "/firmata/%s" % name
+
+def osc_paths(prefix="/firmata"):
+	"""Returns (analog_paths, digital_paths), indexed by pin number"""
+	return ["%s/a%d" % (prefix, i) for i in range(12)], ["%s/d%d" % (prefix, i) for i in range(20)]
+
+def osc_encoders(prefix="/firmata"):
+	"""Returns (analog_encoders, digital_encoders), indexed by pin number"""
+	apaths, dpaths = osc_paths(prefix)
+	return [osccodec.Encoder(path, 'f') for path in apaths], [osccodec.Encoder(path, 'i') for path in dpaths]
+
+osc_analog_paths, osc_digital_paths = osc_paths()
+osc_analog_encoders, osc_digital_encoders = osc_encoders()
 
 def isiterable(obj):
 	return hasattr(obj, '__iter__') and not isinstance(obj, basestring)
 
+def parse_target(target):
+	"""
+	target: a port number, a string 'port' or 'host:port', or a tuple (host, port)
+	Returns (host, port)
+	"""
+	if isinstance(target, tuple):
+		host, port = target
+	elif isinstance(target, basestring) and ':' in target:
+		host, port = target.split(':')
+	else:
+		host, port = 'localhost', target
+	return host, int(port)
+
+def make_address(target):
+	"""
+	Returns a liblo.Address for target (see parse_target), to be created once
+	and reused for every send
+	"""
+	if liblo is None:
+		raise RuntimeError("liblo is not available. Use bundles (--bundle) to send OSC without liblo")
+	if isinstance(target, liblo.Address):
+		return target
+	host, port = parse_target(target)
+	return liblo.Address(host, port)
+
+DEVICE_PATTERN = "/dev/tty.usb*"
+
+def get_ports(pattern=DEVICE_PATTERN):
+	"""all the serial devices which look like a board"""
+	return sorted(glob.glob(pattern))
+
 def get_port():
-	devs = glob.glob("/dev/tty.usb*")
+	devs = get_ports()
 	if len(devs) == 0:
 		print "No arduino board found! Exiting."
 		sys.exit(0)
@@ -115,10 +170,176 @@ def get_port():
 		dev = devs[0]
 	return dev
 
-def get_arduino():
-	dev = get_port()
+def get_arduino(device=None):
+	"""
+	device: the serial device of the board, or None to look for it (see get_port)
+	"""
+	dev = device if device is not None else get_port()
 	print "\nusing port: %s" % dev
-	return pyfirmata.Arduino(dev)
+	board = pyfirmata.Arduino(dev)
+	# pyfirmata keeps the command handlers in a dict shared by all boards,
+	# bound to the last board created. Give each board its own
+	handlers = board._command_handlers
+	board._command_handlers = {}
+	for cmd, handler in handlers.items():
+		method = getattr(board, handler.__name__, None)
+		if method is not None:
+			board.add_cmd_handler(cmd, method)
+		else:
+			board._command_handlers[cmd] = handler
+	return board
+
+def board_name(device):
+	"""a short name for a board, derived from its device. /dev/tty.usbmodem1411 -> usbmodem1411"""
+	name = os.path.basename(device)
+	for prefix in ("tty.", "cu."):
+		if name.startswith(prefix):
+			name = name[len(prefix):]
+	return name
+
+def get_devices(device=None):
+	"""
+	device: None (look for one board), 'all' (every board found), a device,
+	        a comma separated string or a list of devices. A device can be given a
+	        name as name=device, otherwise it is named after the device (see board_name)
+
+	Returns a list of (name, device). With only one board, the name is None
+	"""
+	if device is None:
+		return [(None, None)]
+	if device == 'all':
+		devices = get_ports()
+		if not devices:
+			print "No arduino board found! Exiting."
+			sys.exit(0)
+	elif isiterable(device):
+		devices = list(device)
+	else:
+		devices = device.split(',')
+	if len(devices) == 1 and '=' not in devices[0]:
+		return [(None, devices[0])]
+	out = []
+	for dev in devices:
+		if '=' in dev:
+			name, dev = dev.split('=', 1)
+		else:
+			name = board_name(dev)
+		out.append((name, dev))
+	return out
+
+def open_boards(devices):
+	"""
+	devices: a list of (name, device), as returned by get_devices
+
+	Boards take a few seconds to start, so they are opened concurrently.
+	Returns a list of (name, board)
+	"""
+	if len(devices) == 1:
+		return [(devices[0][0], get_arduino(devices[0][1]))]
+	boards = [None] * len(devices)
+	def open_board(i, dev):
+		boards[i] = get_arduino(dev)
+	threads = [threading.Thread(target=open_board, args=(i, dev)) for i, (name, dev) in enumerate(devices)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if None in boards:
+		raise RuntimeError("could not open all the boards")
+	return [(name, board) for (name, dev), board in zip(devices, boards)]
+
+def cpu_report(cputime, walltime, numpins):
+	"""cputime, walltime: in seconds"""
+	if walltime <= 0:
+		return ""
+	percent = cputime / walltime * 100
+	perpin = percent / numpins if numpins else 0
+	return "cpu: %.1f%% of one core over %.1f s (%.2f%% per pin)" % (percent, walltime, perpin)
+
+START_SYSEX = 0xF0
+END_SYSEX   = 0xF7
+
+class FirmataReader(object):
+	"""
+	Parses the firmata stream of a board from whatever bytes are available
+
+	pyfirmata's Board.iterate reads the serial port byte by byte, so each
+	message costs several system calls. Here each call to read does one
+	os.read and parses all the complete messages in it; incomplete messages
+	are kept until the rest arrives. Messages are dispatched to the board's own
+	handlers, so the pins are updated exactly as with iterate.
+
+	Use it with select:
+
+	reader = FirmataReader(board)
+	while True:
+		select.select([reader], [], [])
+		reader.read()
+	"""
+	def __init__(self, board, bufsize=4096):
+		self.board = board
+		self.fd = board.sp.fileno()
+		self.handlers = board._command_handlers
+		self.bufsize = bufsize
+		self.pending = bytearray()
+		self.messages = 0
+	def fileno(self):
+		return self.fd
+	def read(self):
+		"""read the available bytes and handle the complete messages. Returns the number of messages handled"""
+		try:
+			data = os.read(self.fd, self.bufsize)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EINTR):
+				return 0
+			raise
+		buf = self.pending
+		buf.extend(data)
+		handlers = self.handlers
+		i, n = 0, len(buf)
+		handled = 0
+		while i < n:
+			byte = buf[i]
+			if byte == START_SYSEX:
+				end = buf.find('\xf7', i)
+				if end < 0:
+					break
+				handler = handlers.get(buf[i+1]) if end > i + 1 else None
+				args = buf[i+2:end]
+				i = end + 1
+			elif byte & 0x80:
+				if byte < START_SYSEX:
+					# channel messages: the low nibble is the first argument
+					handler = handlers.get(byte & 0xF0)
+					if handler is None:
+						i += 1
+						continue
+					needed = handler.bytes_needed - 1
+					args = [byte & 0x0F]
+				else:
+					handler = handlers.get(byte)
+					if handler is None:
+						i += 1
+						continue
+					needed = handler.bytes_needed
+					args = []
+				if i + 1 + needed > n:
+					break
+				args.extend(buf[i+1:i+1+needed])
+				i += 1 + needed
+			else:
+				# a data byte out of place, skip it
+				i += 1
+				continue
+			if handler is not None:
+				try:
+					handler(*args)
+				except ValueError:
+					pass
+				handled += 1
+		del buf[:i]
+		self.messages += handled
+		return handled
 
 def linlin(x, x0, x1, y0, y1):
 	return (x - x0) / (x1 - x0) * (y1 - y0) + y0
@@ -126,12 +347,205 @@ def linlin(x, x0, x1, y0, y1):
 def normalize(x, x0, x1):
 	return (x - x0) / (x1 - x0)
 	
-def receive(callback, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False, auto_calibrate=False):
+class SendPolicy(object):
+	"""
+	Decides, per pin, which values are worth sending
+
+	* values are only sent when they change
+	* analog values must move more than `deadband` away from the last value sent.
+	  If relative is True, deadband is a fraction of the last value sent
+	* if keepalive > 0, the current value is sent anyway if nothing was sent for
+	  this pin during the last `keepalive` ms, so receivers joining late get the state
+
+	The first value of each pin is always sent. Use wrap to apply the policy to a callback:
+
+	policy = SendPolicy(deadband=0.01, keepalive=1000)
+	callback = policy.wrap(sendosc_callback(57121))
+
+	policy.report() returns the number of messages sent and suppressed per pin
+	"""
+	def __init__(self, deadband=0, relative=False, keepalive=0):
+		self.deadband = deadband
+		self.relative = relative
+		self.keepalive = keepalive / 1000.
+		# (pintype, pinnumber) -> [lastvalue, lasttime, sent, suppressed]
+		self.pins = {}
+	def copy(self):
+		"""a new policy with the same settings and no state, for another board"""
+		return SendPolicy(self.deadband, self.relative, self.keepalive * 1000)
+	def accept(self, pintype, pinnumber, value, now=None):
+		"""returns True if value should be sent"""
+		state = self.pins.get((pintype, pinnumber))
+		if now is None:
+			now = time.time()
+		if state is None:
+			self.pins[(pintype, pinnumber)] = [value, now, 1, 0]
+			return True
+		last = state[0]
+		if value == last:
+			changed = False
+		elif pintype == 'A' and self.deadband:
+			band = self.deadband * abs(last) if self.relative else self.deadband
+			changed = abs(value - last) > band
+		else:
+			changed = True
+		if changed or (self.keepalive and now - state[1] >= self.keepalive):
+			state[0] = value
+			state[1] = now
+			state[2] += 1
+			return True
+		state[3] += 1
+		return False
+	def wrap(self, callback):
+		accept = self.accept
+		def filtered(pintype, pinnumber, value):
+			if accept(pintype, pinnumber, value):
+				callback(pintype, pinnumber, value)
+		flush = getattr(callback, 'flush', None)
+		if flush is not None:
+			filtered.flush = flush
+		return filtered
+	def report(self):
+		lines = ["pin    sent  suppressed"]
+		totalsent = totalsuppressed = 0
+		for (pintype, pinnumber), state in sorted(self.pins.items()):
+			sent, suppressed = state[2], state[3]
+			totalsent += sent
+			totalsuppressed += suppressed
+			lines.append("%s%-3d %7d %11d" % (pintype, pinnumber, sent, suppressed))
+		total = totalsent + totalsuppressed
+		lines.append("total %6d %11d  (%.1f%% suppressed)" % (totalsent, totalsuppressed, 100. * totalsuppressed / total if total else 0))
+		return "\n".join(lines)
+
+class LatestQueue(object):
+	"""
+	The handoff between the serial reader and the dispatcher in async mode
+
+	A bounded queue of snapshots: when the dispatcher falls behind and the queue
+	is full, the oldest snapshot is dropped, since a stale reading of the pins is
+	worth less than the newest one. The reader never blocks.
+
+	put_count -- snapshots queued
+	dropped   -- snapshots dropped because the queue was full
+	maxdepth  -- the highest number of snapshots waiting at any time
+	"""
+	def __init__(self, maxsize=4):
+		self.items = collections.deque()
+		self.maxsize = maxsize
+		self.cond = threading.Condition()
+		self.closed = False
+		self.put_count = 0
+		self.dropped = 0
+		self.maxdepth = 0
+	def put(self, item):
+		with self.cond:
+			items = self.items
+			if len(items) >= self.maxsize:
+				items.popleft()
+				self.dropped += 1
+			items.append(item)
+			self.put_count += 1
+			if len(items) > self.maxdepth:
+				self.maxdepth = len(items)
+			self.cond.notify()
+	def get(self):
+		"""wait for the next item. Returns None once the queue is closed and empty"""
+		with self.cond:
+			while not self.items and not self.closed:
+				self.cond.wait()
+			return self.items.popleft() if self.items else None
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+	def depth(self):
+		return len(self.items)
+	def report(self):
+		return "queue: %d snapshots, %d dropped, max. depth %d (of %d)" % (self.put_count, self.dropped, self.maxdepth, self.maxsize)
+
+def make_sampler(a, analog_pins, digital_pins, pipeline=None):
+	"""
+	Returns a function which reads the current value of the given pins of the board a,
+	as a list of (pintype, pinnumber, value). Pins which have no value yet are skipped
+
+	pipeline: an AnalogPipeline, already started for analog_pins, to process the
+	          analog values of each tick. The analog pins are only reported once
+	          all of them have a value
+	"""
+	apins = [a.analog[apin] for apin in analog_pins]
+	dpins = [a.digital[dpin] for dpin in digital_pins]
+	def sample():
+		out = []
+		values = [apin.read() for apin in apins]
+		if pipeline is None:
+			out.extend(('A', pin_number, value) for pin_number, value in zip(analog_pins, values) if value is not None)
+		elif None not in values:
+			out.extend(zip(['A'] * len(values), analog_pins, pipeline.process(values)))
+		for dpin in dpins:
+			value = dpin.read()
+			if value is not None:
+				out.append(('D', dpin.pin_number, 1 if value else 0))
+		return out
+	return sample
+
+def run_ticks(readers, wait, ontick, stop=None):
+	"""
+	Wait on the serial ports of readers (FirmataReaders), parsing the incoming data
+	as soon as it arrives, and call ontick() every `wait` seconds, following a
+	monotonic clock. Runs until stop (a threading.Event) is set, if given
+	"""
+	nexttick = monotonic() + wait
+	while stop is None or not stop.is_set():
+		timeout = nexttick - monotonic()
+		if timeout > 0:
+			ready, _, _ = select.select(readers, [], [], timeout)
+			for reader in ready:
+				reader.read()
+			continue
+		nexttick += wait
+		if nexttick < monotonic():
+			# we are late (a slow callback?). Don't try to catch up with
+			# a burst of ticks, restart the clock
+			nexttick = monotonic() + wait
+		ontick()
+
+def receive(callback, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False, auto_calibrate=False, policy=None, device=None, queuesize=4, pipeline=None):
 	"""
 	callback: a function expecting (pintype, pinnumber, value), where pintype is 'A' or 'D'
+	auto_calibrate: normalize each analog pin to the range seen so far. Same as
+	                pipeline=AnalogPipeline(calibrate=True)
+	policy: a SendPolicy, or None to call callback for every pin at every tick
+	pipeline: an AnalogPipeline to process the analog values of each tick (calibration,
+	          smoothing, despiking, scaling), or None
+	device: the serial device of the board, or None to look for it (see get_port)
+	queuesize: in async mode, how many snapshots can wait for the dispatcher
+	           before the oldest are dropped
+
+	The serial port is waited on with select: incoming bytes are parsed
+	as soon as they arrive (see FirmataReader) and the pins are sampled every `wait` ms,
+	following a monotonic clock. The process sleeps in between.
+
+	In sync mode the callback is called from the same loop. In async mode, a reader
+	thread parses the serial data and samples the pins, and a dispatcher thread calls
+	the callback, so that a slow network or midi port never delays the serial parsing.
+	See LatestQueue
+
+	To read many boards at once, see receive_boards
+	"""
+	receive_boards({None: callback}, [(None, device)], analog_pins, digital_pins, wait, async, echo, auto_calibrate, policy, queuesize, pipeline)
+
+def receive_boards(callbacks, devices, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False, auto_calibrate=False, policy=None, queuesize=4, pipeline=None):
+	"""
+	Like receive, for many boards at once: all the serial ports are waited on
+	in the same loop and all boards are sampled at the same tick.
+
+	callbacks: a dict {name: callback}, one callback for each board
+	devices: a list of (name, device) (see get_devices)
+
+	The same pins are read in every board. Callbacks sharing the same flush
+	(see OSCBundleSender.for_board) are flushed once per tick, so one bundle
+	holds the values of all boards
 	"""
-	a = get_arduino()
-	ANALOG_PINS = 6
 	if analog_pins == 'all':
 		analog_pins = range(6)
 	elif analog_pins is None:
@@ -140,89 +554,94 @@ def receive(callback, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=
 		digital_pins = range(14)
 	elif digital_pins is None:
 		digital_pins = []
-	# digital_pins = [p + ANALOG_PINS for p in digital_pins]
-	apaths = ["/firmata/a%d" % i for i in analog_pins]
-	dpaths = ["/firmata/d%d" % i for i in digital_pins]
-	amins = [1] * 20
-	amaxs = [1e-12] * 20
-
-	time_sleep = time.sleep
-	for apin in analog_pins:
-		a.analog[apin].enable_reporting()
-	for dpin in digital_pins:
-		pin = a.digital[dpin]
-		pin.mode = pyfirmata.INPUT
-		pin.enable_reporting()
+	policies = {}
+	if policy is not None:
+		for name, _ in devices:
+			policies[name] = policy if len(devices) == 1 else policy.copy()
+	if pipeline is None and auto_calibrate:
+		pipeline = AnalogPipeline(calibrate=True)
+	pipelines = []
+	boards = open_boards(devices)
+	samplers = []
+	readers = []
+	flushes = []
+	for name, a in boards:
+		for apin in analog_pins:
+			a.analog[apin].enable_reporting()
+		for dpin in digital_pins:
+			pin = a.digital[dpin]
+			pin.mode = pyfirmata.INPUT
+			pin.enable_reporting()
+		callback = callbacks[name]
+		if name in policies:
+			callback = policies[name].wrap(callback)
+		# callbacks which batch the values of a tick (see OSCBundleSender)
+		# are flushed once all pins of all boards have been read
+		flush = getattr(callback, 'flush', None)
+		if flush is not None and flush not in flushes:
+			flushes.append(flush)
+		echoprefix = "%s/" % name if name is not None else ""
+		boardpipeline = None
+		if pipeline is not None and analog_pins:
+			boardpipeline = (pipeline if len(boards) == 1 else pipeline.copy()).start(analog_pins, name)
+			pipelines.append(boardpipeline)
+		samplers.append((callback, echoprefix, make_sampler(a, analog_pins, digital_pins, boardpipeline)))
+		readers.append(FirmataReader(a))
+	def sample():
+		return [(callback, echoprefix, sampler()) for callback, echoprefix, sampler in samplers]
+	def dispatch(snapshot):
+		for callback, echoprefix, samples in snapshot:
+			for pintype, pinnumber, value in samples:
+				callback(pintype, pinnumber, value)
+				if echo:
+					print "%s%s%d: " % (echoprefix, pintype, pinnumber), value
+		for flush in flushes:
+			flush()
+	wait = wait/1000.
 	print "listening... (press CTRL-C to stop)"
-	lasttime = time.time()
+	cpu0, wall0 = sum(os.times()[:2]), time.time()
 	if async:
-		raise ValueError("async is buggy at the moment, use sync")
-		# use the iterator (creates another thread)
-		it = pyfirmata.util.Iterator(a)
-		it.start()
-		try:
+		queue = LatestQueue(queuesize)
+		stop = threading.Event()
+		def dispatcher():
 			while True:
-				for i, apin in enumerate(analog_pins):
-					value = a.analog[apin].read()
-					if value is not None:
-						if auto_calibrate:
-							if value < amins[apin]:
-								amins[apin] = value
-							elif value > amaxs[apin]:
-								amaxs[apin] = value
-							amin = amins[apin]
-
-							# value = linlin(value, amins[apin], amaxs[apin], 0, 1)
-							value = (value - amin) / (amaxs[apin] - amin)
-						callback('A', apin, value)
-						if echo: 
-							print "A%d: " % apin, value
-				for i, dpin in enumerate(digital_pins):
-					value = a.digital[dpin].read()
-					if value is not None:
-						value = 1 if str(value) == 'True' else 0
-						callback('D', dpin, value)
-						if echo: 
-							print "D%d: " % dpin, value
-				a.pass_time(wait)
+				snapshot = queue.get()
+				if snapshot is None:
+					break
+				dispatch(snapshot)
+		threads = [
+			threading.Thread(target=run_ticks, args=(readers, wait, lambda: queue.put(sample()), stop)),
+			threading.Thread(target=dispatcher)
+		]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		try:
+			while all(thread.is_alive() for thread in threads):
+				time.sleep(0.2)
 		except KeyboardInterrupt:
-			a.exit()
-	else:	
-		# sync: no iterator
-		wait = wait/1000.
+			pass
+		stop.set()
+		queue.close()
+		for thread in threads:
+			thread.join(1)
+		print queue.report()
+	else:
 		try:
-			a_iterate = a.iterate
-			apins = [a.analog[apin] for apin in analog_pins]
-			while True:
-				a_iterate()
-				t = time.time()
-				if t - lasttime > wait:
-					lasttime = t
-					for apin in apins:
-						value = apin.read()
-						pin_number = apin.pin_number
-						if value is not None:
-							if auto_calibrate:
-								if value < amins[pin_number]:
-									amins[pin_number] = value
-								elif value > amaxs[pin_number]:
-									amaxs[pin_number] = value
-								amin = amins[pin_number]
-								value = (value - amin) / (amaxs[pin_number] - amin)
-							callback('A', pin_number, value)
-							if echo: 
-								print "A%d: " % pin_number, value
-					for dpin in digital_pins:
-						value = a.digital[dpin].read()
-						if value is not None:
-							value = 1 if str(value) == 'True' else 0
-							callback('D', dpin, value)
-							if echo: 
-								print "D%d: " % dpin, value
+			run_ticks(readers, wait, lambda: dispatch(sample()))
 		except KeyboardInterrupt:
-			a.exit()
+			pass
+	for name, a in boards:
+		a.exit()
+	for boardpipeline in pipelines:
+		boardpipeline.close()
+	print cpu_report(sum(os.times()[:2]) - cpu0, time.time() - wall0, (len(analog_pins) + len(digital_pins)) * len(boards))
+	for name, policy in sorted(policies.items()):
+		if name is not None:
+			print "\n%s" % name
+		print policy.report()
 
-def sendosc_callback(target=OSC_SC, analog_pins=[0], digital_pins=range(5, 9)):
+def sendosc_callback(target=OSC_SC, analog_pins=[0], digital_pins=range(5, 9), prefix="/firmata"):
 	"""
 	returns a callback which sends data to the target. See 'receive'
 	NB: firmata reports the information normalized in the range 0-1
@@ -231,37 +650,300 @@ def sendosc_callback(target=OSC_SC, analog_pins=[0], digital_pins=range(5, 9)):
 	target: either a port number or a tuple (host, port)
 	analog_pins: a list of integers, 'all' or None
 	digital_pins: idem
-	wait: how long to wait between readings, in ms
+	prefix: the namespace of the paths (see board_prefix)
 
 	Example
 	-------
 
-	callback = sendosc_callback(57121)               # will send osc to port 57121 on the local maschine
-	callback = sendosc_callback('localhost', 31415)  # will send osc to port 31415 on the local maschine
-	callback = sendosc_callback('192.168.1.104', 57121) # will send osc to another maschine
+	callback = sendosc_callback(57121)                  # will send osc to port 57121 on the local maschine
+	callback = sendosc_callback('localhost:31415')      # will send osc to port 31415 on the local maschine
+	callback = sendosc_callback('192.168.1.104:57121')  # will send osc to another maschine
 	"""
+	address = make_address(target)
+	apaths, dpaths = osc_paths(prefix)
 	def callback(pintype, pinnumber, value):
-		path = osc_analog_paths[pinnumber] if pintype == 'A' else osc_digital_paths[pinnumber]
-		send(target, path, value)
+		path = apaths[pinnumber] if pintype == 'A' else dpaths[pinnumber]
+		send(address, path, value)
 	return callback
-def sendosc_many_callback(targets, analog_pins=[0], digital_pins=range(5, 9)):
+def sendosc_many_callback(targets, analog_pins=[0], digital_pins=range(5, 9), prefix="/firmata"):
 	"""
 	see sensosc_callback. this version can send to many targets at once
+
+	The targets are sent to one after the other, a slow target delays the
+	others. See OSCRelay
 	"""
+	addresses = [make_address(target) for target in targets]
+	apaths, dpaths = osc_paths(prefix)
 	def callback(pintype, pinnumber, value):
-		path = osc_analog_paths[pinnumber] if pintype == 'A' else osc_digital_paths[pinnumber]
-		for target in targets:
-			send(target, path, value)
+		path = apaths[pinnumber] if pintype == 'A' else dpaths[pinnumber]
+		for address in addresses:
+			send(address, path, value)
 	return callback
-def sendosc(target=57121, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False):
+
+class OSCBundleSender(object):
 	"""
-	target can be a list of targets
+	A callback which collects the values of all pins during one tick. When
+	flushed (receive does that at the end of each tick) they are sent as one
+	timestamped bundle to each target, so receivers get a consistent snapshot of
+	all pins with one packet instead of one packet per pin.
+
+	Messages are encoded with precompiled encoders and sent through one
+	socket to addresses resolved at creation time, liblo is not needed.
+
+	targets: a list of targets (see parse_target)
+
+	With many boards, use for_board to get a callback for each of them: all
+	their values go into the same bundle
+	"""
+	def __init__(self, targets):
+		if not isiterable(targets):
+			targets = [targets]
+		self.addresses = [(socket.gethostbyname(host), port) for host, port in map(parse_target, targets)]
+		self.sock = osccodec.udpsocket()
+		self.packets = []
+		self.bundles_sent = 0
+	def __call__(self, pintype, pinnumber, value):
+		if pintype == 'A':
+			self.packets.append(osc_analog_encoders[pinnumber](value))
+		else:
+			self.packets.append(osc_digital_encoders[pinnumber](value))
+	def for_board(self, prefix):
+		"""a callback sending the values of a board under the namespace prefix (see board_prefix)"""
+		aencoders, dencoders = osc_encoders(prefix)
+		packets_append = self.packets.append
+		def callback(pintype, pinnumber, value):
+			if pintype == 'A':
+				packets_append(aencoders[pinnumber](value))
+			else:
+				packets_append(dencoders[pinnumber](value))
+		callback.flush = self.flush
+		return callback
+	def flush(self):
+		if not self.packets:
+			return
+		bundle = osccodec.encode_bundle(self.packets, time.time())
+		sendto = self.sock.sendto
+		for address in self.addresses:
+			sendto(bundle, address)
+		del self.packets[:]
+		self.bundles_sent += 1
+
+def parse_relay_target(spec):
+	"""
+	spec: a target (see parse_target), optionally followed by its rate:
+	      '127.0.0.1:31415@10' --> at most 10 times per second
+	      '57121/4'            --> every 4th tick
+	Returns (target, rate, decimate)
+	"""
+	if isinstance(spec, basestring):
+		if '@' in spec:
+			spec, rate = spec.split('@')
+			return spec, float(rate), 1
+		if '/' in spec:
+			spec, decimate = spec.split('/')
+			return spec, 0, int(decimate)
+	return spec, 0, 1
+
+class RelayTarget(object):
+	"""
+	One target of an OSCRelay: its own socket and sending thread, and a
+	mailbox holding the latest packet of each path
+
+	The reader puts the values of each tick in the mailbox without ever waiting
+	for the network. When the target is due (every `decimate` ticks, at most
+	`rate` times per second), the sending thread is woken up and sends what the
+	mailbox holds. While a target waits for its turn, or while its thread is
+	stuck sending, newer values replace older ones, so the mailbox never grows
+	and the latest value of every pin is sent.
+
+	sent      -- packets sent
+	coalesced -- values replaced while the target was not due (decimation, rate)
+	dropped   -- values replaced while waiting to be sent (the target is too slow)
+	errors    -- failed sends
+	"""
+	def __init__(self, target, rate=0, decimate=1, bundle=False):
+		host, port = parse_target(target)
+		self.name = "%s:%d" % (host, port)
+		self.address = (socket.gethostbyname(host), port)
+		self.period = 1. / rate if rate > 0 else 0
+		self.decimate = max(int(decimate), 1)
+		self.bundle = bundle
+		self.sock = osccodec.udpsocket()
+		self.pending = {}
+		# the time the pending packets were handed to the thread, None if they were not
+		self.ready = None
+		self.cond = threading.Condition()
+		self.closed = False
+		self.ticks = 0
+		self.lastput = -1e9
+		self.sent = self.coalesced = self.dropped = self.errors = 0
+		self.sends = 0
+		self.latency_total = self.latency_max = 0.
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	def put(self, packets, now):
+		"""packets: a list of (path, packet), the values of one tick. now: monotonic time"""
+		self.ticks += 1
+		due = self.ticks % self.decimate == 0 and now - self.lastput >= self.period
+		with self.cond:
+			pending = self.pending
+			waiting = self.ready is not None
+			for path, packet in packets:
+				if path in pending:
+					if waiting:
+						self.dropped += 1
+					else:
+						self.coalesced += 1
+				pending[path] = packet
+			if due and pending:
+				self.lastput = now
+				if not waiting:
+					self.ready = now
+					self.cond.notify()
+	def run(self):
+		sendto, address = self.sock.sendto, self.address
+		while True:
+			with self.cond:
+				while self.ready is None and not self.closed:
+					self.cond.wait()
+				if self.ready is None:
+					return
+				ready, packets = self.ready, self.pending.values()
+				self.pending = {}
+				self.ready = None
+			try:
+				if self.bundle:
+					sendto(osccodec.encode_bundle(packets, time.time()), address)
+				else:
+					for packet in packets:
+						sendto(packet, address)
+				self.sent += len(packets)
+			except socket.error:
+				self.errors += 1
+			latency = monotonic() - ready
+			self.sends += 1
+			self.latency_total += latency
+			if latency > self.latency_max:
+				self.latency_max = latency
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify()
+		self.thread.join(1)
+		self.sock.close()
+	def report(self):
+		rate = "%gHz" % (1. / self.period) if self.period else "/%d" % self.decimate if self.decimate > 1 else "all"
+		latency = self.latency_total / self.sends * 1000 if self.sends else 0
+		return "%-22s %6s %9d %9d %7d %6d %8.2f %8.2f" % (self.name, rate, self.sent, self.coalesced, self.dropped, self.errors,
+			latency, self.latency_max * 1000)
+
+class OSCRelay(object):
+	"""
+	A callback which fans the values out to many targets, each one at its own
+	rate, so that oscprint can get 10 updates per second while SuperCollider
+	gets every tick. Each target has its own thread (see RelayTarget): a slow
+	or unreachable host never delays the serial reading or the other targets.
+
+	targets: a list of target specs (see parse_relay_target)
+	bundle: send what each target gets at once as one bundle
+
+	Like OSCBundleSender, the values are collected during a tick and handed
+	to the targets when flushed. Use for_board with many boards
+	"""
+	def __init__(self, targets, bundle=False):
+		if not isiterable(targets):
+			targets = [targets]
+		self.targets = [RelayTarget(target, rate, decimate, bundle) for target, rate, decimate in map(parse_relay_target, targets)]
+		self.packets = []
+	def __call__(self, pintype, pinnumber, value):
+		enc = osc_analog_encoders[pinnumber] if pintype == 'A' else osc_digital_encoders[pinnumber]
+		self.packets.append((enc.path, enc(value)))
+	def for_board(self, prefix):
+		"""a callback sending the values of a board under the namespace prefix (see board_prefix)"""
+		aencoders, dencoders = osc_encoders(prefix)
+		packets_append = self.packets.append
+		def callback(pintype, pinnumber, value):
+			enc = aencoders[pinnumber] if pintype == 'A' else dencoders[pinnumber]
+			packets_append((enc.path, enc(value)))
+		callback.flush = self.flush
+		return callback
+	def callbacks(self, names):
+		"""a callback for each board in names. Returns a dict {name: callback}"""
+		if names == [None]:
+			return {None: self}
+		return dict((name, self.for_board(board_prefix(name))) for name in names)
+	def flush(self):
+		# called at every tick, even without new values: a target holding
+		# values while it waited for its turn becomes due on a later tick
+		packets = self.packets
+		now = monotonic()
+		for target in self.targets:
+			target.put(packets, now)
+		del packets[:]
+	def close(self):
+		for target in self.targets:
+			target.close()
+	def report(self):
+		lines = ["target                   rate      sent coalesced dropped errors  lat. ms  max. ms"]
+		lines.extend(target.report() for target in self.targets)
+		return "\n".join(lines)
+
+def sendosc_callbacks(target, names=[None], bundle=False, relay=None):
+	"""
+	One OSC callback for each board in names, all sharing the same output:
+	the targets are resolved once and, with bundle, the values of all boards
+	are sent in one bundle per tick. Each board sends to its own namespace (see board_prefix)
+
+	relay: an OSCRelay, which then sends to its own targets instead of target
+
+	Returns a dict {name: callback}
 	"""
+	if relay is not None:
+		return relay.callbacks(names)
+	if bundle:
+		sender = OSCBundleSender(target)
+		if names == [None]:
+			return {None: sender}
+		return dict((name, sender.for_board(board_prefix(name))) for name in names)
 	if not isiterable(target):
-		callback = sendosc_callback(target=target, analog_pins=analog_pins, digital_pins=digital_pins)
+		address = make_address(target)
+		return dict((name, sendosc_callback(address, prefix=board_prefix(name))) for name in names)
+	addresses = [make_address(t) for t in target]
+	return dict((name, sendosc_many_callback(addresses, prefix=board_prefix(name))) for name in names)
+
+def sendosc(target=57121, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False, bundle=False, policy=None, device=None, pipeline=None, relay=False):
+	"""
+	target can be a list of targets
+
+	bundle: if True, the values of all pins read in one tick are sent together as one
+	        OSC bundle per target (see OSCBundleSender)
+	device: the board to read, or many of them (see get_devices). Each board sends
+	        to its own namespace: /firmata/<board>/a0
+	relay: if True, each target is sent to from its own thread, at its own rate
+	       (see OSCRelay and parse_relay_target)
+	"""
+	devices = get_devices(device)
+	relay = OSCRelay(target, bundle) if relay else None
+	callbacks = sendosc_callbacks(target, [name for name, dev in devices], bundle, relay)
+	receive_boards(callbacks, devices, analog_pins, digital_pins, wait, async, echo, policy=policy, pipeline=pipeline)
+	if relay is not None:
+		relay.close()
+		print relay.report()
+
+def open_midiout(port='FIRMATA'):
+	"""
+	open the given midi port. If it does not exist, a virtual port with that name is created
+	"""
+	if not MIDIAVAILABLE:
+		raise RuntimeError("midi is not available!")
+	o = rtmidi.MidiOut()
+	if port in o.ports:
+		o.open_port(port)
 	else:
-		callback = sendosc_many_callback(targets=target, analog_pins=analog_pins, digital_pins=digital_pins)
-	receive(callback, analog_pins, digital_pins, wait, async, echo)
+		print "'%s' is not an existing port. A virtual port will be created." % port
+		o.open_virtual_port(port)
+	return o
 
 def sendmidi_callback(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9), analogoffset=100, digitaloffset=30):
 	"""
@@ -272,15 +954,12 @@ def sendmidi_callback(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=r
 	D0 -> CC30
 	D1 -> CC31
 	...
+
+	port: the name of a midi port (see open_midiout) or an already open MidiOut
 	"""
 	if not MIDIAVAILABLE:
 		raise RuntimeError("midi is not available!")
-	o = rtmidi.MidiOut()
-	if port in o.ports:
-		o.open_port(port)
-	else:
-		print "'%s' is not an existing port. A virtual port will be created." % port
-		o.open_virtual_port(port)	
+	o = open_midiout(port) if isinstance(port, basestring) else port
 	def callback(pintype, pinnumber, value):
 		if pintype == 'A':
 			value = max(min(int(value * 127 + 0.5), 127), 0) # clip it to 0-127
@@ -288,7 +967,17 @@ def sendmidi_callback(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=r
 		else:
 			o.send_cc(channel, pinnumber + digitaloffset, value * 127)
 	return callback
-def sendmidi(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9), analogoffset=100, digitaloffset=30, wait=20, async=False, echo=False):
+def sendmidi_callbacks(port='FIRMATA', channel=7, names=[None], analogoffset=100, digitaloffset=30):
+	"""
+	One midi callback for each board in names, all sending through the same port.
+	Board number i sends on channel + i
+
+	Returns a dict {name: callback}
+	"""
+	o = open_midiout(port)
+	return dict((name, sendmidi_callback(o, channel + i, analogoffset=analogoffset, digitaloffset=digitaloffset))
+		for i, name in enumerate(names))
+def sendmidi(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9), analogoffset=100, digitaloffset=30, wait=20, async=False, echo=False, policy=None, device=None, pipeline=None):
 	"""
 	tries to connect to devicename to send the data. if device does not exists, 
 	creates a virtual device with the given device name and midi is sent to this device.
@@ -297,6 +986,8 @@ def sendmidi(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9
 	NB: do not ask for analog pins that are not connected, this will send spurious data down the line
 	and can tax the midi pipeline in your maschine too much
 
+	With many boards (see get_devices), each board sends on its own channel, starting at `channel`
+
 	Example
 	-------
 
@@ -305,16 +996,28 @@ def sendmidi(port='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9
 	"""
 	if not MIDIAVAILABLE:
 		raise RuntimeError("midi is not available!")
-	callback = sendmidi_callback(port, channel, analog_pins, digital_pins, analogoffset, digitaloffset)
-	receive(callback, analog_pins, digital_pins, wait, async, echo)	
+	devices = get_devices(device)
+	callbacks = sendmidi_callbacks(port, channel, [name for name, dev in devices], analogoffset, digitaloffset)
+	receive_boards(callbacks, devices, analog_pins, digital_pins, wait, async, echo, policy=policy, pipeline=pipeline)
 
-def send_osc_and_midi(osctarget=57121, midiport='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False):
-	osccallback = sendosc_callback(target=osctarget, analog_pins=analog_pins, digital_pins=digital_pins)
-	midicallback = sendmidi_callback(midiport, channel, analog_pins, digital_pins)
-	def callback(t, n, v):
-		osccallback(t, n, v)
-		midicallback(t, n, v)
-	receive(callback, analog_pins, digital_pins, wait, async, echo)		
+def send_osc_and_midi(osctarget=57121, midiport='FIRMATA', channel=7, analog_pins=[0], digital_pins=range(5, 9), wait=20, async=False, echo=False, bundle=False, policy=None, device=None, pipeline=None, relay=False):
+	devices = get_devices(device)
+	names = [name for name, dev in devices]
+	relay = OSCRelay(osctarget, bundle) if relay else None
+	osccallbacks = sendosc_callbacks(osctarget, names, bundle, relay)
+	midicallbacks = sendmidi_callbacks(midiport, channel, names)
+	def combine(osccallback, midicallback):
+		def callback(t, n, v):
+			osccallback(t, n, v)
+			midicallback(t, n, v)
+		if bundle or relay is not None:
+			callback.flush = osccallback.flush
+		return callback
+	callbacks = dict((name, combine(osccallbacks[name], midicallbacks[name])) for name in names)
+	receive_boards(callbacks, devices, analog_pins, digital_pins, wait, async, echo, policy=policy, pipeline=pipeline)
+	if relay is not None:
+		relay.close()
+		print relay.report()
 
 def get_midiports():
 	if MIDIAVAILABLE:
@@ -341,15 +1044,30 @@ if __name__ == '__main__':
 	parser.add_option("-m", "--midi", dest="midiport", help="send data via midi to the given existing or virtual port (a virtual port will be created if the given port does not exist). use `--midi select` to select from available ports or `--midi 0` to send to default port")
         parser.add_option("-a", "--analog", dest="analogpins", help="The analog pins to read. Either 'all' or a ':' delimited list of pins. Example: --analog 1:3:4", default=None)
 	parser.add_option("-d", "--digital", dest="digitalpins", help="see --analog")
-	parser.add_option("-w", "--wait", dest="wait", help="wait this amount of ms between each read", default=20)
-	parser.add_option("-c", "--midichannel", dest="midichannel", default=7)
+	parser.add_option("-s", "--device", dest="device", help="the serial device of the board. If not given, the board is looked for at /dev/tty.usb*. Many comma-separated devices can be given, or 'all' to read every board found. Each board sends to its own OSC namespace /firmata/<name>/, where name is derived from the device or given as name=device. Example: --device left=/dev/tty.usbmodem1411,right=/dev/tty.usbmodem1421")
+	parser.add_option("-w", "--wait", dest="wait", type="int", help="wait this amount of ms between each read", default=20)
+	parser.add_option("-c", "--midichannel", dest="midichannel", type="int", default=7)
 	parser.add_option("-e", "--echo", help="print the received data to stdout", nargs=0)
+	parser.add_option("--onchange", action="store_true", default=False, help="only send a pin when its value changes")
+	parser.add_option("--deadband", help="only send an analog pin when it moves more than this from the last value sent (implies --onchange). Use a %% sign for a relative deadband. Example: --deadband 0.01 or --deadband 5%%")
+	parser.add_option("--keepalive", type="int", default=0, help="with --onchange or --deadband, send a pin anyway if nothing was sent for it in this amount of ms")
+	parser.add_option("--calibrate", action="store_true", default=False, help="normalize each analog pin to the range seen so far")
+	parser.add_option("--calibration", help="a file to load the calibration ranges from at start and save them to at exit (implies --calibrate)")
+	parser.add_option("--smooth", type="float", default=0, help="smooth the analog pins. 0: no smoothing, 0.9: a lot of smoothing")
+	parser.add_option("--median", type="int", default=1, help="remove spikes from the analog pins, by taking the median of this number of readings")
+	parser.add_option("--scale", help="map the analog pins (0-1) to this range. Example: --scale 0:127. Only for OSC, midi expects values in the range 0-1")
+	parser.add_option("--async", action="store_true", default=False, help="read the serial port and send the data in separate threads, so that a slow target never delays the reading")
+	parser.add_option("-b", "--bundle", action="store_true", default=False, help="send the values of all pins read at each tick as one OSC bundle per target")
+	parser.add_option("-r", "--relay", action="store_true", default=False, help="send to each OSC target from its own thread, so that a slow target never delays the others. A target can be given its own rate, in Hz or as a decimation factor (implies --relay). Example: --osc 57121,localhost:31415@10 or --osc 57121,localhost:31415/5")
 	options, args = parser.parse_args()
 	osctarget = None
-	async = False
+	async = options.async
 	echo = options.echo is not None
+	relay = options.relay
 	if options.osctarget:
 		osctarget = options.osctarget.split(',')
+		if any('@' in target or '/' in target for target in osctarget):
+			relay = True
 		if len(osctarget) == 1:
 			osctarget = osctarget[0]
 	analogpins = options.analogpins
@@ -361,6 +1079,20 @@ if __name__ == '__main__':
 	if analogpins is None and digitalpins is None:
 		print "\nERROR: No pins selected to listen to. Use something like `--analog 0` to listen to the specified pin\n"
 		sys.exit(0)
+	policy = None
+	if options.onchange or options.deadband or options.keepalive:
+		deadband, relative = 0, False
+		if options.deadband:
+			if options.deadband.endswith('%'):
+				deadband, relative = float(options.deadband[:-1]) / 100., True
+			else:
+				deadband = float(options.deadband)
+		policy = SendPolicy(deadband=deadband, relative=relative, keepalive=options.keepalive)
+	pipeline = None
+	if options.calibrate or options.calibration or options.smooth or options.median > 1 or options.scale:
+		scale = map(float, options.scale.split(':')) if options.scale else None
+		pipeline = AnalogPipeline(calibrate=options.calibrate, smooth=options.smooth, median=options.median, 
+			scale=scale, calibrationfile=options.calibration)
 	if options.midiport is not None:
 		if options.midiport in (-1, 'select'):
 			midiport = select_midiport()
@@ -374,12 +1106,12 @@ if __name__ == '__main__':
 			midiport = options.midiport
 		if osctarget is not None:
 			send_osc_and_midi(osctarget=osctarget, midiport=midiport, channel=options.midichannel, 
-				analog_pins=analogpins, digital_pins=digitalpins, wait=options['wait'], async=async, echo=echo)
+				analog_pins=analogpins, digital_pins=digitalpins, wait=options.wait, async=async, echo=echo, bundle=options.bundle, policy=policy, device=options.device, pipeline=pipeline, relay=relay)
 		else:
 			sendmidi(midiport, channel=options.midichannel, 
-				analog_pins=analogpins, digital_pins=digitalpins, wait=options.wait, async=async, echo=echo)
+				analog_pins=analogpins, digital_pins=digitalpins, wait=options.wait, async=async, echo=echo, policy=policy, device=options.device, pipeline=pipeline)
 	elif osctarget:
-		sendosc(target=osctarget, analog_pins=analogpins, digital_pins=digitalpins, wait=options.wait, async=async, echo=echo)
+		sendosc(target=osctarget, analog_pins=analogpins, digital_pins=digitalpins, wait=options.wait, async=async, echo=echo, bundle=options.bundle, policy=policy, device=options.device, pipeline=pipeline, relay=relay)
 	else:
 		print "No target action was found (either --osc or --midi). Use something like --osc 57121"
 		sys.exit(0)
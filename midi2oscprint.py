@@ -1,30 +1,253 @@
 #!/usr/bin/env python
-import rtmidi2 as rtmidi
+"""
+Send all midi messages from all connected sources to oscprint, under the
+namespace MIDI: /print "MIDI/<source>" <type> channel value1 value2
+
+    $ python midi2oscprint.py
+    $ python midi2oscprint.py --window 10 --bundle --report 5
+    $ python midi2oscprint.py --host 192.168.1.20 --port 31415 --namespace keys
 
-midiin = rtmidi.MidiInMulti().open_ports("*")
-print "Listening to:"
-for port in midiin.get_openports():
-    print "   - ", midiin.get_port_name(port)
+The destination is resolved once and sent to through one socket. With
+--window, controller-like messages (CC, pitch bend, aftertouch) are coalesced
+per (source, channel, controller) during the window: only the latest value is
+sent, at the place of the latest. Notes and other messages are always sent,
+in order. With --bundle, what
+was collected during a window is sent as one OSC bundle
+"""
+import time
+import socket
+import struct
+import threading
+import optparse
+from collections import OrderedDict
+
+import rtmidi2 as rtmidi
 
-from liblo import send as oscsend
+import osccodec
+from osccodec import monotonic
 
 OSCPORT = 31415
 
-def callback(src, msg, t):
-    msgt, ch = rtmidi.splitchannel(msg[0])
-    val1 = int(msg[1])
-    val2 = int(msg[2])
-    msgtstr = rtmidi.msgtype2str(msgt).ljust(6)
-    oscsend(31415, "/print", "MIDI/" + src, msgtstr, ch, val1, val2)
+# status & 0xF0 of the messages whose latest value is all that matters
+COALESCE = {
+    0xA0: True,     # polyphonic aftertouch, per note
+    0xB0: True,     # control change, per controller
+    0xD0: False,    # channel pressure
+    0xE0: False     # pitch bend
+}
+
+# keep bundles below the size of a datagram which is never fragmented on a LAN
+MAXBUNDLE = 8192
+
+_values = struct.Struct(">ii")
+
+def msgtype_strings():
+    """status (with channel 0) -> the message type, as shown by oscprint"""
+    out = {}
+    for status in range(0x80, 0x100, 0x10):
+        msgt, ch = rtmidi.splitchannel(status)
+        out[status] = rtmidi.msgtype2str(msgt).ljust(6)
+    return out
+
+class Latency(object):
+    """
+    End-to-end latency, from the reception of a midi message to its sending
 
-midiin.set_qualified_callback(callback)
+    rtmidi gives each message the time since the previous message of the same
+    port. Adding these up gives the time of each message in the port's own
+    clock. The smallest difference ever seen between our clock and the port's
+    is taken as the delivery time, so the latency measured is what is added on
+    top of it: waiting in the coalescing window, encoding and sending
+    """
+    def __init__(self, maxsamples=10000):
+        self.clocks = {}      # source -> [port time, min. offset]
+        self.samples = []
+        self.maxsamples = maxsamples
+        self.count = 0
+        self.total = self.max = 0.
+    def event_time(self, src, delta, now):
+        """the time a message was received, in our clock (monotonic)"""
+        clock = self.clocks.get(src)
+        if clock is None:
+            clock = self.clocks[src] = [0., now]
+        clock[0] += delta
+        offset = now - clock[0]
+        if offset < clock[1]:
+            clock[1] = offset
+        return clock[0] + clock[1]
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        samples = self.samples
+        if len(samples) < self.maxsamples:
+            samples.append(latency)
+        else:
+            samples[self.count % self.maxsamples] = latency
+    def percentile(self, p):
+        if not self.samples:
+            return 0
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * p), len(samples) - 1)]
+    def __str__(self):
+        if not self.count:
+            return "latency: -"
+        return "latency ms: mean %.2f  p50 %.2f  p99 %.2f  max %.2f" % (
+            self.total / self.count * 1000, self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.max * 1000)
 
-while True:
-    a = raw_input("press q and ENTER to exit ")
-    if a == "q":
-        break
+class MIDIBridge(object):
+    """
+    Use an instance as the callback of a MidiInMulti (set_qualified_callback)
 
+    host, port: where oscprint is listening
+    namespace: the label of a message is namespace/source
+    window: in ms. 0 sends each message as soon as it arrives. Otherwise the
+            messages are collected and sent every window ms, coalesced
+    bundle: send each window as one bundle (or a few, if too large)
+    """
+    def __init__(self, host='127.0.0.1', port=OSCPORT, namespace="MIDI", window=0, bundle=False):
+        self.address = (socket.gethostbyname(host), port)
+        self.sock = osccodec.udpsocket()
+        self.namespace = namespace
+        self.window = window / 1000.
+        self.bundle = bundle
+        self.msgtypes = msgtype_strings()
+        # (source, status) -> the encoded message up to value1
+        self.prefixes = {}
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.latency = Latency()
+        self.events = self.sent = self.coalesced = self.bundles = self.errors = 0
+        self.serial = 0
+        self.closed = threading.Event()
+        self.thread = None
+        if self.window > 0:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+    def prefix(self, src, status):
+        prefix = self.prefixes.get((src, status))
+        if prefix is None:
+            oscstring = osccodec.oscstring
+            prefix = "".join([oscstring("/print"), oscstring(",ssiii"),
+                              oscstring("%s/%s" % (self.namespace, src)),
+                              oscstring(self.msgtypes[status & 0xF0]),
+                              struct.pack(">i", status & 0x0F)])
+            self.prefixes[(src, status)] = prefix
+        return prefix
+    def __call__(self, src, msg, t):
+        now = monotonic()
+        status = msg[0]
+        val1 = msg[1] if len(msg) > 1 else 0
+        val2 = msg[2] if len(msg) > 2 else 0
+        packet = self.prefix(src, status) + _values.pack(val1, val2)
+        eventtime = self.latency.event_time(src, t, now)
+        self.events += 1
+        if self.thread is None:
+            try:
+                self.sock.sendto(packet, self.address)
+            except socket.error:
+                self.errors += 1
+                return
+            self.sent += 1
+            self.latency.add(monotonic() - eventtime)
+            return
+        pernote = COALESCE.get(status & 0xF0)
+        with self.lock:
+            if pernote is None:
+                self.serial += 1
+                key = self.serial
+            else:
+                key = (src, status, val1 if pernote else None)
+                if key in self.pending:
+                    # moved to the end: the latest value is sent after the
+                    # notes which arrived before it
+                    del self.pending[key]
+                    self.coalesced += 1
+            self.pending[key] = (packet, eventtime)
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending = self.pending.values()
+            self.pending = OrderedDict()
+        try:
+            self._send([packet for packet, eventtime in pending])
+        except socket.error:
+            self.errors += 1
+            return
+        now = monotonic()
+        for packet, eventtime in pending:
+            self.latency.add(now - eventtime)
+        self.sent += len(pending)
+    def _send(self, packets):
+        sendto, address = self.sock.sendto, self.address
+        if not self.bundle:
+            for packet in packets:
+                sendto(packet, address)
+            return
+        bundle, size = [], 0
+        for packet in packets:
+            if size + len(packet) > MAXBUNDLE and bundle:
+                sendto(osccodec.encode_bundle(bundle), address)
+                self.bundles += 1
+                bundle, size = [], 0
+            bundle.append(packet)
+            size += len(packet) + 4
+        sendto(osccodec.encode_bundle(bundle), address)
+        self.bundles += 1
+    def run(self):
+        window, closed = self.window, self.closed
+        while not closed.is_set():
+            time.sleep(window)
+            self.flush()
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join(1)
+    def report(self, dur):
+        dur = max(dur, 1e-9)
+        return "%d events (%.0f/s), %d messages sent (%.0f/s), %d coalesced, %d bundles, %d errors\n%s" % (
+            self.events, self.events / dur, self.sent, self.sent / dur, self.coalesced, self.bundles, self.errors, self.latency)
 
-    
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-H", "--host", default="127.0.0.1", help="where oscprint is running (default: 127.0.0.1)")
+    parser.add_option("-p", "--port", type="int", default=OSCPORT, help="the OSC port of oscprint (default: %d)" % OSCPORT)
+    parser.add_option("-n", "--namespace", default="MIDI", help="the labels are namespace/source (default: MIDI)")
+    parser.add_option("-w", "--window", type="float", default=0,
+                      help="collect the messages during this many ms and send only the latest value of each "
+                           "controller, pitch bend and aftertouch (default: 0, send each message at once)")
+    parser.add_option("-b", "--bundle", action="store_true", default=False, help="with --window, send what was collected as one OSC bundle")
+    parser.add_option("-r", "--report", type="float", default=0, help="print the throughput and latency every this many seconds")
+    parser.add_option("-i", "--ports", default="*", help="the midi ports to listen to, a glob pattern (default: *)")
+    options, args = parser.parse_args()
+    if options.bundle and not options.window:
+        parser.error("--bundle needs a --window")
+    midiin = rtmidi.MidiInMulti().open_ports(options.ports)
+    print "Listening to:"
+    for port in midiin.get_openports():
+        print "   - ", midiin.get_port_name(port)
+    bridge = MIDIBridge(options.host, options.port, options.namespace, options.window, options.bundle)
+    midiin.set_qualified_callback(bridge)
+    t0 = time.time()
+    if options.report > 0:
+        def report():
+            while not bridge.closed.wait(options.report):
+                print bridge.report(time.time() - t0)
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+    try:
+        while True:
+            a = raw_input("press q and ENTER to exit ")
+            if a == "q":
+                break
+    except (KeyboardInterrupt, EOFError):
+        pass
+    bridge.close()
+    print bridge.report(time.time() - t0)
 
-    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+The way back: receive OSC and drive MIDI controllers or the outputs of an Arduino
+
+    $ python oscbridge.py --midi FIRMATA                          # /firmata/a0 0.5 --> CC100 64
+    $ python oscbridge.py --device /dev/tty.usbmodem1411 --pwm 3:5 --digital 13
+    $ python oscbridge.py --port 57122 --midi IAC --device /dev/ttyACM0 --pwm 9 --report 5
+
+The paths are the ones firmatasend.py sends, under --prefix (default /firmata):
+
+    path            MIDI (the reverse of firmatasend.sendmidi_callback)   firmata
+    /firmata/a<N>   CC analogoffset+N, value 0-1 --> 0-127                 -
+    /firmata/d<N>   CC digitaloffset+N, 0 or 127                          digital pin N, 0 or 1
+    /firmata/pwm<N> -                                                     PWM pin N, 0-1
+
+The table path -> output is compiled once. Outputs keep only the latest value
+of each controller or pin and skip values which did not change (after
+quantization to 0-127 for MIDI). The serial link is never given more than
+--load of its bandwidth: values wait, and are replaced by newer ones, until
+it has room for them.
+"""
+import time
+import select
+import optparse
+from collections import OrderedDict
+
+import osccodec
+from osccodec import monotonic
+
+BRIDGE_PORT = 57122
+
+# bytes of an analog (PWM) or digital message
+FIRMATA_MESSAGE = 3
+
+class CoalescingOutput(object):
+    """
+    The latest value of each slot (a controller, a pin), written in the order
+    the slots were first updated, at most `rate` units of cost per second
+
+    write: a function (slot, value)
+    rate: 0 for no limit
+    cost: the cost of a write, in the units of rate (bytes for a serial link)
+    burst: how much can be written at once after being idle, in seconds of rate
+
+    written   -- values written
+    replaced  -- values replaced by a newer one before being written
+    unchanged -- values equal to the last value written, skipped
+    errors    -- failed writes
+    """
+    def __init__(self, name, write, rate=0, cost=1, burst=0.05):
+        self.name = name
+        self.write = write
+        self.rate = rate
+        self.cost = cost
+        self.capacity = max(rate * burst, cost)
+        self.tokens = self.capacity
+        self.lastrefill = monotonic()
+        self.pending = OrderedDict()
+        self.last = {}
+        self.written = self.replaced = self.unchanged = self.errors = 0
+        self.latency_total = self.latency_max = 0.
+    def put(self, slot, value, now):
+        pending = self.pending
+        if slot in pending:
+            self.replaced += 1
+        elif self.last.get(slot) == value:
+            self.unchanged += 1
+            return
+        # an existing slot keeps its place in the queue
+        pending[slot] = (value, now)
+    def flush(self, now):
+        """write what the rate allows. Returns the number of values written"""
+        pending = self.pending
+        if not pending:
+            return 0
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.lastrefill) * self.rate)
+            self.lastrefill = now
+        n = 0
+        write, last, cost = self.write, self.last, self.cost
+        while pending and (not self.rate or self.tokens >= cost):
+            slot, (value, t) = pending.popitem(last=False)
+            try:
+                write(slot, value)
+            except (IOError, OSError):
+                self.errors += 1
+                continue
+            last[slot] = value
+            self.tokens -= cost
+            n += 1
+            latency = monotonic() - t
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+        self.written += n
+        return n
+    def timeout(self, now):
+        """seconds until something can be written, None if nothing is pending"""
+        if not self.pending:
+            return None
+        if not self.rate:
+            return 0
+        tokens = self.tokens + (now - self.lastrefill) * self.rate
+        return max(0, (self.cost - tokens) / self.rate)
+    def report(self):
+        latency = self.latency_total / self.written * 1000 if self.written else 0
+        return "%-8s %9d %9d %9d %6d %7d %8.2f %8.2f" % (self.name, self.written, self.replaced, self.unchanged,
+            self.errors, len(self.pending), latency, self.latency_max * 1000)
+
+def analog2cc(value):
+    return max(min(int(value * 127 + 0.5), 127), 0)
+
+def digital2cc(value):
+    return 127 if value else 0
+
+def unit(value):
+    return max(min(float(value), 1.), 0.)
+
+def digital(value):
+    return 1 if value else 0
+
+def midi_routes(output, prefix="/firmata", channel=7, analogoffset=100, digitaloffset=30):
+    """
+    the reverse of firmatasend.sendmidi_callback: /prefix/a<N> --> CC analogoffset+N,
+    /prefix/d<N> --> CC digitaloffset+N, on channel
+
+    Returns a list of (path, output, slot, convert)
+    """
+    routes = [("%s/a%d" % (prefix, i), output, (channel, analogoffset + i), analog2cc) for i in range(12)]
+    routes.extend(("%s/d%d" % (prefix, i), output, (channel, digitaloffset + i), digital2cc) for i in range(20))
+    return routes
+
+def firmata_routes(output, prefix="/firmata", pwm_pins=(), digital_pins=()):
+    """/prefix/pwm<N> --> PWM pin N, /prefix/d<N> --> digital pin N"""
+    routes = [("%s/pwm%d" % (prefix, pin), output, ('p', pin), unit) for pin in pwm_pins]
+    routes.extend(("%s/d%d" % (prefix, pin), output, ('d', pin), digital) for pin in digital_pins)
+    return routes
+
+def compile_routes(routes):
+    """a list of (path, output, slot, convert) --> {path: [(output, slot, convert), ...]}"""
+    table = {}
+    for path, output, slot, convert in routes:
+        table.setdefault(path, []).append((output, slot, convert))
+    return table
+
+def open_midi(port):
+    """a persistent MidiOut on port, created as a virtual port if it does not exist"""
+    import rtmidi2 as rtmidi
+    midiout = rtmidi.MidiOut()
+    if port in midiout.ports:
+        midiout.open_port(port)
+    else:
+        print "'%s' is not an existing port. A virtual port will be created." % port
+        midiout.open_virtual_port(port)
+    return midiout
+
+def midi_output(midiout, rate=0):
+    """rate: max. messages per second, 0 for no limit"""
+    send_cc = midiout.send_cc
+    def write(slot, value):
+        send_cc(slot[0], slot[1], value)
+    return CoalescingOutput("midi", write, rate=rate, cost=1)
+
+def open_board(device, pwm_pins=(), digital_pins=()):
+    """open the board at device and set the mode of its output pins"""
+    import pyfirmata
+    board = pyfirmata.Arduino(device)
+    for pin in pwm_pins:
+        board.digital[pin].mode = pyfirmata.PWM
+    for pin in digital_pins:
+        board.digital[pin].mode = pyfirmata.OUTPUT
+    return board
+
+def firmata_output(board, baudrate=57600, load=0.5):
+    """load: the fraction of the serial bandwidth which can be used (a byte is 10 bits on the line)"""
+    pins = board.digital
+    def write(slot, value):
+        pins[slot[1]].write(value)
+    return CoalescingOutput("firmata", write, rate=baudrate / 10. * load, cost=FIRMATA_MESSAGE)
+
+class Bridge(object):
+    """
+    Receives OSC on port and routes the first argument of each message to the outputs
+
+    table: compiled routes (see compile_routes)
+    outputs: the CoalescingOutputs the routes point to
+    """
+    def __init__(self, port, table, outputs, batchsize=64):
+        self.sock = osccodec.udpsocket(port)
+        self.receiver = osccodec.BatchReceiver(self.sock, batchsize=batchsize)
+        self.table = table
+        self.outputs = outputs
+        self.received = self.unrouted = 0
+    def route(self, messages, now):
+        table = self.table
+        for path, args in messages:
+            routes = table.get(path)
+            if routes is None or not args:
+                self.unrouted += 1
+                continue
+            value = args[0]
+            for output, slot, convert in routes:
+                try:
+                    output.put(slot, convert(value), now)
+                except (TypeError, ValueError):
+                    self.unrouted += 1
+        self.received += len(messages)
+    def step(self, maxwait=0.5):
+        """wait for messages or for an output to have room, route and write"""
+        now = monotonic()
+        timeouts = [t for t in (output.timeout(now) for output in self.outputs) if t is not None]
+        timeout = min(timeouts + [maxwait])
+        select.select([self.sock], [], [], timeout)
+        receiver = self.receiver
+        while receiver.recv_batch():
+            self.route(receiver.decode_batch(), monotonic())
+        now = monotonic()
+        for output in self.outputs:
+            output.flush(now)
+    def report(self):
+        lines = ["received %d messages, %d not routed, %d could not be decoded" % (self.received, self.unrouted, self.receiver.errors),
+                 "output     written  replaced unchanged errors pending  lat. ms  max. ms"]
+        lines.extend(output.report() for output in self.outputs)
+        return "\n".join(lines)
+    def close(self):
+        self.sock.close()
+
+def parse_pins(pins):
+    return map(int, pins.split(':')) if pins else []
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-p", "--port", type="int", default=BRIDGE_PORT, help="the OSC port to listen to (default: %d)" % BRIDGE_PORT)
+    parser.add_option("--prefix", default="/firmata", help="the namespace of the paths (default: /firmata)")
+    parser.add_option("-m", "--midi", dest="midiport", help="send MIDI CCs to this port. A virtual port is created if it does not exist")
+    parser.add_option("-c", "--midichannel", type="int", default=7)
+    parser.add_option("--analogoffset", type="int", default=100, help="/firmata/a<N> --> CC analogoffset+N (default: 100)")
+    parser.add_option("--digitaloffset", type="int", default=30, help="/firmata/d<N> --> CC digitaloffset+N (default: 30)")
+    parser.add_option("--midirate", type="float", default=0, help="max. MIDI messages per second (default: 0, no limit)")
+    parser.add_option("-s", "--device", help="the serial device of the board to drive")
+    parser.add_option("--pwm", help="the PWM pins to drive, a ':' delimited list. Example: --pwm 3:5:6")
+    parser.add_option("-d", "--digital", help="the digital pins to drive, see --pwm")
+    parser.add_option("--baudrate", type="int", default=57600, help="the baud rate of the board (default: 57600)")
+    parser.add_option("--load", type="float", default=0.5, help="the fraction of the serial bandwidth to use (default: 0.5)")
+    parser.add_option("-r", "--report", type="float", default=0, help="print the counters every this many seconds")
+    options, args = parser.parse_args()
+    if options.midiport is None and options.device is None:
+        parser.error("nothing to drive. Use --midi and/or --device")
+    routes = []
+    outputs = []
+    board = None
+    if options.midiport is not None:
+        output = midi_output(open_midi(options.midiport), options.midirate)
+        outputs.append(output)
+        routes.extend(midi_routes(output, options.prefix, options.midichannel, options.analogoffset, options.digitaloffset))
+    if options.device is not None:
+        pwm_pins, digital_pins = parse_pins(options.pwm), parse_pins(options.digital)
+        if not pwm_pins and not digital_pins:
+            parser.error("--device needs --pwm and/or --digital pins")
+        board = open_board(options.device, pwm_pins, digital_pins)
+        output = firmata_output(board, options.baudrate, options.load)
+        outputs.append(output)
+        routes.extend(firmata_routes(output, options.prefix, pwm_pins, digital_pins))
+    bridge = Bridge(options.port, compile_routes(routes), outputs)
+    print "listening to OSC on port %d (press CTRL-C to stop)" % options.port
+    nextreport = time.time() + options.report
+    try:
+        while True:
+            bridge.step()
+            if options.report > 0 and time.time() >= nextreport:
+                print bridge.report()
+                nextreport += options.report
+    except KeyboardInterrupt:
+        pass
+    print bridge.report()
+    bridge.close()
+    if board is not None:
+        board.exit()
+
+if __name__ == '__main__':
+    main()
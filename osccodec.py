@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+A pure python OSC 1.0 codec
+
+Decoding works on offsets into the received buffer (str or bytearray) with
+struct.unpack_from, so neither messages nor bundle elements are sliced
+out of the packet. Messages whose arguments are all fixed-size (i f d h t)
+are decoded with one precompiled struct per typetag string.
+
+    decode(data)                  --> [(path, args), ...]
+    encode(path, *args)           --> str
+    Encoder('/firmata/a0', 'f')   --> precompiled encoder, enc(0.5) --> str
+    encode_bundle(packets, t)     --> str
+    BatchReceiver(sock)           --> drain many datagrams into preallocated buffers
+
+monotonic() is a monotonic clock in seconds, also for python versions which lack time.monotonic
+"""
+import sys
+import struct
+import socket
+import errno
+import time
+
+NTP_DELTA = 2208988800  # seconds between 1900 (NTP epoch) and 1970
+IMMEDIATELY = 1
+
+_int32 = struct.Struct(">i")
+_uint64 = struct.Struct(">Q")
+_bundle_header = struct.Struct(">8sQ")
+
+FIXEDSIZE = {'i': 'i', 'f': 'f', 'd': 'd', 'h': 'q', 't': 'Q', 'c': 'i'}
+NOARGS = {'T': True, 'F': False, 'N': None, 'I': float('inf')}
+
+class OSCDecodeError(ValueError):
+    pass
+
+def pad4(n):
+    return (n + 3) & ~3
+
+def oscstring(s):
+    """encode s as a null-terminated, 4-byte padded OSC-string"""
+    return s + '\0' * (4 - (len(s) & 3))
+
+def oscblob(b):
+    b = bytes(b)
+    return _int32.pack(len(b)) + b + '\0' * (pad4(len(b)) - len(b))
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    def _get_monotonic():
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        try:
+            librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+            clock_gettime = librt.clock_gettime
+        except (OSError, AttributeError):
+            return time.time
+        CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+        ts = timespec()
+        ts_ref = ctypes.byref(ts)
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, ts_ref)
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    monotonic = _get_monotonic()
+
+def time2timetag(t):
+    """unix time (float) -> NTP timetag (int)"""
+    secs = int(t)
+    return ((secs + NTP_DELTA) << 32) | int((t - secs) * 4294967296.)
+
+def timetag2time(tag):
+    """NTP timetag (int) -> unix time (float). The special value 1 (immediately) is returned as 0"""
+    if tag == IMMEDIATELY:
+        return 0
+    return (tag >> 32) - NTP_DELTA + (tag & 0xFFFFFFFF) / 4294967296.
+
+# ------------------------------------------------------------------
+# Decoding
+# ------------------------------------------------------------------
+
+def _read_string(data, i, end):
+    zero = data.find('\0', i, end)
+    if zero < 0:
+        raise OSCDecodeError("unterminated string at %d" % i)
+    return str(data[i:zero]), pad4(zero + 1)
+
+_typetag_cache = {}
+
+def _compile_typetags(typetags):
+    """
+    typetags without the leading comma. Returns (struct, None) if all arguments
+    are fixed size, (None, tags) otherwise
+    """
+    if all(tag in FIXEDSIZE for tag in typetags):
+        fmt = struct.Struct(">" + "".join(FIXEDSIZE[tag] for tag in typetags))
+        compiled = (fmt, None)
+    else:
+        compiled = (None, typetags)
+    _typetag_cache[typetags] = compiled
+    return compiled
+
+def read_address(data, start=0, end=None):
+    """
+    return the address of the message at data[start:end] without decoding its arguments,
+    or '#bundle' for a bundle
+    """
+    if end is None:
+        end = len(data)
+    return _read_string(data, start, end)[0]
+
+def decode_message(data, start=0, end=None):
+    """
+    decode the message at data[start:end]. Returns (path, args)
+
+    Blobs are returned as memoryviews into data, so they are only valid as
+    long as data is not reused
+    """
+    if end is None:
+        end = len(data)
+    path, i = _read_string(data, start, end)
+    if i >= end or not data.startswith(',', i):
+        # OSC 1.0 allows messages without typetags
+        return path, []
+    typetags, i = _read_string(data, i + 1, end)
+    fmt, tags = _typetag_cache.get(typetags) or _compile_typetags(typetags)
+    if fmt is not None:
+        if i + fmt.size > end:
+            raise OSCDecodeError("message too short for typetags %s" % typetags)
+        return path, list(fmt.unpack_from(data, i))
+    args = []
+    append = args.append
+    unpack_from = struct.unpack_from
+    for tag in tags:
+        if tag == 's' or tag == 'S':
+            value, i = _read_string(data, i, end)
+        elif tag in FIXEDSIZE:
+            code = FIXEDSIZE[tag]
+            value = unpack_from(">" + code, data, i)[0]
+            i += 8 if code in "dqQ" else 4
+        elif tag in NOARGS:
+            value = NOARGS[tag]
+        elif tag == 'b':
+            size = _int32.unpack_from(data, i)[0]
+            i += 4
+            value = memoryview(data)[i:i+size]
+            i += pad4(size)
+        elif tag == 'm':
+            value = tuple(bytearray(data[i:i+4]))
+            i += 4
+        else:
+            raise OSCDecodeError("typetag not supported: %s" % tag)
+        append(value)
+    if i > end:
+        raise OSCDecodeError("message too short for typetags %s" % typetags)
+    return path, args
+
+def decode_bundle(data, start=0, end=None):
+    """
+    decode the bundle at data[start:end]. Returns (timetag, [(start, end), ...]),
+    the offsets of each element inside data
+    """
+    if end is None:
+        end = len(data)
+    header, timetag = _bundle_header.unpack_from(data, start)
+    if header != '#bundle\0':
+        raise OSCDecodeError("not a bundle")
+    elements = []
+    i = start + 16
+    while i < end:
+        size = _int32.unpack_from(data, i)[0]
+        i += 4
+        if size < 0 or i + size > end:
+            raise OSCDecodeError("bundle element exceeds packet")
+        elements.append((i, i + size))
+        i += size
+    return timetag, elements
+
+def decode(data, start=0, end=None, out=None):
+    """
+    decode an OSC packet (a message or a bundle, possibly nested) at data[start:end]
+
+    Returns a list of (path, args). Bundles are flattened in order, their timetags
+    are discarded. Use decode_timed to keep them.
+    """
+    if out is None:
+        out = []
+    if end is None:
+        end = len(data)
+    if data.startswith('#', start):
+        timetag, elements = decode_bundle(data, start, end)
+        for elemstart, elemend in elements:
+            decode(data, elemstart, elemend, out)
+    else:
+        out.append(decode_message(data, start, end))
+    return out
+
+def decode_timed(data, start=0, end=None, out=None, timetag=IMMEDIATELY):
+    """like decode, but returns a list of (timetag, path, args)"""
+    if out is None:
+        out = []
+    if end is None:
+        end = len(data)
+    if data.startswith('#', start):
+        timetag, elements = decode_bundle(data, start, end)
+        for elemstart, elemend in elements:
+            decode_timed(data, elemstart, elemend, out, timetag)
+    else:
+        path, args = decode_message(data, start, end)
+        out.append((timetag, path, args))
+    return out
+
+# ------------------------------------------------------------------
+# Encoding
+# ------------------------------------------------------------------
+
+def typetag(value):
+    if value is True:
+        return 'T'
+    if value is False:
+        return 'F'
+    if value is None:
+        return 'N'
+    if isinstance(value, int):
+        return 'i' if -2147483648 <= value <= 2147483647 else 'h'
+    if isinstance(value, long):
+        return 'h'
+    if isinstance(value, float):
+        return 'f'
+    if isinstance(value, basestring):
+        return 's'
+    if isinstance(value, (bytearray, memoryview)):
+        return 'b'
+    raise TypeError("can't encode %s as OSC" % type(value))
+
+def _packer(tag):
+    if tag in FIXEDSIZE:
+        return struct.Struct(">" + FIXEDSIZE[tag]).pack
+    if tag == 's' or tag == 'S':
+        return lambda value: oscstring(value if isinstance(value, str) else str(value))
+    if tag == 'b':
+        return oscblob
+    if tag in NOARGS:
+        return lambda value: ''
+    raise ValueError("typetag not supported: %s" % tag)
+
+class Encoder(object):
+    """
+    A precompiled encoder for a fixed address and typetags
+
+    enc = Encoder('/firmata/a0', 'f')
+    packet = enc(0.5)
+
+    The address and typetag strings are encoded once. If all the types are
+    fixed-size, the arguments are packed with a single struct
+    """
+    def __init__(self, path, typetags):
+        typetags = typetags.lstrip(',')
+        self.path = path
+        self.typetags = typetags
+        self.prefix = prefix = oscstring(path) + oscstring(',' + typetags)
+        if all(tag in FIXEDSIZE for tag in typetags):
+            pack = struct.Struct(">" + "".join(FIXEDSIZE[tag] for tag in typetags)).pack
+            self.encode = lambda *args: prefix + pack(*args)
+        else:
+            packers = [_packer(tag) for tag in typetags]
+            def encode(*args):
+                return prefix + "".join([pack(arg) for pack, arg in zip(packers, args)])
+            self.encode = encode
+    def __call__(self, *args):
+        return self.encode(*args)
+    def __repr__(self):
+        return "Encoder(%s, %s)" % (self.path, self.typetags)
+
+_encoder_cache = {}
+
+def encode(path, *args):
+    """encode a message, inferring the typetags from the arguments"""
+    typetags = "".join([typetag(arg) for arg in args])
+    key = (path, typetags)
+    enc = _encoder_cache.get(key)
+    if enc is None:
+        enc = _encoder_cache[key] = Encoder(path, typetags)
+    return enc.encode(*args)
+
+def encode_bundle(packets, t=None):
+    """
+    packets: a list of already encoded messages or bundles
+    t: unix time of the bundle, or None to execute immediately
+    """
+    timetag = IMMEDIATELY if t is None else time2timetag(t)
+    parts = [_bundle_header.pack('#bundle\0', timetag)]
+    for packet in packets:
+        parts.append(_int32.pack(len(packet)))
+        parts.append(packet)
+    return "".join(parts)
+
+# ------------------------------------------------------------------
+# Receiving
+# ------------------------------------------------------------------
+
+class BatchReceiver(object):
+    """
+    Receive many datagrams per call into a set of preallocated buffers
+
+    Python has no access to recvmmsg, so the socket is drained in a tight
+    recv_into loop and the packets are decoded in one pass afterwards,
+    without allocating a new buffer per datagram.
+
+    r = BatchReceiver(sock)
+    n = r.recv_batch()             # number of datagrams read
+    for path, args in r.decode_batch():
+        ...
+    """
+    def __init__(self, sock, batchsize=64, bufsize=65536):
+        sock.setblocking(0)
+        self.sock = sock
+        self.buffers = [bytearray(bufsize) for _ in range(batchsize)]
+        self.sizes = [0] * batchsize
+        self.addresses = [None] * batchsize
+        self.count = 0
+        self.errors = 0
+        self.dropped = 0
+    def recv_batch(self):
+        recvfrom_into = self.sock.recvfrom_into
+        buffers, sizes, addresses = self.buffers, self.sizes, self.addresses
+        n = 0
+        for buf in buffers:
+            try:
+                sizes[n], addresses[n] = recvfrom_into(buf)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+            n += 1
+        self.count = n
+        return n
+    def packets(self):
+        """iterate over (buffer, size, address) of the last batch"""
+        for i in xrange(self.count):
+            yield self.buffers[i], self.sizes[i], self.addresses[i]
+    def _rejected(self, i, accept):
+        """
+        does accept reject the address of packet i? Read without decoding the
+        packet. Bundles are not looked into
+        """
+        try:
+            address = read_address(self.buffers[i], 0, self.sizes[i])
+        except OSCDecodeError:
+            return False
+        if address == '#bundle' or accept(address):
+            return False
+        self.dropped += 1
+        return True
+    def decode_each(self, accept=None):
+        """
+        decode the last batch packet by packet. Returns a list of
+        (messages, size, address), messages being a list of (path, args)
+
+        accept: a function address -> bool. Messages it rejects are dropped
+                before their arguments are decoded
+        """
+        packets = []
+        for i in xrange(self.count):
+            if accept is not None and self._rejected(i, accept):
+                continue
+            messages = []
+            try:
+                decode(self.buffers[i], 0, self.sizes[i], messages)
+            except (OSCDecodeError, struct.error, IndexError):
+                self.errors += 1
+                continue
+            packets.append((messages, self.sizes[i], self.addresses[i]))
+        return packets
+    def decode_batch(self, out=None, accept=None):
+        """
+        decode all messages of the last batch. Returns a list of (path, args)
+
+        accept: as in decode_each
+        """
+        if out is None:
+            out = []
+        for i in xrange(self.count):
+            if accept is not None and self._rejected(i, accept):
+                continue
+            try:
+                decode(self.buffers[i], 0, self.sizes[i], out)
+            except (OSCDecodeError, struct.error, IndexError):
+                self.errors += 1
+        return out
+
+# python 2 does not define SO_REUSEPORT
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 0x200 if sys.platform == 'darwin' else 15)
+
+def udpsocket(port=None, host='', reuseport=False):
+    """
+    create a UDP socket. If port is given, the socket is bound to it
+
+    reuseport: allow other sockets (in other processes) to bind the same port. The
+               kernel distributes the datagrams among them, by source address
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if port is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    return sock
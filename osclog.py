@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+A compact, append-only binary log of OSC packets
+
+Layout:
+
+    header      "OSCLOG02"
+    records     one per packet:
+                    'P' | timestamp (double) | size (uint32) | packet (size bytes)
+    index       every INDEX_EVERY packets, and when the log is closed, one block
+                for the packets written since the previous block:
+                    'I' | first timestamp (double) | offset of the first packet (uint64) |
+                    last timestamp (double) | count (uint32) |
+                    offset of the previous block (uint64, 0 if none) | offset of this block (uint64)
+
+The timestamp is the time of reception, in seconds from the start of the log.
+Packets are stored as received (a message with its address, typetags and raw
+arguments, or a whole bundle), so they can be re-sent as they are.
+
+A log which was closed ends with an index block. A reader finds it at the end
+of the file and follows the offsets of the previous blocks back to the first,
+to seek to a given time without scanning the log. Only a log whose writer was
+killed needs to be scanned.
+
+Appending to a log starts a new session: its timestamps continue from the
+last one of the log, since the clocks of two sessions have nothing in common.
+A record cut short when the previous writer was killed is dropped.
+
+    log = LogWriter("show.osclog")
+    log.write(packet)
+    log.close()
+
+    for t, packet in LogReader("show.osclog"):
+        ...
+"""
+import os
+import mmap
+import struct
+from bisect import bisect
+
+from osccodec import monotonic
+
+MAGIC = "OSCLOG02"
+PACKET = 'P'
+INDEX  = 'I'
+INDEX_EVERY = 1024
+
+_record_header = struct.Struct(">cdI")
+_index_block   = struct.Struct(">cdQdIQQ")
+
+class LogError(IOError):
+    pass
+
+class LogWriter(object):
+    """
+    path: the log file. If it exists, packets are appended to it, as a new session
+    bufsize: writes are buffered, the log is written in blocks of this size
+    """
+    def __init__(self, path, bufsize=65536, clock=monotonic):
+        self.path = path
+        self.clock = clock
+        self.count = 0
+        # the packets since the last index block: (timestamp, offset) of the first, timestamp of the last
+        self._first = None
+        self._last = 0.
+        self._pending = 0
+        self._previous = 0
+        base, end, tail = 0., None, None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = LogReader(path)
+            try:
+                first, last = reader.timespan()
+                if last is not None:
+                    base = last
+                end, tail, self._previous = reader.end, reader.tail, reader.lastblock
+            finally:
+                reader.close()
+        if end is None:
+            self.f = open(path, "wb", bufsize)
+            self.f.write(MAGIC)
+        else:
+            self.f = open(path, "r+b", bufsize)
+            self.f.seek(end)
+            self.f.truncate()
+        self.offset = self.f.tell()
+        if tail is not None:
+            # packets of a killed writer, which no block points at
+            first, firstoffset, self._last, self._pending = tail
+            self._first = (first, firstoffset)
+            self._write_index()
+        self.base = base
+        self.clock0 = clock()
+    def write(self, packet, size=None, t=None):
+        """
+        packet: the raw packet (str, bytearray or buffer)
+        size: the size of the packet, if packet is a larger buffer
+        t: the time of reception, in the clock of the writer. Defaults to now
+        """
+        if size is None:
+            size = len(packet)
+        if t is None:
+            t = self.clock()
+        t = self.base + (t - self.clock0)
+        if self._first is None:
+            self._first = (t, self.offset)
+        self._last = t
+        self._pending += 1
+        header = _record_header.pack(PACKET, t, size)
+        f = self.f
+        f.write(header)
+        f.write(buffer(packet, 0, size))
+        self.offset += len(header) + size
+        self.count += 1
+        if self._pending >= INDEX_EVERY:
+            self._write_index()
+    def _write_index(self):
+        if not self._pending:
+            return
+        first, firstoffset = self._first
+        self.f.write(_index_block.pack(INDEX, first, firstoffset, self._last, self._pending,
+                                       self._previous, self.offset))
+        self._previous = self.offset
+        self.offset += _index_block.size
+        self._first = None
+        self._pending = 0
+    def flush(self):
+        self.f.flush()
+    def close(self):
+        if self.f is not None:
+            self._write_index()
+            self.f.close()
+            self.f = None
+
+class LogReader(object):
+    """
+    Reads a log through a memory map: packets are returned as buffers into the
+    map, without copying. They are only valid while the reader is open.
+
+    Iterating gives (timestamp, packet)
+
+    blocks    -- the index, read once: a list of (first timestamp, offset, last timestamp, count)
+    end       -- the offset after the last complete record
+    lastblock -- the offset of the last index block, 0 if there is none
+    tail      -- the block of the packets written after it by a killed writer, or None
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        size = os.path.getsize(path)
+        if size < len(MAGIC):
+            raise LogError("%s is not an OSC log" % path)
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise LogError("%s is not an OSC log" % path)
+        self.size = size
+        self.blocks = self._chain()
+        if self.blocks is None:
+            self.blocks = self._scan()
+    def _chain(self):
+        """the blocks, from the one at the end of the log back to the first. None if the log does not end with one"""
+        m = self.map
+        offset = self.size - _index_block.size
+        if offset < len(MAGIC) or m[offset] != INDEX or _index_block.unpack_from(m, offset)[6] != offset:
+            return None
+        self.end, self.lastblock, self.tail = self.size, offset, None
+        blocks = []
+        while offset:
+            _, first, firstoffset, last, count, previous, this = _index_block.unpack_from(m, offset)
+            if this != offset or previous >= offset:
+                raise LogError("corrupt index at offset %d" % offset)
+            blocks.append((first, firstoffset, last, count))
+            offset = previous
+        blocks.reverse()
+        return blocks
+    def _scan(self):
+        """the blocks, found by reading every record"""
+        m = self.map
+        size = self.size
+        record_size = _record_header.size
+        blocks = []
+        first = None
+        count = 0
+        offset = len(MAGIC)
+        self.lastblock = 0
+        while offset < size:
+            kind = m[offset]
+            if kind == PACKET:
+                if offset + record_size > size:
+                    break
+                _, t, length = _record_header.unpack_from(m, offset)
+                if offset + record_size + length > size:
+                    break
+                if first is None:
+                    first = (t, offset)
+                last = t
+                count += 1
+                offset += record_size + length
+            elif kind == INDEX:
+                if offset + _index_block.size > size:
+                    break
+                _, t, firstoffset, lastt, n, previous, this = _index_block.unpack_from(m, offset)
+                blocks.append((t, firstoffset, lastt, n))
+                first = None
+                count = 0
+                self.lastblock = offset
+                offset += _index_block.size
+            else:
+                raise LogError("corrupt log at offset %d" % offset)
+        self.end = offset
+        self.tail = None
+        if first is not None:
+            self.tail = (first[0], first[1], last, count)
+            blocks.append(self.tail)
+        return blocks
+    def records(self, offset=len(MAGIC)):
+        """iterate over (timestamp, packet), starting at offset"""
+        m = self.map
+        end = self.end
+        record_size = _record_header.size
+        index_size = _index_block.size
+        while offset < end:
+            kind = m[offset]
+            if kind == PACKET:
+                _, t, length = _record_header.unpack_from(m, offset)
+                start = offset + record_size
+                yield t, buffer(m, start, length)
+                offset = start + length
+            elif kind == INDEX:
+                offset += index_size
+            else:
+                raise LogError("corrupt log at offset %d" % offset)
+    __iter__ = records
+    def index(self):
+        """iterate over the index entries, one per block: (timestamp, offset) of its first packet"""
+        for first, offset, last, count in self.blocks:
+            yield first, offset
+    def offset_at(self, t):
+        """the offset of the last indexed packet received before time t"""
+        blocks = self.blocks
+        i = bisect([block[0] for block in blocks], t)
+        return blocks[i - 1][1] if i else len(MAGIC)
+    def timespan(self):
+        """(first timestamp, last timestamp)"""
+        if not self.blocks:
+            return None, None
+        return self.blocks[0][0], self.blocks[-1][2]
+    def close(self):
+        self.map.close()
+        self.f.close()
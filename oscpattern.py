@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+OSC address patterns, compiled into a trie
+
+    d = Dispatcher([('/print', printfunc), ('/synth/*/freq', freqfunc)], default=defaultfunc,
+                   exclude=['MIDI', '/firmata'])
+    d.dispatch('/synth/3/freq', [440.0])       # --> freqfunc('/synth/3/freq', [440.0])
+    d.dispatch('/pr?nt', ['freq', 440.0])      # --> printfunc('/pr?nt', ['freq', 440.0])
+    d.accept('/firmata/a0')                    # --> False
+
+Patterns follow OSC 1.0. Within a part of the address (between two '/'):
+
+    ?           any character
+    *           any sequence of characters, also none
+    [abc]       one of the characters. [a-z] is a range, [!abc] any other character
+    {foo,bar}   one of the strings
+
+A pattern is split at '/' into parts, which are the edges of the trie: literal
+parts are looked up in a dict, only the parts with wildcards are matched with a
+regular expression. The address of a message can itself be a pattern, as in
+OSC 1.0: it reaches every method it matches. A part of it with wildcards is
+matched against the literal parts of the trie (and equals a pattern part
+only if written the same). The functions an address resolves to, and whether
+the filters let it through, are cached per address, so after the first
+message an address costs one dict lookup.
+
+Filters (include, exclude) match an address or any of its parents: the filter
+'/firmata' (or '/firmata/*') drops '/firmata/a0' and '/firmata/d/3'. For the
+addresses with a key among their arguments (keypaths), include applies to
+the key only: include=['voice*'] lets ('/print', 'voice1', 1) through.
+"""
+import re
+
+class OSCPatternError(ValueError):
+    pass
+
+_MISSING = object()
+
+_WILDCARDS = re.compile(r"[*?\[\]{}]")
+
+def compile_part(part):
+    """
+    a part of a pattern (no '/') --> a function part -> match or None.
+    Returns None if part has no wildcards
+    """
+    if not _WILDCARDS.search(part):
+        return None
+    out = []
+    i, n = 0, len(part)
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '[':
+            end = part.find(']', i)
+            if end < 0:
+                raise OSCPatternError("unbalanced [ in %s" % part)
+            chars = part[i:end]
+            i = end + 1
+            negate = chars.startswith('!')
+            if negate:
+                chars = chars[1:]
+            if not chars:
+                raise OSCPatternError("empty [] in %s" % part)
+            chars = chars.replace('\\', '\\\\').replace('^', '\\^').replace('[', '\\[')
+            out.append('[%s%s]' % ('^' if negate else '', chars))
+        elif c == '{':
+            end = part.find('}', i)
+            if end < 0:
+                raise OSCPatternError("unbalanced { in %s" % part)
+            choices = part[i:end].split(',')
+            i = end + 1
+            out.append('(?:%s)' % '|'.join(re.escape(choice) for choice in choices))
+        elif c in ']}':
+            raise OSCPatternError("unbalanced %s in %s" % (c, part))
+        else:
+            out.append(re.escape(c))
+    try:
+        return re.compile(''.join(out) + r'\Z', re.DOTALL).match
+    except re.error as e:
+        raise OSCPatternError("%s: %s" % (part, e))
+
+def ispattern(address):
+    """does address have wildcards?"""
+    return _WILDCARDS.search(address) is not None
+
+def split(address):
+    """'/a/b/' --> ['', 'a', 'b']. A trailing '/' (or '/*' for a filter) is not a part"""
+    if len(address) > 1 and address.endswith('/'):
+        address = address[:-1]
+    return address.split('/')
+
+class _Node(object):
+    __slots__ = ('literals', 'patterns', 'values', 'subtree')
+    def __init__(self):
+        self.literals = {}      # part -> node
+        self.patterns = []      # (match, pattern, node)
+        self.values = []        # the values of the patterns ending here
+        self.subtree = []       # the values of the prefixes ending here
+
+class AddressTrie(object):
+    """
+    Maps OSC address patterns to values
+
+    trie.add('/synth/*/freq', value)
+    trie.add('/firmata', value, prefix=True)
+    trie.match('/synth/1/freq')  --> [value]
+    """
+    def __init__(self, patterns=(), prefix=False):
+        self.root = _Node()
+        self.size = 0
+        for pattern in patterns:
+            self.add(pattern, pattern, prefix)
+    def add(self, pattern, value, prefix=False):
+        """
+        prefix: if True, the pattern also matches any address below it. A
+                trailing '/*' means the same
+        """
+        parts = split(pattern)
+        if prefix and len(parts) > 1 and parts[-1] == '*':
+            parts.pop()
+        node = self.root
+        for part in parts:
+            match = compile_part(part)
+            if match is None:
+                child = node.literals.get(part)
+                if child is None:
+                    child = node.literals[part] = _Node()
+            else:
+                for m, p, child in node.patterns:
+                    if p == part:
+                        break
+                else:
+                    child = _Node()
+                    node.patterns.append((match, part, child))
+            node = child
+        # the values are numbered, to give the matches in order
+        (node.subtree if prefix else node.values).append((self.size, value))
+        self.size += 1
+    def __len__(self):
+        return self.size
+    def match(self, address):
+        """
+        the values of all patterns matching address, in the order they were
+        added. address can be a pattern
+        """
+        found = []
+        nodes = [self.root]
+        for part in split(address):
+            try:
+                wildcard = compile_part(part)
+            except OSCPatternError:
+                # not a valid pattern: taken literally
+                wildcard = None
+            children = []
+            for node in nodes:
+                if node.subtree:
+                    found.extend(node.subtree)
+                if wildcard is None:
+                    child = node.literals.get(part)
+                    if child is not None:
+                        children.append(child)
+                    for match, pattern, child in node.patterns:
+                        if match(part):
+                            children.append(child)
+                    continue
+                for literal, child in node.literals.iteritems():
+                    if wildcard(literal):
+                        children.append(child)
+                for match, pattern, child in node.patterns:
+                    if pattern == part:
+                        children.append(child)
+            nodes = children
+            if not nodes:
+                break
+        for node in nodes:
+            found.extend(node.values)
+            found.extend(node.subtree)
+        if len(found) > 1:
+            # an address can reach the same pattern through several nodes
+            found = sorted(set(found))
+        return [value for order, value in found]
+
+class Dispatcher(object):
+    """
+    methods: a list of (pattern, func). func is called as func(path, args)
+    default: called for the addresses no method matches, can be None
+    include: a list of patterns. If given, only these addresses are dispatched
+    exclude: a list of patterns. These addresses are dropped
+    keypaths: a dict path -> the index of the argument which is a key (a label).
+              include applies to the key instead of the address, exclude to both.
+              For oscprint, '/print': 0: ('/print', 'MIDI/note', 60) is dropped by
+              exclude=['MIDI'], and kept by include=['MIDI']. A message of a keypath
+              without its key is filtered by its address. An index of None
+              means the messages concern no key in particular (clear all, ...):
+              include does not apply to them, only exclude. A list of paths
+              means their first argument is the key
+    cachesize: the max. number of addresses cached. The cache starts over when it is full
+
+    dropped: the number of messages dropped by the filters
+    """
+    def __init__(self, methods=(), default=None, include=(), exclude=(), keypaths=(), cachesize=10000):
+        self.methods = AddressTrie()
+        for pattern, func in methods:
+            self.methods.add(pattern, func)
+        self.default = default
+        self.include = AddressTrie(include, prefix=True) if include else None
+        self.exclude = AddressTrie(exclude, prefix=True) if exclude else None
+        self.filtered = bool(include or exclude)
+        self.keypaths = AddressTrie() if self.filtered and keypaths else None
+        if self.keypaths is not None:
+            if not isinstance(keypaths, dict):
+                keypaths = dict.fromkeys(keypaths, 0)
+            for path, index in keypaths.iteritems():
+                self.keypaths.add(path, index)
+        self.cachesize = cachesize
+        self.dropped = 0
+        self._funcs = {}
+        self._accepted = {}
+        self._keyed = {}
+    def add_method(self, pattern, func):
+        self.methods.add(pattern, func)
+        self._funcs.clear()
+    def accept(self, address):
+        """does address (or a key) pass the filters?"""
+        accepted = self._accepted.get(address)
+        if accepted is None:
+            accepted = ((self.include is None or bool(self.include.match(address))) and
+                        (self.exclude is None or not self.exclude.match(address)))
+            if len(self._accepted) >= self.cachesize:
+                self._accepted.clear()
+            self._accepted[address] = accepted
+        return accepted
+    def _keypath(self, address):
+        """
+        None if address is not a keypath. Otherwise (index of the key, does
+        address pass exclude)
+        """
+        keyed = self._keyed.get(address, _MISSING)
+        if keyed is _MISSING:
+            indexes = self.keypaths.match(address) if self.keypaths is not None else None
+            if indexes:
+                keyed = (indexes[0], self.exclude is None or not self.exclude.match(address))
+            else:
+                keyed = None
+            if len(self._keyed) >= self.cachesize:
+                self._keyed.clear()
+            self._keyed[address] = keyed
+        return keyed
+    def accept_address(self, address):
+        """
+        can a message to address pass the filters? Its key, if address is a
+        keypath, is not known yet: only exclude applies
+        """
+        keyed = self._keypath(address)
+        if keyed is None:
+            return self.accept(address)
+        return keyed[1]
+    def _accept_key(self, path, args, index):
+        """the key of a message to a keypath passes the filters (or, without a key, its path)"""
+        if index is None:
+            return True
+        if len(args) > index and isinstance(args[index], basestring):
+            return self.accept(args[index])
+        return self.accept(path)
+    def accept_message(self, path, args):
+        """does the message pass the filters, by its address and key?"""
+        if not self.filtered:
+            return True
+        if not self.accept_address(path):
+            return False
+        keyed = self._keypath(path)
+        if keyed is not None:
+            return self._accept_key(path, args, keyed[0])
+        return True
+    def resolve(self, address):
+        """the functions to call for address, a tuple. Empty if it is filtered out"""
+        funcs = self._funcs.get(address)
+        if funcs is None:
+            if not self.accept_address(address):
+                funcs = ()
+            else:
+                funcs = tuple(self.methods.match(address))
+                if not funcs and self.default is not None:
+                    funcs = (self.default,)
+            if len(self._funcs) >= self.cachesize:
+                self._funcs.clear()
+            self._funcs[address] = funcs
+        return funcs
+    def dispatch(self, path, args):
+        """call the functions matching path. Returns how many were called"""
+        funcs = self._funcs.get(path)
+        if funcs is None:
+            funcs = self.resolve(path)
+        if funcs and self.keypaths is not None:
+            keyed = self._keypath(path)
+            if keyed is not None and not self._accept_key(path, args, keyed[0]):
+                funcs = ()
+        if not funcs:
+            if self.filtered:
+                self.dropped += 1
+            return 0
+        for func in funcs:
+            func(path, args)
+        return len(funcs)
@@ -1,12 +1,29 @@
 #!/usr/bin/env python
-import liblo
 import curses
 import time
 import sys, os
-from math import *
-from peach import *
-from e.elib import sort_natural
-    
+import select
+import struct
+import re
+import locale
+import json
+from collections import OrderedDict
+import csv
+import errno
+import signal
+import fcntl
+from array import array
+from bisect import bisect
+from math import log10
+
+import osccodec
+import oscpattern
+from osclog import LogWriter, LogError
+import sharedtable
+
+# imported in main, if available
+liblo = None
+
 def usage():
     print """
 %s [oscport] [options]
@@ -21,6 +38,51 @@ OPTIONS:
 --nosort           do not sort the lines each automatically
 --autocalibrate    calibrate faders acording to the received values (default=True). VUs are never autocalibrated
 --noautocalibrate  do not autocalibrate faders.
+--backend NAME     how to receive OSC. One of
+                       liblo  : use a liblo server (default, if liblo is installed)
+                       select : a plain UDP socket waited on together with the keyboard.
+                                Does not need liblo and has no polling granularity
+--fps FPS          maximum number of screen repaints per second (default=30). All pending
+                   messages are processed before each repaint, so a label updated many
+                   times between frames is drawn only once, with its latest value. Only
+                   the characters which changed are written, and the rate is lowered
+                   when the terminal is slow to take them (over ssh)
+--record FILE      append every received packet to FILE, with its time of arrival.
+                   The log can be replayed with oscreplay.py. Recording again to the
+                   same FILE adds a session, which follows the previous one
+--history N        keep the last N values of each label and show them as a sparkline,
+                   together with min, max, mean and rate (default=0, no history).
+                   Can also be set per label, see "history" below
+--window SECS      the time window of the statistics shown with --history (default=5)
+--output FORMAT    headless mode: do not use the terminal, write each update as a record
+                   to stdout (or to --outfile). FORMAT is one of jsonl, csv, tsv.
+                   Each record has the time, label, type (line, fader, vu, percent), value
+                   and, for faders, the range. Writes are buffered and flushed --fps times
+                   per second
+--outfile FILE     where to write the records in headless mode (default: stdout)
+--workers N        receive with N processes instead of one. Each binds the OSC port
+                   (SO_REUSEPORT: the kernel spreads the senders among them), decodes
+                   and keeps the latest value of each label, and publishes them in a
+                   table in shared memory, read by the display at each frame. For
+                   traffic from many senders. Does not use liblo, cannot --record and
+                   does not answer /print/stats
+--ratelimit HZ     headless mode: write at most HZ updates per second for each label. The
+                   latest value of a label is always written (default=0, no limit)
+--include PATTERN  show only the messages whose address, or label for /print, /print/fader,
+                   /print/vu, /print/percent and /print/config, matches PATTERN or is below
+                   it. An OSC pattern: ? * [abc] [!abc] {foo,bar}. /print/clear, /print/sort
+                   and /print/stats always pass. Can be given several times
+--exclude PATTERN  drop these messages, as soon as their address (or label) is read. For example
+                   --exclude /firmata --exclude 'MIDI/*' ignores all of /firmata/...
+                   and the labels MIDI/... Can be given several times
+
+KEYS:
+
+q  quit                     up/down, j/k    scroll one line
+r  refresh                  PgUp/PgDn/space scroll one page
+s  sort                     Home/End, g/G   go to the first/last line
+c  clear                    /               find a label (ENTER to jump, ESC to cancel)
+i  info: rates per label and per source, decode and render times
 
 Monitor the oscport and print messages
 --------------------------------------
@@ -36,6 +98,8 @@ path            args
                                        | or converts the line to a fader 
                 "range" label min max  | this is a synonim for "fader"
                 "remove" label         | remove the line if it exists
+                "history" label size   | keep the last `size` values of the label and show
+                                       | a sparkline and statistics (0 to disable)
                 "transform" label func | apply the given transform to the value before printing it
                                        | possible transforms are:
                                        |     * m2n      --> convert a midinote to its note representation
@@ -49,16 +113,36 @@ path            args
                                        | and shown as a VU meter with a range of -75 to 0 dB
 /print/clear    --                     | remove all lines
 /print/sort     --                     | sort the lines
+/print/stats    [port] [maxlabels]     | reply to the sender (at port, if given) with the stats:
+                                       |   /print/stats/total  packets/s bytes/s packets messages labels sources
+                                       |   /print/stats/counters name count [name count ...]
+                                       |     (packets, coalesced, frames, failed, ...)
+                                       |   /print/stats/source address msgs/s bytes/s age
+                                       |   /print/stats/label  label msgs/s bytes/s age
+                                       | for the busiest sources and labels (default: 100).
+                                       | Not answered with --workers, which do not pass on
+                                       | the address of the sender
 
                 
  
 """ % os.path.split(sys.argv[0])[1]
     sys.exit(0)
 
+# defaults, set from the command line by parse_args
 autosort = True
-
-if '--help' in sys.argv:
-    usage()
+autocalibrate = True
+FPS = 30
+RECORD = None
+HISTORY = 0
+WINDOW = 5
+OUTPUT = None
+OUTFILE = None
+RATELIMIT = 0
+BACKEND = None
+PORT = 31415
+WORKERS = 0
+INCLUDE = []
+EXCLUDE = []
 
 def getarg(arg):
     if arg in sys.argv:
@@ -68,35 +152,86 @@ def getarg(arg):
         out = False
     return out
 
-if getarg('--sort'):
-    autosort = True
-if getarg('--nosort'):
-    autosort = False
-if getarg('--autocalibrate'):
-    autocalibrate = True
-if getarg('--noautocalibrate'):
-    autocalibrate = False
-
-try:
-    PORT = int(sys.argv[1])
-except IndexError:
-    PORT = 31415
+def getoption(arg, default=None, convert=str):
+    if arg in sys.argv:
+        idx = sys.argv.index(arg)
+        try:
+            value = convert(sys.argv[idx+1])
+        except (IndexError, ValueError):
+            print "%s expects a value" % arg
+            sys.exit(0)
+        del sys.argv[idx:idx+2]
+        return value
+    return default
 
-screen = curses.initscr()
-curses.start_color()
-curses.use_default_colors()
-curses.init_color(curses.COLOR_BLACK, 113, 113, 113)
+def getoptions(arg, convert=str):
+    """the values of an option which can be given several times"""
+    values = []
+    while arg in sys.argv:
+        values.append(getoption(arg, convert=convert))
+    return values
 
-curses.init_pair(1, curses.COLOR_RED, curses.COLOR_BLACK)
-curses.init_pair(curses.COLOR_YELLOW, curses.COLOR_YELLOW, curses.COLOR_BLACK)
-curses.init_pair(curses.COLOR_GREEN, curses.COLOR_GREEN, curses.COLOR_BLACK)
-curses.init_pair(curses.COLOR_BLUE, curses.COLOR_BLUE, curses.COLOR_BLACK)
+def load_liblo():
+    global liblo
+    try:
+        import liblo
+    except ImportError:
+        liblo = None
+    return liblo
 
-screen.nodelay(1)
-curses.noecho()
-screen.keypad(1)
+def parse_args():
+    """parse sys.argv into the module settings (autosort, FPS, PORT, ...)"""
+    global autosort, autocalibrate, FPS, RECORD, HISTORY, WINDOW, OUTPUT, OUTFILE, RATELIMIT, BACKEND, PORT, WORKERS
+    global INCLUDE, EXCLUDE
+    if '--help' in sys.argv:
+        usage()
+    if getarg('--sort'):
+        autosort = True
+    if getarg('--nosort'):
+        autosort = False
+    if getarg('--autocalibrate'):
+        autocalibrate = True
+    if getarg('--noautocalibrate'):
+        autocalibrate = False
+    FPS = getoption('--fps', FPS, float)
+    RECORD = getoption('--record')
+    HISTORY = getoption('--history', HISTORY, int)
+    WINDOW = getoption('--window', WINDOW, float)
+    OUTPUT = getoption('--output')
+    OUTFILE = getoption('--outfile')
+    RATELIMIT = getoption('--ratelimit', RATELIMIT, float)
+    WORKERS = getoption('--workers', WORKERS, int)
+    INCLUDE = getoptions('--include')
+    EXCLUDE = getoptions('--exclude')
+    for pattern in INCLUDE + EXCLUDE:
+        try:
+            oscpattern.AddressTrie([pattern])
+        except oscpattern.OSCPatternError as e:
+            print "bad pattern: %s" % e
+            sys.exit(0)
+    if WORKERS and RECORD is not None:
+        print "--record can't be used with --workers"
+        sys.exit(0)
+    if OUTPUT is not None and OUTPUT not in ('jsonl', 'csv', 'tsv'):
+        print "output should be one of jsonl, csv, tsv"
+        sys.exit(0)
+    BACKEND = getoption('--backend')
+    if WORKERS:
+        BACKEND = 'select'
+    elif BACKEND is None:
+        BACKEND = 'liblo' if load_liblo() is not None else 'select'
+    elif BACKEND == 'liblo':
+        load_liblo()
+    if BACKEND not in ('liblo', 'select'):
+        print "backend should be one of liblo, select"
+        sys.exit(0)
+    try:
+        PORT = int(sys.argv[1])
+    except IndexError:
+        PORT = 31415
 
-screeny, screenx = screen.getmaxyx()
+screen = None
+screeny, screenx = 0, 0
 
 LABELWIDTH = 20
 CURSOR_EXCEPTIONS = [
@@ -120,13 +255,171 @@ def label_show_cursor(label):
         return False
     return True
 
+def amp2db(x):
+    """linear amplitude to dB. Silence is -240 dB"""
+    return 20 * log10(x) if x > 1e-12 else -240.
+
 def amp2vu(x):
     return amp2db(x*x)
 
 def normalize_label(label):
     return label.rstrip("_ ")
 
+_digits = re.compile(r'(\d+)')
+
+def natural_key(label):
+    """sort key, so that voice2 comes before voice10"""
+    parts = _digits.split(label.lower())
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+# sparkline glyphs, lowest to highest. Replaced by an ascii version in
+# init_screen if the terminal is not utf-8
+SPARKS = [c.encode('utf-8') for c in u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588']
+SPARKWIDTH = 24
+
+class History(object):
+    """
+    A ring buffer of the last `size` (time, value) pairs of a label.
+
+    The buffers are allocated once, adding a value does not allocate
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self.times = array('d', [0]) * size
+        self.values = array('d', [0]) * size
+        self.count = 0
+        self._idx = 0
+    def add(self, t, value):
+        idx = self._idx
+        self.times[idx] = t
+        self.values[idx] = value
+        self._idx = (idx + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+    def last(self, n):
+        """indexes of the last n entries, oldest first"""
+        n = min(n, self.count)
+        size, end = self.size, self._idx
+        return [(end - n + i) % size for i in xrange(n)]
+    def stats(self, window, now=None):
+        """
+        (min, max, mean, rate) of the values received in the last `window` seconds,
+        or None if there are none. rate is in values per second
+        """
+        if now is None:
+            now = time.time()
+        t0 = now - window
+        times, values = self.times, self.values
+        size = self.size
+        idx = self._idx
+        n = 0
+        total = 0.
+        lo = hi = None
+        oldest = now
+        for i in xrange(self.count):
+            idx = (idx - 1) % size
+            t = times[idx]
+            if t < t0:
+                break
+            v = values[idx]
+            if lo is None or v < lo:
+                lo = v
+            if hi is None or v > hi:
+                hi = v
+            total += v
+            n += 1
+            oldest = t
+        if not n:
+            return None
+        if n == self.count and n == size:
+            # the buffer does not reach back to the start of the window
+            span = max(now - oldest, 1e-9)
+        else:
+            span = window
+        return lo, hi, total / n, n / span
+    def sparkline(self, width=SPARKWIDTH):
+        idxs = self.last(width)
+        if not idxs:
+            return ""
+        values = self.values
+        ys = [values[i] for i in idxs]
+        lo, hi = min(ys), max(ys)
+        top = len(SPARKS) - 1
+        if hi - lo <= 0:
+            return SPARKS[top // 2] * len(ys)
+        scale = top / (hi - lo)
+        return "".join([SPARKS[int((y - lo) * scale + 0.5)] for y in ys])
+
+def compose(funcs):
+    """compose a chain of functions into one callable (None if there are none)"""
+    funcs = list(funcs)
+    if not funcs:
+        return None
+    if len(funcs) == 1:
+        return funcs[0]
+    first, rest = funcs[0], compose(funcs[1:])
+    return lambda value: rest(first(value))
+
+def truncate(text, width):
+    """cut text to width bytes, without cutting a multibyte glyph in half"""
+    if len(text) <= width:
+        return text
+    return text[:width].decode('utf-8', 'ignore').encode('utf-8')
+
+_nonascii = re.compile(r'[\x80-\xff]')
+
+def damage(old, new, gap=6):
+    """
+    old, new: the text drawn at the same place before and now
+
+    Returns the spans of new which differ from old, as a list of (start, end).
+    Spans less than gap cells apart are merged: moving the cursor costs about
+    as much as writing a few cells. If the length changed, everything after
+    the first difference is one span
+    """
+    # the common prefix and suffix are found by halving, the slices are compared in C
+    n = len(new)
+    lo, hi = 0, min(n, len(old))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[:mid] == new[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    start = lo
+    if len(old) != n:
+        return [(start, n)]
+    lo, hi = 0, n - start
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[n - mid:] == new[n - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    end = n - lo
+    spans = []
+    spanstart = start
+    same = 0
+    for i in xrange(start, end):
+        if old[i] != new[i]:
+            if same >= gap:
+                spans.append((spanstart, i - same))
+                spanstart = i
+            same = 0
+        else:
+            same += 1
+    spans.append((spanstart, end))
+    return spans
+
 class Line(object):
+    kind = "line"
+    # the Handler this line belongs to, notified when the line changes
+    owner = None
+    # a History, if the values of the line are kept
+    history = None
+    # a value was set which has not been drawn yet
+    _undrawn = False
     def __init__(self, label, line, value, isfooter=False):
         self.label = label
         self._labelstr = normalize_label(label).ljust(LABELWIDTH)[:LABELWIDTH]
@@ -134,43 +427,114 @@ class Line(object):
         self._value = value
         self.needsrefresh = True
         self._transforms = []
+        self._transform = None
         self._time_last_update = 0
         self.show_cursor = not isfooter and label_show_cursor(label)
         self.isfooter = isfooter
+        self._undrawn = not isfooter
         self.color = get_color(label)
+        # the formatted line, valid until the value changes
+        self._text = None
+        self._textwidth = None
     @property
     def value(self):
         return self._value
     @value.setter
     def value(self, newvalue):
-        if self._transforms:
-            for func in self._transforms:
-                newvalue = func(newvalue)
+        if self._undrawn and self.owner is not None:
+            # the value waiting to be drawn will never be
+            self.owner.coalesced += 1
+        if self._transform is not None:
+            newvalue = self._transform(newvalue)
+        if self.history is not None and isinstance(newvalue, (int, float)):
+            # the statistics change even if the value does not
+            self.history.add(time.time(), newvalue)
+            self.needsrefresh = True
         if newvalue != self._value:
             self._value = newvalue
+            self._text = None
             self.needsrefresh = True
             self._time_last_update = time.time()
+            self._undrawn = True
+    def set_transforms(self, funcs):
+        """the functions applied, in order, to each new value"""
+        self._transforms = list(funcs)
+        self._transform = compose(self._transforms)
+        self.invalidate()
+    def add_transform(self, func):
+        self.set_transforms(self._transforms + [func])
+    def invalidate(self):
+        """the formatted line is out of date"""
+        self._text = None
+        self.needsrefresh = True
+    @property
+    def needsrefresh(self):
+        return self._needsrefresh
+    @needsrefresh.setter
+    def needsrefresh(self, value):
+        self._needsrefresh = value
+        if value and self.owner is not None:
+            self.owner.markdirty(self)
     @property
     def line(self):
         return self._line
     @line.setter
     def line(self, newlinenumber):
+        oldlinenumber = self._line
         self._line = newlinenumber
+        if self.owner is not None:
+            self.owner.moved(self, oldlinenumber)
         self.needsrefresh = True
-    def __repr__(self):
+    def historystr(self):
+        """the sparkline and statistics of the history of this line"""
+        history = self.history
+        if history is None or not history.count:
+            return ""
+        stats = history.stats(WINDOW)
+        if stats is None:
+            return "  " + history.sparkline()
+        lo, hi, mean, rate = stats
+        return "  %s  min %.4g max %.4g mean %.4g %5.1f/s" % (history.sparkline(), lo, hi, mean, rate)
+    def format(self):
         if self.label:
             return "%s: %s" % (self._labelstr, tostr(self.value))
         else:
             return self.value
+    def render(self, width):
+        """
+        the line as drawn on a screen `width` columns wide. The text is only
+        formatted again when the value changed
+        """
+        text = self._text
+        if text is None or self._textwidth != width:
+            text = self._text = truncate(self.format(), width)
+            self._textwidth = width
+        if self.history is not None:
+            text = truncate(text + self.historystr(), width)
+        return text
+    def __repr__(self):
+        return self.format() + self.historystr()
 
 class Footer(Line):
+    def format(self):
+        return self.value
     def __repr__(self):
         return self.value
 
 def clip(x, x0, x1):
     return max(min(x, x1), x0)
 
+_bars = {}
+
+def fader_bars(width):
+    """all the bars of a fader `width` wide, indexed by the number of filled cells"""
+    bars = _bars.get(width)
+    if bars is None:
+        bars = _bars[width] = ["=" * n + " " * (width - n) for n in range(width + 1)]
+    return bars
+
 class LineFader(Line):
+    kind = "fader"
     def __init__(self, label, line, value, minvalue=0, maxvalue=1, width=30, autocalibrate=True):
         Line.__init__(self, label, line, value)
         self.set_range(minvalue, maxvalue)
@@ -180,9 +544,11 @@ class LineFader(Line):
         self.posttransforms = None
     @Line.value.setter
     def value(self, value):
-        if self._transforms:
-            for func in self._transforms:
-                value = func(value)
+        if self._transform is not None:
+            value = self._transform(value)
+        if self.history is not None and isinstance(value, (int, float)):
+            self.history.add(time.time(), value)
+            self.needsrefresh = True
         if value != self._value:
             if self.autocalibrate:
                 if self.autocalibrate == "up":
@@ -196,10 +562,12 @@ class LineFader(Line):
             else:
                 value = clip(value, self.minvalue, self.maxvalue)
             self._value = value
+            self._text = None
             self.needsrefresh = True
     def set_range(self, minvalue, maxvalue):
         self.minvalue = minvalue
         self.maxvalue = maxvalue
+        self.invalidate()
     def get_n(self):
         try:
             n = int((self.value - self.minvalue) / (self.maxvalue - self.minvalue) * self.width + 0.5)
@@ -207,21 +575,22 @@ class LineFader(Line):
             n = 0
         except ValueError:
             n = 0
+        except ZeroDivisionError:
+            n = 0
         return n
-
-    def __repr__(self):
-        n = self.get_n()
-        fader = "=" * n + " " * (self.width - n)
+    def format(self):
+        bars = fader_bars(self.width)
+        fader = bars[clip(self.get_n(), 0, self.width)]
         return "%s:  %s %s [%s]" % (self._labelstr, str(round(self.value, 2)).ljust(7), self.unit, fader)
 
 class VuFader(LineFader):
+    kind = "vu"
     def __init__(self, *args, **kws):
         LineFader.__init__(self, *args, **kws)
         self.width = 36
         self.autocalibrate = False
-        self._transforms = [amp2db]
-        self.minvalue = -72
-        self.maxvalue = 0
+        self.set_transforms([amp2db])
+        self.set_range(-72, 0)
         self.unit = "dB"
         self.show_cursor = False
         self.color = curses.COLOR_YELLOW
@@ -230,21 +599,23 @@ def percent(x):
     return int(x * 100)
 
 class PercentFader(LineFader):
+    kind = "percent"
     def __init__(self, *args, **kws):
         LineFader.__init__(self, *args, **kws)
         self.autocalibrate = False
-        self._transforms = [percent]
-        self.minvalue = 0
-        self.maxvalue = 100
+        self.set_transforms([percent])
+        self.set_range(0, 100)
         self.unit = "%"
 
+_padding = [" " * i for i in range(5)]
+
 def tostr(val):
     if isinstance(val, basestring):
         return val
     if val <= 1e-12:
         x = 0
     else:
-        x = max(0, int(log(val+1e-12, 10)))
+        x = max(0, int(log10(val+1e-12)))
     try:
         rst = val - int(val)
     except OverflowError:
@@ -252,30 +623,166 @@ def tostr(val):
     if rst < 1e-12:
         val = int(val)
     else:
-        aftercomma = 7 - x
-        val = round(val, aftercomma)
-    return " "*(4-x) + str(val)
+        val = round(val, 7 - x)
+    return (_padding[4-x] if x <= 4 else "") + str(val)
+
+def from_peach(name):
+    """
+    peach is slow to import and only needed for some transforms: it is
+    imported when one of these is configured. Without peach the loader
+    returns None, and the transform is ignored like an unknown one
+    """
+    def load():
+        try:
+            import peach
+        except ImportError:
+            return None
+        return getattr(peach, name)
+    return load
 
+# name -> a function returning the transform. Values are converted to float once,
+# at the start of the chain of transforms of a line (see Handler.lineconfig_transform)
 TRANSFORMS = {
-    'm2n':lambda value:m2n(float(value)),
-    'ampdb': lambda value:clip(amp2db(float(value)), -90, 0),
-    'amp2db': lambda value:clip(amp2db(float(value)), -90, 0),
-    'f2n': f2n
+    'm2n': from_peach('m2n'),
+    'ampdb': lambda: lambda value:clip(amp2db(value), -90, 0),
+    'amp2db': lambda: lambda value:clip(amp2db(value), -90, 0),
+    'f2n': from_peach('f2n')
 }
 
+FOOTER = 'OSC port: %d | (q)uit | (r)efresh | (s)ort | (c)lear | (/)find | (i)nfo'
+
 class Handler:
-    def __init__(self, autosort=autosort):
+    """
+    Keeps the lines and their layout:
+
+    lines    -- label -> Line
+    bynum    -- line number -> Line
+    dirty    -- the lines which changed since the last refresh, so that a
+                refresh only touches those
+    _labels  -- (natural_key, label) of all lines, kept sorted. A new label is
+                inserted with a binary search. With autosort the lines after it
+                are renumbered once, at the next refresh, so a burst of new
+                labels does not relayout the screen for each of them
+
+    The screen is a viewport over the lines, starting at line `top`. Only the
+    visible lines are formatted and drawn, changes to the other lines are
+    just kept until they are scrolled into view
+
+    onupdate, if set, is called with the line after each update received
+
+    _rows keeps the text drawn at each row of the screen. A line drawn again
+    only writes the cells which changed (see damage). written counts the
+    bytes given to the screen
+
+    coalesced counts the values replaced by a newer one before being drawn
+    """
+    def __init__(self, autosort=autosort, historysize=HISTORY, onupdate=None):
+        self.onupdate = onupdate
+        self.historysize = historysize
         self.maxy = screeny
+        self.maxx = screenx
+        self.top = 0
+        self.search = None
+        self._scrolled = False
+        self._position = None
+        self._rows = {}
+        self.written = 0
+        self.coalesced = 0
         self.initlines()
-        self.lastline = 0
         self.needsrefresh = True
         self.autosort = autosort
         self._cursor = 0
     def initlines(self):
         info = '__info__'
-        footer = Footer("__info__", self.maxy-1, 'OSC port: %d | (q)uit | (r)efresh | (s)ort | (c)lear' % PORT, isfooter=True)
-        self.lines = {info: footer}
+        self.lines = {}
+        self.bynum = {}
+        self.dirty = set()
+        self._labels = []
+        self._relayout_from = None
+        self._cleared = set()
+        self.lastline = 0
+        self.top = 0
+        footer = Footer("__info__", self.maxy-1, FOOTER % PORT, isfooter=True)
+        self.setline(info, footer)
         self.footer = footer
+    def setline(self, label, line):
+        """add a line for label, or replace the existing one (keeping its place)"""
+        old = self.lines.get(label)
+        if old is not None:
+            line.history = old.history
+            line._undrawn = old._undrawn
+            old.owner = None
+            self.dirty.discard(old)
+            if self.bynum.get(old.line) is old:
+                del self.bynum[old.line]
+        elif not line.isfooter:
+            if self.historysize:
+                self.sethistory(line, self.historysize)
+            key = (natural_key(label), label)
+            idx = bisect(self._labels, key)
+            self._labels.insert(idx, key)
+            if self.autosort:
+                self.relayout(idx)
+        self.lines[label] = line
+        line.owner = self
+        if not line.isfooter:
+            self.bynum[line.line] = line
+        line.needsrefresh = True
+    def removeline(self, label):
+        line = self.lines.pop(label, None)
+        if line is None or line.isfooter:
+            return
+        line.owner = None
+        self.dirty.discard(line)
+        if self.bynum.get(line.line) is line:
+            del self.bynum[line.line]
+        self._cleared.add(line.line)
+        key = (natural_key(label), label)
+        idx = bisect(self._labels, key) - 1
+        if 0 <= idx < len(self._labels) and self._labels[idx] == key:
+            del self._labels[idx]
+            if self.autosort:
+                self.relayout(idx)
+        self.needsrefresh = True
+    def sethistory(self, line, size):
+        if size <= 0:
+            line.history = None
+            return
+        line.history = History(size)
+        if isinstance(line.value, (int, float)):
+            line.history.add(time.time(), line.value)
+    def markdirty(self, line):
+        self.dirty.add(line)
+        self.needsrefresh = True
+    def moved(self, line, oldlinenumber):
+        if line.isfooter:
+            return
+        if self.bynum.get(oldlinenumber) is line:
+            del self.bynum[oldlinenumber]
+        self.bynum[line.line] = line
+    def relayout(self, start=0):
+        """renumber the lines from the sorted position start onwards, at the next refresh"""
+        if self._relayout_from is None or start < self._relayout_from:
+            self._relayout_from = start
+        self.needsrefresh = True
+    def layout(self):
+        """apply a pending relayout"""
+        start = self._relayout_from
+        if start is None:
+            return
+        self._relayout_from = None
+        lines = self.lines
+        labels = self._labels
+        for i in xrange(start, len(labels)):
+            line = lines[labels[i][1]]
+            if line.line != i:
+                line.line = i
+        numlines = len(labels)
+        # rows left empty after a removal
+        for row in xrange(numlines, self.lastline):
+            if row not in self.bynum:
+                self._cleared.add(row)
+        self.lastline = numlines
     def handle(self, label, values, linenum=None):
         if len(values) > 1:
             value = " ".join(tostr(v) for v in values)
@@ -285,98 +792,211 @@ class Handler:
         line = self.lines.get(label)
         if not line:
             linenum = linenum if linenum is not None else self.newline()
-            self.lines[label] = line = Line(label, linenum, value)
-            if self.autosort:
-                self.sort_lines()
+            line = Line(label, linenum, value)
+            self.setline(label, line)
         else:
             line.value = value
         # line.needsrefresh = True
         self.needsrefresh = True
+        if self.onupdate is not None:
+            self.onupdate(line)
         return line
     def newline(self):
         out = self.lastline
         self.lastline += 1
         return out
     def sort_lines(self):
-        lines = [(label, line) for label, line in self.lines.iteritems() if not line.isfooter]
-        # lines.sort()
-        lines = sort_natural(lines, key=lambda elem:elem[0])
-        for i, (label, line) in enumerate(lines):
-            line.line = i
-            line.needsrefresh = True
-        self.needsrefresh = True
+        self.relayout(0)
+        self.layout()
+    def height(self):
+        """number of rows available for lines (the last row is the footer)"""
+        return max(1, self.maxy - 1)
+    def resize(self, maxy, maxx):
+        self.maxy, self.maxx = maxy, maxx
+        self.footer.line = maxy - 1
+        self.scrollto(self.top)
+    def scrollto(self, top):
+        """make line `top` the first visible line"""
+        top = clip(top, 0, max(0, self.lastline - self.height()))
+        if top != self.top:
+            self.top = top
+            self._scrolled = True
+            self.needsrefresh = True
+    def scroll(self, numlines):
+        self.scrollto(self.top + numlines)
+    def page(self, numpages):
+        self.scroll(numpages * self.height())
+    def jump(self, text):
+        """scroll to the first line (in sort order) whose label contains text"""
+        text = text.lower()
+        for key, label in self._labels:
+            if text in label.lower():
+                linenum = self.lines[label].line
+                if not self.top <= linenum < self.top + self.height():
+                    self.scrollto(linenum - self.height() // 2)
+                return True
+        return False
+    def update_footer(self):
+        if self.search is not None:
+            text = "find: " + self.search
+        else:
+            text = FOOTER % PORT
+            height = self.height()
+            if self.lastline > height:
+                last = min(self.top + height, self.lastline)
+                text = "%s | %d-%d of %d" % (text, self.top + 1, last, self.lastline)
+        self.footer.value = text
+    def _drawline(self, line, row):
+        line._undrawn = False
+        text = line.render(max(0, self.maxx - 3))
+        color = line.color
+        old = self._rows.get(row)
+        self._rows[row] = (text, color)
+        if old is not None and old[1] == color:
+            oldtext = old[0]
+            if text != oldtext:
+                self._drawdamage(row, oldtext, text, color)
+            return
+        screen.move(row, LABELWIDTH)
+        screen.clrtoeol()
+        if color is not None:
+            screen.addstr(row, 2, text, curses.color_pair(color))
+        else:
+            screen.addstr(row, 2, text)
+        self.written += len(text)
+    def _drawdamage(self, row, oldtext, text, color):
+        """write only the cells of text which differ from oldtext, drawn there before"""
+        encoded = _nonascii.search(text) or _nonascii.search(oldtext)
+        if encoded:
+            # one cell per character, not per byte
+            text, oldtext = text.decode('utf-8', 'replace'), oldtext.decode('utf-8', 'replace')
+        for start, end in damage(oldtext, text):
+            cells = text[start:end]
+            if encoded:
+                cells = cells.encode('utf-8')
+            if color is not None:
+                screen.addstr(row, 2 + start, cells, curses.color_pair(color))
+            else:
+                screen.addstr(row, 2 + start, cells)
+            self.written += len(cells)
+        if len(text) < len(oldtext):
+            screen.move(row, 2 + len(text))
+            screen.clrtoeol()
     def refresh(self, force=False):
+        """
+        redraw the visible lines which changed since the last refresh (all
+        visible lines if force is True or after scrolling)
+
+        Returns the number of lines drawn
+        """
+        drawn = 0
+        if screen is None:
+            # headless
+            return drawn
         if force: 
             screen.clear()
+            self._rows.clear()
+        elif self._scrolled:
+            screen.erase()
+            self._rows.clear()
         if self.needsrefresh or force:
+            self.layout()
+            position = (self.top, self.lastline, self.maxy)
+            if position != self._position:
+                self._position = position
+                self.update_footer()
+            top, height = self.top, self.height()
             cursor = self._cursor
-            for line in self.lines.values():
-                if line.needsrefresh or force:
-                    screen.move(line.line, LABELWIDTH)
-                    screen.clrtoeol()
-                    if line.color is not None:
-                        screen.addstr(line.line, 2, str(line), curses.color_pair(line.color))
-                    else:
-                        screen.addstr(line.line, 2, str(line))
+            if force or self._scrolled:
+                bynum = self.bynum
+                lines = [bynum[num] for num in xrange(top, top + height) if num in bynum]
+                lines.append(self.footer)
+                self._scrolled = False
+                self._cursor = -1
+                for line in self.dirty:
+                    line._needsrefresh = False
+            else:
+                for num in self._cleared:
+                    if top <= num < top + height:
+                        screen.move(num - top, 0)
+                        screen.clrtoeol()
+                        self._rows.pop(num - top, None)
+                lines = self.dirty
+            self._cleared.clear()
+            for line in lines:
+                line._needsrefresh = False
+                if line.isfooter:
+                    row = line.line
+                else:
+                    row = line.line - top
+                    if row < 0 or row >= height:
+                        continue
                     if line.show_cursor:
                         cursor = line.line
-                    line.needsrefresh = False
+                drawn += 1
+                self._drawline(line, row)
+            self.dirty = set()
             if cursor != self._cursor:
-                screen.addstr(self._cursor, 0, " ")
+                if top <= self._cursor < top + height:
+                    screen.addstr(self._cursor - top, 0, " ")
                 self._cursor = cursor
-                screen.addstr(cursor, 0, ">", curses.color_pair(1))
+                if top <= cursor < top + height:
+                    screen.addstr(cursor - top, 0, ">", curses.color_pair(1))
 
-            screen.move(self.lastline+1, 0)
+            screen.move(min(self.lastline - top + 1, height), 0)
             screen.refresh()
             self.needsrefresh = False
+        return drawn
     def lineconfig(self, label, method, args):
         func = getattr(self, "lineconfig_" + method)
         if func is not None:
             func(label, *args)
     def lineconfig_linenum(self, label, num):
         line = self.getline(label)
-        if num > self.lastline:
-            self.lastline = num
-        else:
-            # is there someone with this line
-            oldline = [l for l in self.lines.itervalues() if l.line == num]
-            if oldline:
-                oldline = oldline[0]
-                oldline.line = line.line
-            line.line = num
-        
+        # is there someone with this line
+        oldline = self.bynum.get(num)
+        if oldline is not None and oldline is not line:
+            oldline.line = line.line
+        line.line = num
+        if num >= self.lastline:
+            self.lastline = num + 1
         self.refresh(force=True)
     def getline(self, label):
         line = self.lines.get(label)
         if line is None:
-            line = self.handle(label, "?")
+            line = Line(label, self.newline(), "?")
+            self.setline(label, line)
         return line
     def lineconfig_range(self, label, minvalue, maxvalue):
         return self.lineconfig_range(label, minvalue, maxvalue)
+    def lineconfig_history(self, label, size):
+        line = self.getline(label)
+        self.sethistory(line, int(size))
+        line.needsrefresh = True
     def lineconfig_remove(self, label):
-        self.lines.pop(label, None)
+        self.removeline(label)
     def lineconfig_transform(self, label, functionname):
-        func = TRANSFORMS.get(functionname)
+        transform = TRANSFORMS.get(functionname)
+        func = transform() if transform is not None else None
         line = self.getline(label)
         if line and func:
-            line._transforms.append(func)
-            line.needsrefresh = True
+            if not line._transforms:
+                line.add_transform(float)
+            line.add_transform(func)
             self.needsrefresh=True
     def lineconfig_fader(self, label, minvalue, maxvalue):
         line = self.getline(label)
         if isinstance(line, LineFader):
-            line.minvalue = minvalue
-            line.maxvalue = maxvalue
-            line.needsrefresh = True
+            line.set_range(minvalue, maxvalue)
         else:
             fader = LineFader(label, line.line, line.value, minvalue, maxvalue)
-            self.lines[label] = fader
+            self.setline(label, fader)
         self.needsrefresh=True
     def newfader(self, label, linenum, minvalue, maxvalue):
         if linenum == -1:
             linenum = self.newline()
         fader = LineFader(label, linenum, minvalue, minvalue, maxvalue)
-        self.lines[label] = fader
+        self.setline(label, fader)
         self.refresh(force=True)
     def printasfader(self, label, value, minvalue=None, maxvalue=None):
         line = self.getline(label)
@@ -389,30 +1009,392 @@ class Handler:
                 line.minvalue = minvalue
             if maxvalue:
                 line.maxvalue = maxvalue
-            self.lines[label] = line
+            self.setline(label, line)
         self.needsrefresh=True
+        if self.onupdate is not None:
+            self.onupdate(line)
     def printaspercent(self, label, value):
         line = self.getline(label)
         if isinstance(line, PercentFader):
             line.value = value
         else:
             line = PercentFader(label, line.line, value)
-            self.lines[label] = line
+            self.setline(label, line)
         self.needsrefresh=True
+        if self.onupdate is not None:
+            self.onupdate(line)
         
     def printasvu(self, label, value):
         line = self.getline(label)
         if isinstance(line, VuFader):
             line.value = value
         else:
-            vufader = VuFader(label, line.line, value)
-            self.lines[label] = vufader
+            line = VuFader(label, line.line, value)
+            self.setline(label, line)
         self.needsrefresh=True
+        if self.onupdate is not None:
+            self.onupdate(line)
     def clear(self, *args, **kws):
         self.initlines()
         self.refresh(force=True)
 
-handler = Handler()
+DRAWSHARE = 0.5
+MAXPERIOD = 0.5
+
+class RenderScheduler(object):
+    """
+    Decouples receiving from drawing: all pending packets are processed
+    before the screen is repainted, and repaints happen at most `fps` times
+    per second. Since each Line keeps only its latest value, updates to the same
+    label arriving between two frames are folded into one draw.
+
+    Counters:
+
+    packets   -- number of packets received
+    coalesced -- number of updates which never reached the screen because a newer
+                 value for the same label arrived before it was drawn (counted by
+                 the handler)
+    frames    -- number of repaints
+    frametime -- the average time a repaint takes
+
+    The rate is lowered when repaints take long, so that drawing takes at most
+    DRAWSHARE of the time, down to one repaint every MAXPERIOD seconds. What
+    takes long is mostly writing to the terminal, so the rate follows what it
+    can take
+
+    stats: a Stats. Frames are timed, and when its panel is visible it is drawn
+           twice a second in place of the lines. The counters are shown there.
+           Kept as statspanel: stats() gives the counters
+    """
+    def __init__(self, handler, fps=FPS, stats=None):
+        self.handler = handler
+        self.statspanel = stats
+        if stats is not None:
+            stats.register(self.stats)
+        self.period = 1.0 / fps if fps > 0 else 0
+        self.packets = 0
+        self.frames = 0
+        self.frametime = 0.
+        self._nextframe = 0
+    @property
+    def coalesced(self):
+        return getattr(self.handler, 'coalesced', 0)
+    def pending(self):
+        """is there anything to draw"""
+        return self.handler.needsrefresh or (self.statspanel is not None and self.statspanel.visible)
+    def timeout(self):
+        """seconds left until the next frame is due"""
+        return max(0, self._nextframe - time.time())
+    def drain(self, recv, timeout=0):
+        """
+        recv: a function (timeout_ms) -> bool, like liblo.Server.recv. It can also
+              return the number of packets processed, if it handles more than one per call
+        timeout: how long to wait for the first packet, in ms
+
+        wait for a packet and then process everything pending without blocking.
+        Returns the number of packets processed
+        """
+        n = int(recv(timeout))
+        if not n:
+            return 0
+        while True:
+            k = int(recv(0))
+            if not k:
+                break
+            n += k
+        self.packets += n
+        return n
+    def frame(self, force=False):
+        """
+        repaint if a frame is due (or force is True). Returns True if the screen was repainted
+        """
+        now = time.time()
+        stats = self.statspanel
+        if stats is not None:
+            stats.tick(now)
+            if stats.visible:
+                if now < self._nextframe:
+                    return False
+                stats.draw(self.handler.maxy, self.handler.maxx)
+                self._nextframe = now + 0.5
+                return True
+        if not force and (now < self._nextframe or not self.handler.needsrefresh):
+            return False
+        self.handler.refresh(force=force)
+        dur = time.time() - now
+        if stats is not None:
+            stats.render.add(dur)
+        self.frames += 1
+        # writing blocks when the terminal can't keep up (a slow ssh link):
+        # frames get longer, and are then drawn less often
+        self.frametime += (dur - self.frametime) * 0.2
+        self._nextframe = now + min(max(self.period, self.frametime / DRAWSHARE), max(self.period, MAXPERIOD))
+        return True
+    def stats(self):
+        return OrderedDict([('packets', self.packets), ('coalesced', self.coalesced), ('frames', self.frames)])
+
+class Histogram(object):
+    """durations, counted in power of two buckets of microseconds"""
+    def __init__(self, numbuckets=32):
+        self.counts = [0] * numbuckets
+        self.total = 0
+    def add(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.total += 1
+    def percentile(self, p):
+        """the upper bound, in microseconds, of the bucket where percentile p falls"""
+        if not self.total:
+            return 0
+        target = self.total * p / 100.
+        acc = 0
+        for bucket, count in enumerate(self.counts):
+            acc += count
+            if acc >= target:
+                return 1 << bucket
+        return 1 << (len(self.counts) - 1)
+    def __str__(self):
+        if not self.total:
+            return "-"
+        return "p50 <%dus  p90 <%dus  p99 <%dus" % tuple(self.percentile(p) for p in (50, 90, 99))
+
+def human(x):
+    """1234567 -> 1.2M"""
+    for unit in ("", "K", "M", "G"):
+        if abs(x) < 1000:
+            return ("%.0f%s" if unit == "" else "%.1f%s") % (x, unit)
+        x /= 1000.
+    return "%.1fT" % x
+
+class Stats(object):
+    """
+    What is being received, per label, per source and in total, and how long
+    decoding and rendering take
+
+    labels  -- label -> [messages, bytes, last update, messages/s, bytes/s, ...]
+    sources -- (host, port) -> the same, counting packets
+    decode  -- Histogram of the time to decode a batch of packets
+    render  -- Histogram of the time to draw a frame
+    source  -- the address of the packet being dispatched, where /print/stats replies go.
+               Set by the receiver before dispatching each packet
+    counters -- functions returning the counters of the other parts (scheduler,
+                receiver) as a dict name -> count. See register
+
+    Collecting costs a few dict operations per message. Rates are computed
+    once per second, in tick. Bytes of a packet are split evenly among its
+    messages. The liblo backend does not give the size of packets
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.messages = 0
+        self.packetrate = 0
+        self.byterate = 0
+        self.labels = {}
+        self.sources = {}
+        self.decode = Histogram()
+        self.render = Histogram()
+        self.source = None
+        self.counters = []
+        self.visible = False
+        self._sock = None
+        self._last = (time.time(), 0, 0)
+    def register(self, counters):
+        """counters: a function returning a dict name -> count, shown in the panel and the reply"""
+        self.counters.append(counters)
+    def allcounters(self):
+        out = OrderedDict()
+        for counters in self.counters:
+            out.update(counters())
+        return out
+    def packet(self, messages, size, address, now):
+        """messages: the (path, args) decoded from one packet, about to be dispatched"""
+        self.batch([(messages, size, address)], now)
+        self.source = address
+    def batch(self, packets, now):
+        """packets: a list of (messages, size, address), as returned by BatchReceiver.decode_each"""
+        sources, labels, valuepaths = self.sources, self.labels, VALUE_KINDS
+        lastaddress = source = None
+        nummessages = numbytes = 0
+        for messages, size, address in packets:
+            numbytes += size
+            if address != lastaddress or source is None:
+                source = sources.get(address)
+                if source is None:
+                    source = sources[address] = [0, 0, now, 0, 0, 0, 0]
+                source[2] = now
+                lastaddress = address
+            source[0] += 1
+            source[1] += size
+            if not messages:
+                continue
+            nummessages += len(messages)
+            share = float(size) / len(messages)
+            for path, args in messages:
+                label = args[0] if args and path in valuepaths else path
+                entry = labels.get(label)
+                if entry is None:
+                    entry = labels[label] = [0, 0, now, 0, 0, 0, 0]
+                entry[0] += 1
+                entry[1] += share
+                entry[2] = now
+        self.packets += len(packets)
+        self.bytes += numbytes
+        self.messages += nummessages
+    def tick(self, now):
+        """update the rates, at most once per second. Returns True if they were updated"""
+        t0, packets, numbytes = self._last
+        dt = now - t0
+        if dt < 1:
+            return False
+        self.packetrate = (self.packets - packets) / dt
+        self.byterate = (self.bytes - numbytes) / dt
+        self._last = (now, self.packets, self.bytes)
+        for table in (self.labels, self.sources):
+            for entry in table.itervalues():
+                entry[3] = (entry[0] - entry[5]) / dt
+                entry[4] = (entry[1] - entry[6]) / dt
+                entry[5], entry[6] = entry[0], entry[1]
+        return True
+    def top(self, table, n):
+        """the n busiest entries of table (labels or sources), as (key, entry)"""
+        items = sorted(table.iteritems(), key=lambda item: item[1][3], reverse=True)
+        return items[:n]
+    def draw(self, maxy, maxx):
+        """draw the stats panel, in place of the lines"""
+        now = time.time()
+        rows = [
+            "STATS   packets/s %s  bytes/s %s  packets %d  messages %d  labels %d  sources %d   (i) back" % (
+                human(self.packetrate), human(self.byterate), self.packets, self.messages,
+                len(self.labels), len(self.sources)),
+            "decode/batch  %s      render/frame  %s" % (self.decode, self.render),
+            "  ".join("%s %d" % item for item in self.allcounters().iteritems()),
+            "",
+            "%-32s %10s %10s %8s" % ("SOURCE", "msgs/s", "bytes/s", "age")
+        ]
+        for address, entry in self.top(self.sources, 5):
+            name = "%s:%s" % address if address is not None else "(workers)"
+            rows.append("%-32s %10s %10s %7.1fs" % (name, human(entry[3]), human(entry[4]), now - entry[2]))
+        rows.append("")
+        rows.append("%-32s %10s %10s %8s" % ("LABEL", "msgs/s", "bytes/s", "age"))
+        for label, entry in self.top(self.labels, max(0, maxy - 1 - len(rows))):
+            rows.append("%-32s %10s %10s %7.1fs" % (str(label)[:32], human(entry[3]), human(entry[4]), now - entry[2]))
+        screen.erase()
+        for y, row in enumerate(rows[:maxy - 1]):
+            screen.addstr(y, 0, row[:maxx - 1])
+        screen.refresh()
+    def reply(self, address, maxlabels=100):
+        """send the stats to address, as OSC messages"""
+        if address is None:
+            return
+        if self._sock is None:
+            self._sock = osccodec.udpsocket()
+        sendto = self._sock.sendto
+        now = time.time()
+        encode = osccodec.encode
+        sendto(encode('/print/stats/total', float(self.packetrate), float(self.byterate), self.packets, self.messages,
+                      len(self.labels), len(self.sources)), address)
+        counters = []
+        for name, count in self.allcounters().iteritems():
+            counters.extend((name, int(count)))
+        if counters:
+            sendto(encode('/print/stats/counters', *counters), address)
+        for source, entry in self.top(self.sources, maxlabels):
+            name = "%s:%s" % source if source is not None else "(workers)"
+            sendto(encode('/print/stats/source', name, float(entry[3]), float(entry[4]), now - entry[2]), address)
+        for label, entry in self.top(self.labels, maxlabels):
+            sendto(encode('/print/stats/label', str(label), float(entry[3]), float(entry[4]), now - entry[2]), address)
+
+class StreamOutput(object):
+    """
+    Headless output: writes each update of the handler as a record
+
+    fmt: one of 'jsonl', 'csv', 'tsv'
+    out: a file open for writing
+    ratelimit: max. records per second for each label (0: no limit). An update
+               arriving too soon after the last record of its label is kept
+               pending, only the latest pending value is written, when its time
+               comes, with the time it was received
+
+    Records are collected and written in one call at each flush. It has the
+    interface of a Handler as seen by a RenderScheduler (needsrefresh, refresh),
+    so that flushes are paced like frames
+
+    Counters:
+
+    records -- number of records written
+    limited -- number of updates never written because of the rate limit. The
+               scheduler reports them as coalesced
+    """
+    columns = ('time', 'label', 'type', 'value', 'min', 'max')
+    def __init__(self, fmt='jsonl', out=sys.stdout, ratelimit=0, bufsize=1000):
+        self.out = out
+        self.period = 1.0 / ratelimit if ratelimit > 0 else 0
+        self.bufsize = bufsize
+        self.records = 0
+        self.limited = 0
+        self._buffer = []
+        self._lastsent = {}
+        # line -> the time of its latest update, not written yet
+        self._pending = {}
+        if fmt == 'jsonl':
+            self._format = self._jsonl
+        else:
+            # csv.writer writes each row to the buffer
+            self._writer = csv.writer(self, delimiter='\t' if fmt == 'tsv' else ',', lineterminator='\n')
+            self._format = self._writer.writerow
+            self._writer.writerow(self.columns)
+    @property
+    def coalesced(self):
+        return self.limited
+    def write(self, text):
+        self._buffer.append(text)
+    def record(self, line, t):
+        if isinstance(line, LineFader):
+            return (t, line.label, line.kind, line.value, line.minvalue, line.maxvalue)
+        return (t, line.label, line.kind, line.value, None, None)
+    def _jsonl(self, record):
+        self._buffer.append(json.dumps(OrderedDict(zip(self.columns, record)), default=str) + "\n")
+    def update(self, line):
+        now = time.time()
+        if self.period:
+            if now - self._lastsent.get(line.label, 0) < self.period:
+                if line in self._pending:
+                    self.limited += 1
+                self._pending[line] = now
+                return
+            self._lastsent[line.label] = now
+            self._pending.pop(line, None)
+        self._format(self.record(line, now))
+        self.records += 1
+        if len(self._buffer) >= self.bufsize:
+            self.flush()
+    @property
+    def needsrefresh(self):
+        return bool(self._buffer or self._pending)
+    def refresh(self, force=False):
+        """write the pending records. Returns the number of records written"""
+        if self._pending:
+            now = time.time()
+            lastsent, period = self._lastsent, self.period
+            for line, received in self._pending.items():
+                if force or now - lastsent.get(line.label, 0) >= period:
+                    del self._pending[line]
+                    lastsent[line.label] = now
+                    self._format(self.record(line, received))
+                    self.records += 1
+        return self.flush()
+    def flush(self):
+        n = len(self._buffer)
+        if n:
+            self.out.write("".join(self._buffer))
+            self.out.flush()
+            self._buffer = []
+        return n
+    def close(self):
+        self.refresh(force=True)
+        if self.out is not sys.stdout:
+            self.out.close()
 
 def printfunc(path, values):
     handler.handle(values[0], values[1:])
@@ -423,55 +1405,549 @@ def lineconfig(path, values):
 def defaultfunc(path, values):
     handler.handle(path, values)
 
-s = liblo.Server(port=31415)
-s.add_method('/print', typespec=None, func=printfunc)
+def statsfunc(path, values):
+    """/print/stats [port] [maxlabels]: reply to the sender (at port, if given)"""
+    if stats is None or stats.source is None:
+        return
+    address = stats.source
+    if values:
+        address = (address[0], int(values[0]))
+    stats.reply(address, *[int(v) for v in values[1:2]])
 
-s.add_method('/print/lineconfig', typespec=None, func=lineconfig)
-s.add_method('/print/config', typespec=None, func=lineconfig)
-s.add_method('/print/fader', typespec=None, func=lambda path, values: handler.printasfader(*values))
-s.add_method('/print/vu', typespec=None, func=lambda path, values: handler.printasvu(*values))
-s.add_method('/print/clear', typespec=None, func=handler.clear)
-s.add_method('/print/sort', typespec=None, func=lambda *args, **kws: handler.sort_lines())
-s.add_method('/print/percent', typespec=None, func=lambda path, values: handler.printaspercent(*values))
-s.add_method(None, None, func=defaultfunc)
+METHODS = [
+    ('/print',            printfunc),
+    ('/print/stats',      statsfunc),
+    ('/print/lineconfig', lineconfig),
+    ('/print/config',     lineconfig),
+    ('/print/fader',      lambda path, values: handler.printasfader(*values)),
+    ('/print/vu',         lambda path, values: handler.printasvu(*values)),
+    ('/print/clear',      lambda path, values: handler.clear()),
+    ('/print/sort',       lambda path, values: handler.sort_lines()),
+    ('/print/percent',    lambda path, values: handler.printaspercent(*values))
+]
+
+# path -> the index of the label among the arguments: --include and --exclude apply
+# to it. The messages with None concern all labels, --include lets them through
+LABEL_PATHS = {
+    '/print':            0,
+    '/print/fader':      0,
+    '/print/vu':         0,
+    '/print/percent':    0,
+    '/print/config':     1,
+    '/print/lineconfig': 1,
+    '/print/clear':      None,
+    '/print/sort':       None,
+    '/print/stats':      None
+}
+
+def make_dispatcher(methods=METHODS, default=defaultfunc, include=(), exclude=()):
+    return oscpattern.Dispatcher(methods, default, include, exclude, keypaths=LABEL_PATHS)
+
+def liblo_server(port, recorder=None, stats=None, include=(), exclude=()):
+    s = liblo.Server(port=port)
+    if stats is not None:
+        # registered first and returning True, like record below. liblo hands
+        # over messages, not packets: each message counts as a packet of unknown size
+        def collect(path, args, types, src):
+            stats.packet([(path, args)], 0, (src.hostname, src.port), time.time())
+            return True
+        s.add_method(None, None, func=collect)
+    if recorder is not None:
+        # liblo does not give access to the raw packet: registered first, this
+        # method sees every message and reencodes it. Returning True lets
+        # liblo go on dispatching to the other methods
+        encoders = {}
+        def record(path, args, types):
+            enc = encoders.get((path, types))
+            if enc is None:
+                enc = encoders[(path, types)] = osccodec.Encoder(path, types)
+            try:
+                recorder.write(enc(*args))
+            except (ValueError, TypeError, struct.error):
+                pass
+            return True
+        s.add_method(None, None, func=record)
+    # liblo has decoded the message already, the filters only spare the rest
+    dispatcher = make_dispatcher(include=include, exclude=exclude)
+    dispatch = dispatcher.dispatch
+    failed = [0]
+    def dispatch_message(path, args):
+        # as in UDPReceiver.dispatch: a malformed message is skipped, and counted
+        try:
+            dispatch(path, args)
+        except Exception:
+            failed[0] += 1
+    s.add_method(None, None, func=dispatch_message)
+    if stats is not None:
+        stats.register(lambda: OrderedDict([('failed', failed[0]), ('filtered', dispatcher.dropped)]))
+    return s
+
+# ------------------------------------------------------------------
+# select backend: a plain UDP socket, no liblo needed
+# ------------------------------------------------------------------
+
+class UDPReceiver(object):
+    """
+    A liblo-free OSC server. recv has the same semantics as liblo.Server.recv,
+    so it can be used with RenderScheduler.drain. The socket is non-blocking and
+    can be waited on with select together with other file descriptors.
+
+    Each call to recv drains all pending datagrams at once (see osccodec.BatchReceiver)
+    and returns the number of packets dispatched
+
+    include, exclude: address patterns, see oscpattern.Dispatcher. Messages
+                      filtered out by their address are dropped before decoding
+                      their arguments (they are still recorded)
+
+    failed: the number of messages whose handler raised an exception (wrong
+            arguments, for example an empty /print/fader). They are skipped
+
+    The counters (failed, undecodable, filtered) are registered with stats
+    """
+    def __init__(self, port, methods=METHODS, default=defaultfunc, batchsize=64, recorder=None, stats=None,
+                 include=(), exclude=()):
+        self.stats = stats
+        self.sock = osccodec.udpsocket(port)
+        self.port = port
+        self.receiver = osccodec.BatchReceiver(self.sock, batchsize=batchsize)
+        self.dispatcher = make_dispatcher(methods, default, include, exclude)
+        self.accept = self.dispatcher.accept_address if self.dispatcher.filtered else None
+        self.recorder = recorder
+        self.failed = 0
+        if stats is not None:
+            stats.register(self.counters)
+    @property
+    def errors(self):
+        return self.receiver.errors
+    def counters(self):
+        return OrderedDict([('failed', self.failed), ('undecodable', self.receiver.errors), ('filtered', self.dispatcher.dropped)])
+    def fileno(self):
+        return self.sock.fileno()
+    def dispatch(self, messages):
+        dispatch = self.dispatcher.dispatch
+        for path, values in messages:
+            # a malformed message must not take down the display, nor the rest of the batch
+            try:
+                dispatch(path, values)
+            except Exception:
+                self.failed += 1
+    def recv(self, timeout=0):
+        """
+        timeout: in ms. Returns the number of packets received and dispatched
+        """
+        receiver = self.receiver
+        n = receiver.recv_batch()
+        if not n and timeout:
+            r, _, _ = select.select([self.sock], [], [], timeout / 1000.)
+            if r:
+                n = receiver.recv_batch()
+        if n:
+            if self.recorder is not None:
+                write = self.recorder.write
+                for buf, size, address in receiver.packets():
+                    write(buf, size)
+            stats = self.stats
+            if stats is None:
+                self.dispatch(receiver.decode_batch(accept=self.accept))
+                return n
+            t0 = time.time()
+            packets = receiver.decode_each(accept=self.accept)
+            now = time.time()
+            stats.decode.add(now - t0)
+            stats.batch(packets, now)
+            dispatch = self.dispatch
+            for messages, size, address in packets:
+                # a /print/stats in this packet replies to its sender
+                stats.source = address
+                dispatch(messages)
+        return n
+    def close(self):
+        self.sock.close()
+
+# ------------------------------------------------------------------
+# workers: several processes receive, the display reads a shared table
+# ------------------------------------------------------------------
+
+VALUE_KINDS = {
+    '/print':         sharedtable.KIND_PRINT,
+    '/print/fader':   sharedtable.KIND_FADER,
+    '/print/vu':      sharedtable.KIND_VU,
+    '/print/percent': sharedtable.KIND_PERCENT
+}
+
+KIND_PATHS = dict((kind, path) for path, kind in VALUE_KINDS.items())
+
+KIND_METHODS = {
+    sharedtable.KIND_PRINT:   lambda label, value, lo, hi: handler.handle(label, [value]),
+    sharedtable.KIND_FADER:   lambda label, value, lo, hi: handler.printasfader(label, value, lo, hi),
+    sharedtable.KIND_VU:      lambda label, value, lo, hi: handler.printasvu(label, value),
+    sharedtable.KIND_PERCENT: lambda label, value, lo, hi: handler.printaspercent(label, value)
+}
+
+def coalesce(messages, latest, control, accept=None):
+    """
+    fold messages into latest: label -> (kind, value, min, max), keeping only the
+    last value of each label. Messages which are not values (config, clear, ...)
+    are passed to control(path, args), in order. The values folded so far were
+    received before it
+
+    accept: a function (path, args) -> bool, messages it rejects are skipped
+    """
+    for path, args in messages:
+        if accept is not None and not accept(path, args):
+            continue
+        kind = VALUE_KINDS.get(path)
+        if kind is None:
+            if path.startswith('/print') or oscpattern.ispattern(path):
+                # a pattern can reach any method: dispatched by the display
+                control(path, args)
+                continue
+            # default handler: the path is the label
+            kind, label, values = sharedtable.KIND_PRINT, path, args
+        elif not args:
+            continue
+        else:
+            label, values = args[0], args[1:]
+        if not values:
+            continue
+        if kind == sharedtable.KIND_PRINT:
+            value = values[0] if len(values) == 1 else " ".join(tostr(v) for v in values)
+            latest[label] = (kind, value, None, None)
+        elif kind == sharedtable.KIND_FADER and len(values) >= 3:
+            latest[label] = (kind, values[0], values[1], values[2])
+        else:
+            latest[label] = (kind, values[0], None, None)
+
+def receive_worker(port, table, queue, doorbell, batchsize=64, include=(), exclude=()):
+    """
+    the loop of a worker process: receive, filter, coalesce, publish and ring the
+    doorbell (a pipe the display waits on)
+
+    What goes through the queue is stamped by the table, like the values, and
+    the display applies both in the order of their stamps. A control message
+    is put in the queue before any later value is published, and after the
+    values received before it: those are published first
+    """
+    # CTRL-C is for the display process, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sock = osccodec.udpsocket(port, reuseport=True)
+    receiver = osccodec.BatchReceiver(sock, batchsize=batchsize)
+    filters = make_dispatcher(include=include, exclude=exclude)
+    if filters.filtered:
+        accept, accept_message = filters.accept_address, filters.accept_message
+    else:
+        accept = accept_message = None
+    latest = {}
+    put, stamp = queue.put, table.stamp
+    def publish():
+        for label in table.publish(latest):
+            # too long, does not fit or no room left: send it the slow way
+            kind, value, lo, hi = latest[label]
+            args = [label, value] if lo is None else [label, value, lo, hi]
+            put((stamp(), KIND_PATHS[kind], args))
+        latest.clear()
+    def control(path, args):
+        if latest:
+            publish()
+        put((stamp(), path, args))
+    while True:
+        select.select([sock], [], [], 1.0)
+        received = False
+        while receiver.recv_batch():
+            coalesce(receiver.decode_batch(accept=accept), latest, control, accept_message)
+            received = True
+        if not received:
+            continue
+        if latest:
+            publish()
+        try:
+            os.write(doorbell, '\x01')
+        except OSError as e:
+            # the pipe is full: the display has not read it yet, which is just as good
+            if e.errno != errno.EAGAIN:
+                raise
+
+class SharedReceiver(object):
+    """
+    The display side of the workers. recv has the semantics of UDPReceiver.recv
+    (and liblo.Server.recv): it returns the number of labels updated, and
+    fileno can be waited on with select
+
+    numworkers: number of worker processes
+    capacity: the max. number of labels in the shared table. Labels beyond that,
+              and values which do not fit in it (long text), are passed through
+              a queue with the control messages, one message at a time. The queue is a
+              pipe written to by put itself (not by a feeder thread, like
+              multiprocessing.Queue), so a message can be read as soon as the
+              doorbell rings
+    include, exclude: address patterns, applied by the workers
+
+    failed: as in UDPReceiver, for the messages passed through the queue. It
+            is registered with stats
+    """
+    def __init__(self, port, numworkers, capacity=4096, methods=METHODS, default=defaultfunc, batchsize=64, stats=None,
+                 include=(), exclude=()):
+        import multiprocessing, multiprocessing.queues
+        self.stats = stats
+        self.port = port
+        self.table = sharedtable.SharedTable(capacity)
+        self.queue = multiprocessing.queues.SimpleQueue()
+        self.dispatcher = make_dispatcher(methods, default)
+        self.failed = 0
+        if stats is not None:
+            stats.register(lambda: {'failed': self.failed})
+        self._bell, doorbell = os.pipe()
+        for fd in (self._bell, doorbell):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.workers = []
+        for i in range(numworkers):
+            worker = multiprocessing.Process(target=receive_worker,
+                                             args=(port, self.table, self.queue, doorbell, batchsize, include, exclude))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        os.close(doorbell)
+    def fileno(self):
+        return self._bell
+    def recv(self, timeout=0):
+        """
+        timeout: in ms. Returns the number of labels and messages dispatched
+        """
+        if timeout:
+            select.select([self._bell], [], [], timeout / 1000.)
+        try:
+            os.read(self._bell, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        # the table first: a message in the queue is there before any value stamped after it
+        changes = self.table.changes()
+        queue = self.queue
+        messages = []
+        while not queue.empty():
+            messages.append(queue.get())
+        stats = self.stats
+        if stats is not None and changes:
+            # only the latest value of each label gets here, from unknown sources
+            stats.packet([(KIND_PATHS[kind], [label]) for label, kind, value, lo, hi, serial in changes], 0, None, time.time())
+        if not messages:
+            for label, kind, value, lo, hi, serial in changes:
+                KIND_METHODS[kind](label, value, lo, hi)
+            return len(changes)
+        events = [(change[5], change, None) for change in changes]
+        events.extend((serial, None, (path, values)) for serial, path, values in messages)
+        events.sort(key=lambda event: event[0])
+        dispatch = self.dispatcher.dispatch
+        for serial, change, message in events:
+            if change is not None:
+                label, kind, value, lo, hi, serial = change
+                KIND_METHODS[kind](label, value, lo, hi)
+                continue
+            try:
+                dispatch(*message)
+            except Exception:
+                self.failed += 1
+        return len(events)
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        os.close(self._bell)
+
+def init_screen():
+    global screen, screeny, screenx, SPARKS
+    locale.setlocale(locale.LC_ALL, '')
+    if locale.getpreferredencoding().lower().replace('-', '') != 'utf8':
+        SPARKS = list("_.-=+*#@")
+    screen = curses.initscr()
+    curses.start_color()
+    curses.use_default_colors()
+    curses.init_color(curses.COLOR_BLACK, 113, 113, 113)
+
+    curses.init_pair(1, curses.COLOR_RED, curses.COLOR_BLACK)
+    curses.init_pair(curses.COLOR_YELLOW, curses.COLOR_YELLOW, curses.COLOR_BLACK)
+    curses.init_pair(curses.COLOR_GREEN, curses.COLOR_GREEN, curses.COLOR_BLACK)
+    curses.init_pair(curses.COLOR_BLUE, curses.COLOR_BLUE, curses.COLOR_BLACK)
+
+    screen.nodelay(1)
+    curses.noecho()
+    screen.keypad(1)
+
+    screeny, screenx = screen.getmaxyx()
+    return screen
 
 def exit(msg=""):
-    global s
-    del s
-    curses.endwin()
-    print msg
+    global server, recorder, output
+    if server is not None:
+        if hasattr(server, 'close'):
+            server.close()
+        server = None
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+    if output is not None:
+        try:
+            output.close()
+        except IOError:
+            pass
+        output = None
+    if screen is not None:
+        curses.endwin()
+    if msg:
+        print msg
     sys.exit(0)
 
-if __name__ == '__main__':
-    try:
-        screen.refresh()
-        R = ord("r")
-        S = ord("s")
-        Q = ord("q")
-        C = ord("c")
-        recv = s.recv
-        getch = screen.getch
-        REFRESH = curses.KEY_REFRESH
-        handler_refresh = handler.refresh
-        while True:
-            c = getch()
-            if   c == Q:  # (q)uit
+def handle_key(c):
+    global screen
+    if handler.search is not None:
+        handle_search_key(c)
+    elif c == ord("q"):  # (q)uit
+        exit()
+    elif c == ord("r") or c == curses.KEY_RESIZE:  # (r)efresh
+        curses.endwin()
+        screen = curses.initscr()
+        maxy, maxx = screen.getmaxyx()
+        handler.resize(maxy, maxx)
+        handler.refresh(force=True)
+    elif c == ord("s"):  # (s)ort
+        handler.sort_lines()
+        handler.refresh(force=True)
+    elif c == ord("c"):  # (c)lear
+        handler.clear()
+    elif c == curses.KEY_UP or c == ord("k"):
+        handler.scroll(-1)
+    elif c == curses.KEY_DOWN or c == ord("j"):
+        handler.scroll(1)
+    elif c == curses.KEY_PPAGE:
+        handler.page(-1)
+    elif c == curses.KEY_NPAGE or c == ord(" "):
+        handler.page(1)
+    elif c == curses.KEY_HOME or c == ord("g"):
+        handler.scrollto(0)
+    elif c == curses.KEY_END or c == ord("G"):
+        handler.scrollto(handler.lastline)
+    elif c == ord("i"):  # (i)nfo: the stats panel
+        stats.visible = not stats.visible
+        if not stats.visible:
+            handler.refresh(force=True)
+    elif c == ord("/"):  # find a label
+        handler.search = ""
+        handler.update_footer()
+
+def handle_search_key(c):
+    if c in (10, 13, curses.KEY_ENTER):
+        text, handler.search = handler.search, None
+        if text:
+            handler.jump(text)
+        handler.update_footer()
+    elif c == 27:  # ESC
+        handler.search = None
+        handler.update_footer()
+    elif c in (curses.KEY_BACKSPACE, 127, 8):
+        handler.search = handler.search[:-1]
+        handler.update_footer()
+    elif 32 <= c < 127:
+        handler.search += chr(c)
+        handler.update_footer()
+
+def loop_liblo(server, scheduler):
+    recv = server.recv
+    getch = screen.getch
+    drain, frame = scheduler.drain, scheduler.frame
+    while True:
+        c = getch()
+        if c != -1:
+            handle_key(c)
+        # block at most until the next frame is due, so that keyboard
+        # handling and repaints keep their pace under load. With nothing
+        # to draw there is no deadline, only the keyboard to poll
+        drain(recv, min(50, int(scheduler.timeout() * 1000)) if scheduler.pending() else 50)
+        frame()
+
+def loop_select(server, scheduler):
+    """
+    wait on the socket and on stdin at the same time: keys are handled as soon as
+    they arrive, packets are processed as soon as they arrive and the screen
+    is repainted when a frame is due
+    """
+    stdin = sys.stdin.fileno()
+    fds = [server, stdin]
+    drain, frame, timeout = scheduler.drain, scheduler.frame, scheduler.timeout
+    recv = server.recv
+    while True:
+        ready, _, _ = select.select(fds, [], [], timeout() if scheduler.pending() else None)
+        if stdin in ready:
+            c = screen.getch()
+            while c != -1:
+                handle_key(c)
+                c = screen.getch()
+        if server in ready:
+            drain(recv, 0)
+        frame()
+
+def loop_headless(server, scheduler):
+    """no screen, no keyboard: receive and flush the output at the pace of the scheduler"""
+    recv = server.recv
+    drain, frame, timeout = scheduler.drain, scheduler.frame, scheduler.timeout
+    output = scheduler.handler
+    while True:
+        # with nothing to flush there is no deadline
+        drain(recv, max(1, int(timeout() * 1000)) if output.needsrefresh else 1000)
+        try:
+            frame()
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # the reader went away (oscprint.py --output csv | head)
                 exit()
-            elif c == R:  # (r)efresh
-                curses.endwin()
-                screen = curses.initscr()
-                maxy, maxx = screen.getmaxyx()
-                handler.footer.line = maxy - 1
-                handler.refresh(force=True)
-            elif c == S:  # (s)ort
-                handler.sort_lines()
-                handler.refresh(force=True)
-            elif c == C:  # (c)lear
-                handler.clear()
-            recv(50)
-            if handler.needsrefresh:
-                handler_refresh()
+            raise
+
+server = None
+handler = None
+recorder = None
+output = None
+stats = None
+
+def main():
+    global server, handler, recorder, output, stats
+    parse_args()
+    stats = Stats()
+    if BACKEND == 'liblo' and liblo is None:
+        print "liblo was not found. Use --backend select"
+        sys.exit(0)
+    if RECORD is not None:
+        try:
+            recorder = LogWriter(RECORD)
+        except LogError as e:
+            print e
+            sys.exit(1)
+    # the workers are started before the screen is taken over
+    if WORKERS:
+        server = SharedReceiver(PORT, WORKERS, stats=stats, include=INCLUDE, exclude=EXCLUDE)
+        loop = loop_select
+    elif BACKEND == 'liblo':
+        server = liblo_server(PORT, recorder, stats, include=INCLUDE, exclude=EXCLUDE)
+        loop = loop_liblo
+    else:
+        server = UDPReceiver(PORT, recorder=recorder, stats=stats, include=INCLUDE, exclude=EXCLUDE)
+        loop = loop_select
+    if OUTPUT is not None:
+        out = open(OUTFILE, "w") if OUTFILE not in (None, '-') else sys.stdout
+        output = StreamOutput(OUTPUT, out, ratelimit=RATELIMIT)
+        handler = Handler(autosort, HISTORY, onupdate=output.update)
+        # under systemd and friends: flush and close on stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit())
+    else:
+        init_screen()
+        handler = Handler(autosort, HISTORY)
+    if output is not None:
+        scheduler = RenderScheduler(output, fps=FPS, stats=stats)
+        loop = loop_headless
+    else:
+        scheduler = RenderScheduler(handler, fps=FPS, stats=stats)
+        screen.refresh()
+    try:
+        loop(server, scheduler)
     except KeyboardInterrupt:
         exit()
-    
-        
+
+if __name__ == '__main__':
+    main()
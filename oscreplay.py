@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Replay an OSC log recorded with oscprint.py --record
+
+    $ python oscprint.py --record show.osclog
+    $ python oscreplay.py show.osclog                  # to localhost:31415, in real time
+    $ python oscreplay.py show.osclog -p 9000 --speed 4
+    $ python oscreplay.py show.osclog --speed 0        # as fast as possible
+    $ python oscreplay.py show.osclog --start 30 --loop
+
+Packets are sent as they were received. The timing between them is kept,
+scaled by --speed. --start skips the first seconds of the log, using the
+index stored in it.
+"""
+import sys
+import time
+import optparse
+
+import osccodec
+from osccodec import monotonic
+from osclog import LogReader, LogError
+
+def replay(reader, sock, address, speed=1.0, start=0, timespan=None):
+    """
+    send the packets of reader to address
+
+    speed: 1 is real time, 0 is as fast as possible
+    start: seconds from the beginning of the log
+    timespan: reader.timespan(), if already known
+
+    Returns (packets, bytes) sent
+    """
+    sendto = sock.sendto
+    first, last = timespan or reader.timespan()
+    if first is None:
+        return 0, 0
+    t_start = first + start
+    offset = reader.offset_at(t_start)
+    packets = numbytes = 0
+    clock0 = None
+    sleep = time.sleep
+    for t, packet in reader.records(offset):
+        if t < t_start:
+            continue
+        if speed > 0:
+            if clock0 is None:
+                clock0 = monotonic()
+            delay = (t - t_start) / speed - (monotonic() - clock0)
+            if delay > 0:
+                sleep(delay)
+        sendto(packet, address)
+        packets += 1
+        numbytes += len(packet)
+    return packets, numbytes
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] logfile")
+    parser.add_option("-H", "--host", default="127.0.0.1", help="where to send the packets (default: 127.0.0.1)")
+    parser.add_option("-p", "--port", type="int", default=31415, help="OSC port (default: 31415)")
+    parser.add_option("-x", "--speed", type="float", default=1.0,
+                      help="playback speed. 1 is real time, 0 is as fast as possible (default: 1)")
+    parser.add_option("-s", "--start", type="float", default=0, help="start at this time, in seconds from the beginning of the log")
+    parser.add_option("-l", "--loop", action="store_true", default=False, help="replay the log again and again")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected the path of a log")
+    try:
+        reader = LogReader(args[0])
+    except (IOError, LogError) as e:
+        print e
+        sys.exit(1)
+    timespan = first, last = reader.timespan()
+    if first is None:
+        print "the log is empty"
+        sys.exit(0)
+    print "%s: %.1f seconds. Sending to %s:%d (press CTRL-C to stop)" % (args[0], last - first, options.host, options.port)
+    sock = osccodec.udpsocket()
+    address = (options.host, options.port)
+    total_packets = total_bytes = 0
+    t0 = time.time()
+    try:
+        while True:
+            packets, numbytes = replay(reader, sock, address, options.speed, options.start, timespan)
+            total_packets += packets
+            total_bytes += numbytes
+            if not options.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    dur = max(time.time() - t0, 1e-9)
+    print "sent %d packets (%d bytes) in %.2f s: %.0f packets/s, %.1f KB/s" % (
+        total_packets, total_bytes, dur, total_packets / dur, total_bytes / dur / 1024.)
+    reader.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+A table of the latest value of each label, in shared memory
+
+Written by several processes (forked after the table is created), read by
+one. Each label gets a fixed slot, found by hashing the label: a writer
+looks a label up once and then remembers its slot. Writers and the reader
+hold the table's lock for a whole batch of labels, not for each value.
+Changed slots are flagged. The reader collects only the flagged slots, so
+reading does not depend on the number of labels. Each value is stamped with a
+serial number, from a counter shared by the writers, which stamp() also hands
+out: what is passed to the reader by other means can be put in order with the
+values.
+
+    table = SharedTable(capacity=4096)
+    # in a writer process
+    table.publish({'freq': (KIND_PRINT, 440.0, None, None)})
+    # in the reader
+    for label, kind, value, minvalue, maxvalue, serial in table.changes():
+        ...
+
+A value is either a float, an int (kept exactly up to 2**53) or a string of at
+most TEXTSIZE bytes. Labels are at most LABELSIZE bytes. Anything else is
+rejected by publish, not cut.
+"""
+import zlib
+import struct
+
+LABELSIZE = 64
+TEXTSIZE = 64
+
+KIND_PRINT   = 1
+KIND_FADER   = 2
+KIND_VU      = 3
+KIND_PERCENT = 4
+
+_NUMBER = 'n'
+_INT = 'i'
+_TEXT = 't'
+_NAN = float('nan')
+# the largest int a double keeps exactly
+_MAXINT = 2 ** 53
+
+# label, kind, value type, serial, value, min, max, text
+_slot = struct.Struct("<%dsBc6xQddd%ds" % (LABELSIZE, TEXTSIZE))
+
+class SharedTable(object):
+    """
+    capacity: number of slots, the maximum number of labels
+
+    Must be created before the processes sharing it are forked
+    """
+    def __init__(self, capacity=4096):
+        # imported here, it is slow to import and not needed to read the constants
+        import multiprocessing
+        self.capacity = capacity
+        self.data = multiprocessing.RawArray('c', capacity * _slot.size)
+        self.changed = multiprocessing.RawArray('c', capacity)
+        self.used = multiprocessing.RawValue('i', 0)
+        self.serial = multiprocessing.RawValue('L', 0)
+        self.lock = multiprocessing.Lock()
+        # label -> slot, per process
+        self._slots = {}
+    def _claim(self, label):
+        """find or take the slot of label. Called with the lock held"""
+        capacity, size, data = self.capacity, _slot.size, self.data
+        start = zlib.crc32(label) % capacity
+        for i in xrange(capacity):
+            slot = (start + i) % capacity
+            offset = slot * size
+            existing = data[offset:offset + LABELSIZE].rstrip('\0')
+            if not existing:
+                struct.pack_into("%ds" % LABELSIZE, data, offset, label)
+                self.used.value += 1
+                return slot
+            if existing == label:
+                return slot
+        return None
+    def publish(self, updates):
+        """
+        updates: a dict label -> (kind, value, minvalue, maxvalue). minvalue and
+                 maxvalue can be None
+
+        Returns a list of the labels which could not be published: too long,
+        the table is full, or the value does not fit (see above)
+        """
+        rejected = []
+        slots, data, changed = self._slots, self.data, self.changed
+        size, pack_into = _slot.size, _slot.pack_into
+        with self.lock:
+            serial = self.serial.value
+            for label, (kind, value, minvalue, maxvalue) in updates.iteritems():
+                if isinstance(value, float):
+                    valuetype, number, text = _NUMBER, value, ''
+                elif isinstance(value, (int, long)) and not isinstance(value, bool) and -_MAXINT <= value <= _MAXINT:
+                    valuetype, number, text = _INT, value, ''
+                else:
+                    valuetype, number, text = _TEXT, 0, str(value)
+                    if len(text) > TEXTSIZE:
+                        rejected.append(label)
+                        continue
+                slot = slots.get(label)
+                if slot is None:
+                    if not label or len(label) > LABELSIZE:
+                        rejected.append(label)
+                        continue
+                    slot = self._claim(label)
+                    if slot is None:
+                        rejected.append(label)
+                        continue
+                    slots[label] = slot
+                serial += 1
+                pack_into(data, slot * size, label, kind, valuetype, serial, number,
+                          _NAN if minvalue is None else minvalue,
+                          _NAN if maxvalue is None else maxvalue,
+                          text)
+                changed[slot] = '\x01'
+            self.serial.value = serial
+        return rejected
+    def stamp(self):
+        """the next serial number, for something which is not in the table"""
+        with self.lock:
+            self.serial.value += 1
+            return self.serial.value
+    def changes(self):
+        """
+        the slots changed since the last call, as a list of
+        (label, kind, value, minvalue, maxvalue, serial)
+        """
+        out = []
+        data, changed = self.data, self.changed
+        size, unpack_from = _slot.size, _slot.unpack_from
+        with self.lock:
+            flags = changed.raw
+            slot = flags.find('\x01')
+            while slot >= 0:
+                changed[slot] = '\x00'
+                label, kind, valuetype, serial, number, minvalue, maxvalue, text = unpack_from(data, slot * size)
+                if valuetype == _NUMBER:
+                    value = number
+                elif valuetype == _INT:
+                    value = int(number)
+                else:
+                    value = text.rstrip('\0')
+                out.append((label.rstrip('\0'), kind, value,
+                            None if minvalue != minvalue else minvalue,
+                            None if maxvalue != maxvalue else maxvalue,
+                            serial))
+                slot = flags.find('\x01', slot + 1)
+        return out
+    def __len__(self):
+        return self.used.value